@@ -1,14 +1,36 @@
 # app/api/routes/normalization.py
-from fastapi import APIRouter, File, UploadFile, Form, HTTPException, Query, Body
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import APIRouter, File, UploadFile, Form, HTTPException, Query, Body, Request
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from typing import Optional, Union
 import os
+import json
+import asyncio
 from pathlib import Path
+import numpy as np
+import cv2
 
-from app.services.normalization_service import NormalizationService
+from app.services.normalization_service import (
+    NormalizationService, IMAGE_FORMATS, SCATTER_MODES, COMPARE_METHODS, STAIN_METHODS, STAIN_MAP_FORMATS,
+    CHART_MODES, HISTOGRAM_EQUALIZATION_IMAGES)
+from app.services.job_service import job_service, JOB_DONE, JOB_ERROR
+from app.services.single_flight_service import single_flight
+from app.services.scheduler_service import scheduler
+from app.services.stain_cache_service import stain_cache
+from app.services.shared_cache_service import shared_cache
+from app.services.memory_budget_service import memory_budget, MemoryBudgetError
+from app.normalization_methods.sweep import parameter_grid
+from app.normalization_methods import vahadane
+from app.utils.utils import BACKGROUND_MODES
+from app.utils import kernels
+from app.utils import content_urls
+from app.config import settings
 from app.models.schemas import (
     MethodsResponse, 
     NormalizationResponse,
+    JobStatusResponse,
+    CompareResponse,
+    SweepResponse,
+    StatsResponse,
     ErrorResponse
 )
 
@@ -19,8 +41,15 @@ router = APIRouter(
 )
 
 # Define paths for uploads and results
-UPLOAD_DIR = Path("static/images/uploads")
-RESULT_DIR = Path("static/images/results")
+IMAGES_DIR = Path("static/images")
+UPLOAD_DIR = IMAGES_DIR / "uploads"
+RESULT_DIR = IMAGES_DIR / "results"
+
+# Response formats of /process: JSON with file paths and chart data, or the encoded image itself
+RESPONSE_FORMATS = ("json", "image")
+
+# Seconds between job status checks of the /jobs/{job_id}/events stream
+JOB_EVENTS_POLL_INTERVAL = 0.25
 
 # Ensure directories exist
 UPLOAD_DIR.mkdir(exist_ok=True, parents=True)
@@ -61,7 +90,8 @@ async def get_methods():
             "description": "Stain normalization using Vahadane's method"
         }
     ]
-    return {"methods": methods}
+    return {"methods": methods, "kernel_backend": kernels.backend(),
+            "vahadane_backend": vahadane.dictionary_backend()}
 
 async def save_upload_file(upload_file: UploadFile) -> Path:
     """Save an uploaded file and return its path"""
@@ -94,11 +124,106 @@ async def save_upload_file(upload_file: UploadFile) -> Path:
     except Exception as e:
         raise ValueError(f"Error saving file: {str(e)}")
 
-@router.post("/process", response_model=NormalizationResponse, responses={400: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
+async def file_info(path, filename=None) -> dict:
+    """Response entry (filename, path, urls) for a stored image file; url is content-addressed"""
+    relative_path = Path(path).relative_to(IMAGES_DIR).as_posix()
+    return {
+        "filename": filename or os.path.basename(path),
+        "path": str(path),
+        "url": f"/api/normalization/files/{await content_urls.content_digest_async(path)}/{relative_path}",
+        "download_url": f"/api/normalization/download/{os.path.basename(path)}"
+    }
+
+async def cached_file_response(request: Request, path, digest=None, **kwargs) -> Response:
+    """
+    FileResponse with an ETag of the file's content. With the digest of a content-addressed
+    URL the response is cacheable for good, otherwise clients revalidate (304 when unchanged).
+    """
+    tag = content_urls.etag(digest or await content_urls.content_digest_async(path))
+    headers = dict(kwargs.pop("headers", {}), etag=tag)
+    headers["Cache-Control"] = content_urls.IMMUTABLE if digest else content_urls.REVALIDATE
+    if content_urls.not_modified(request.headers.get("if-none-match"), tag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path=str(path), headers=headers, **kwargs)
+
+async def result_images_info(result_images) -> list:
+    """Response entries for the histogram equalization result images (or the stain maps)"""
+    return [
+        dict(await file_info(img_info['path']), name=img_info['name'], key=img_info['key'])
+        for img_info in result_images
+    ]
+
+async def build_process_response(method_name, result, source_path, source_filename, reference_path=None,
+                           reference_filename=None, group_id=None) -> dict:
+    """Create the /process JSON response from a NormalizationService result"""
+    response = {
+        "success": True,
+        "message": f"Image processed with {method_name} method",
+        "method": method_name,
+        "source_image": await file_info(source_path, source_filename),
+        "chart_data": result.get('chart_data'),  # Interactive charts replace static plots
+        "chart_url": f"/api/normalization/charts/{result['chart_id']}" if result.get('chart_id') else None,
+        "group_id": group_id,
+        "background_fraction": result.get('background_fraction'),
+        "cached": result.get('cached'),
+        "stages": result.get('stages'),
+        "low_memory": result.get('low_memory'),
+        "memory_estimate_mb": result.get('memory_estimate_mb')
+    }
+    
+    # Handle different response structures based on method
+    if method_name == "histogram_equalization":
+        # Multiple result images for histogram equalization
+        response["result_images"] = await result_images_info(result['result_images'])
+    else:
+        # Single result image for other methods
+        response["result_image"] = await file_info(result['result_image'])
+    
+    # Add reference image info if provided
+    if reference_path:
+        response["reference_image"] = await file_info(reference_path, reference_filename)
+    
+    if result.get('stain_maps'):
+        response["stain_maps"] = await result_images_info(result['stain_maps'])
+    
+    if result.get('profile'):
+        profile = result['profile']
+        response["profile"] = {
+            "file": await file_info(profile['path']),
+            "seconds": profile['seconds'],
+            "hot_functions": profile['hot_functions']
+        }
+    
+    return response
+
+async def read_upload_image(upload_file: UploadFile) -> np.ndarray:
+    """Decode an uploaded image to an RGB uint8 array without saving it"""
+    await upload_file.seek(0)
+    content = await upload_file.read()
+    img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Could not read image: {upload_file.filename}")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+@router.post("/process", response_model=NormalizationResponse, responses={200: {"content": {"image/png": {}, "image/jpeg": {}, "image/webp": {}}}, 400: {"model": ErrorResponse}, 413: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
 async def process_image(
     source_image: UploadFile = File(..., description="Source image to process"),
     method: int = Form(..., description="Normalization method (1-5): 1=Histogram Equalization, 2=Histogram Matching, 3=Reinhard, 4=Macenko, 5=Vahadane"),
-    reference_image: Optional[UploadFile] = File(None, description="Reference image (required for methods 2-5, not used for method 1)")
+    reference_image: Optional[UploadFile] = File(None, description="Reference image (required for methods 2-5, not used for method 1)"),
+    group_id: Optional[str] = Form(None, description="Slide/group id: Macenko and Vahadane estimate the source stains once per group and reuse them for its other tiles"),
+    group_thumbnail: Optional[UploadFile] = File(None, description="Optional thumbnail of the slide to estimate the group's source stains from (methods 4-5 with group_id)"),
+    background: Optional[str] = Form(None, description="Methods 4-5: solve only tissue pixels and 'passthrough' or 'white' the background"),
+    source_scale: float = Form(1, ge=1, description="Estimate source statistics on a copy downscaled by this factor (e.g. 4); the mapping is applied at full resolution"),
+    reference_scale: float = Form(1, ge=1, description="Fit the reference on a copy downscaled by this factor"),
+    response_format: str = Form("json", description="'json' for file paths and chart data, 'image' to return the encoded result image directly without writing any files"),
+    image_format: str = Form("png", description="Encoding of the result for response_format='image': png, jpeg or webp"),
+    result_key: str = Form("adaptive_equalize", description="Method 1 with response_format='image': which image to return (original, rescale, equalize, adaptive_equalize)"),
+    preview: bool = Form(False, description="Respond with a low-resolution preview right away and compute the full result in the background (poll status_url or stream events_url)"),
+    preview_size: int = Form(512, ge=32, le=4096, description="Longest side of the preview in pixels"),
+    scatter_mode: str = Form("sample", description="Methods 2-5: 'sample' plots 2000 random pixels, 'density' a fixed 64x64 R-G grid of pixel counts and dominant channels over all pixels"),
+    profile: bool = Form(False, description="Debug: compute the result under cProfile (bypassing the result cache) and return a downloadable profile with its hottest functions; requires COLOR_NORM_PROFILING"),
+    stain_maps: Optional[str] = Form(None, description="Methods 4-5: also return the hematoxylin and eosin concentration maps solved by the normalization, as 'image' (grayscale PNGs) or 'float16' (one H x W x 2 .npy array)"),
+    charts: str = Form("deferred", description="'deferred' responds as soon as the result image is ready, the chart data is computed on the first request of chart_url; 'inline' includes chart_data in the response")
 ):
     """Process image with selected normalization method"""
     try:
@@ -119,112 +244,370 @@ async def process_image(
         
         method_name = method_mapping[method]
         
+        if background is not None and background not in BACKGROUND_MODES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid background mode. Please choose from {', '.join(BACKGROUND_MODES)}"
+            )
+        
+        if scatter_mode not in SCATTER_MODES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid scatter mode. Please choose from {', '.join(SCATTER_MODES)}"
+            )
+        
+        if response_format not in RESPONSE_FORMATS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid response format. Please choose from {', '.join(RESPONSE_FORMATS)}"
+            )
+        
+        if stain_maps is not None:
+            if stain_maps not in STAIN_MAP_FORMATS:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Invalid stain map format. Please choose from {', '.join(STAIN_MAP_FORMATS)}"
+                )
+            if method_name not in STAIN_METHODS:
+                raise HTTPException(status_code=400, detail="Stain maps require method 4 or 5")
+            if response_format != "json":
+                raise HTTPException(status_code=400, detail="Stain maps require response_format='json'")
+        
+        if charts not in CHART_MODES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid chart mode. Please choose from {', '.join(CHART_MODES)}"
+            )
+        
+        if profile and not settings.profiling:
+            raise HTTPException(status_code=403, detail="Profiling is disabled on this server (COLOR_NORM_PROFILING)")
+        
+        if profile and response_format != "json":
+            raise HTTPException(status_code=400, detail="Profiling requires response_format='json'")
+        
+        if response_format == "image":
+            if image_format not in IMAGE_FORMATS:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Invalid image format. Please choose from {', '.join(IMAGE_FORMATS)}"
+                )
+            if method_name == "histogram_equalization" and result_key not in HISTOGRAM_EQUALIZATION_IMAGES:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Invalid result key. Please choose from {', '.join(HISTOGRAM_EQUALIZATION_IMAGES)}"
+                )
+            # Decode everything in memory: no uploads, results or chart data are written
+            source_img = await read_upload_image(source_image)
+            reference_img = await read_upload_image(reference_image) if reference_image else None
+            thumbnail_img = await read_upload_image(group_thumbnail) if group_id and group_thumbnail else None
+            content, media_type, background_fraction = await scheduler.run(
+                lambda: NormalizationService.normalize_to_bytes(
+                    source_img,
+                    method_name,
+                    reference_img,
+                    image_format=image_format,
+                    result_key=result_key,
+                    group_id=group_id,
+                    group_thumbnail=thumbnail_img,
+                    background=background,
+                    source_scale=source_scale,
+                    reference_scale=reference_scale
+                ),
+                scheduler.estimate_cost(method_name, source_img.shape[0] * source_img.shape[1])
+            )
+            headers = {"X-Normalization-Method": method_name}
+            if background_fraction is not None:
+                headers["X-Background-Fraction"] = f"{background_fraction:.6f}"
+            return Response(content=content, media_type=media_type, headers=headers)
+        
         # Save uploaded files
         source_path = await save_upload_file(source_image)
         reference_path = None
         if reference_image:
             reference_path = await save_upload_file(reference_image)
         
+        # Decode the group thumbnail in memory, it is only used for stain estimation
+        thumbnail_img = None
+        if group_id and group_thumbnail:
+            thumbnail_img = await read_upload_image(group_thumbnail)
+        
+        reference_filename = reference_image.filename if reference_image else None
+        
+        if preview:
+            # Quick preview from a downscaled source with the same fitted target; the
+            # full-resolution result follows through the job endpoints
+            preview_path = await scheduler.run(
+                lambda: NormalizationService.preview_image(
+                    source_path, method_name, reference_path, preview_size=preview_size,
+                    background=background, reference_scale=reference_scale),
+                scheduler.estimate_cost(method_name, preview_size * preview_size))
+            job_id = job_service.create()
+            
+            async def full_result():
+                result = await NormalizationService.normalize_image(
+                    source_path, method_name, reference_path, group_id, thumbnail_img,
+                    background, source_scale, reference_scale, scatter_mode, profile, stain_maps, charts)
+                return await build_process_response(
+                    method_name, result, source_path, source_image.filename,
+                    reference_path, reference_filename, group_id)
+            
+            job_service.start(job_id, full_result)
+            response = {
+                "success": True,
+                "message": f"Preview processed with {method_name} method, full result pending",
+                "method": method_name,
+                "source_image": await file_info(source_path, source_image.filename),
+                "preview_image": await file_info(preview_path),
+                "group_id": group_id,
+                "job_id": job_id,
+                "status_url": f"/api/normalization/jobs/{job_id}",
+                "events_url": f"/api/normalization/jobs/{job_id}/events"
+            }
+            if reference_path:
+                response["reference_image"] = await file_info(reference_path, reference_filename)
+            return response
+        
         # Process the image using our service
         result = await NormalizationService.normalize_image(
             source_path, 
             method_name,
-            reference_path
+            reference_path,
+            group_id=group_id,
+            group_thumbnail=thumbnail_img,
+            background=background,
+            source_scale=source_scale,
+            reference_scale=reference_scale,
+            scatter_mode=scatter_mode,
+            profile=profile,
+            stain_maps=stain_maps,
+            charts=charts
         )
         
-        # Create response with image information
+        return await build_process_response(
+            method_name, result, source_path, source_image.filename,
+            reference_path, reference_filename, group_id)
+        
+    except HTTPException:
+        raise
+    except MemoryBudgetError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        import traceback
+        error_detail = f"Error processing image: {str(e)}\n{traceback.format_exc()}"
+        print(f"ERROR in normalization route: {error_detail}")  # Add console logging
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/compare", response_model=CompareResponse, responses={400: {"model": ErrorResponse}, 413: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
+async def compare_methods(
+    source_image: UploadFile = File(..., description="Source image to process"),
+    reference_image: UploadFile = File(..., description="Reference image for methods 2-5"),
+    methods: Optional[str] = Form(None, description="Comma-separated method numbers to run (default: all, 1-5)"),
+    scatter_mode: str = Form("sample", description="'sample' or 'density' scatter plot data (see /process)")
+):
+    """Run several normalization methods side by side on the same source and reference"""
+    try:
+        method_names = list(COMPARE_METHODS)
+        if methods:
+            try:
+                numbers = [int(number) for number in methods.split(",")]
+            except ValueError:
+                numbers = []
+            if not numbers or any(number not in range(1, len(COMPARE_METHODS) + 1) for number in numbers):
+                raise HTTPException(
+                    status_code=400,
+                    detail="Invalid methods. Please give comma-separated method numbers from 1-5"
+                )
+            method_names = [COMPARE_METHODS[number - 1] for number in dict.fromkeys(numbers)]
+        
+        if scatter_mode not in SCATTER_MODES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid scatter mode. Please choose from {', '.join(SCATTER_MODES)}"
+            )
+        
+        source_path = await save_upload_file(source_image)
+        reference_path = await save_upload_file(reference_image)
+        
+        comparison = await NormalizationService.compare(source_path, reference_path, method_names, scatter_mode)
+        
+        results = []
+        for method_name, result in comparison['results'].items():
+            entry = {"method": method_name, "error": result.get('error')}
+            if 'result_image' in result:
+                entry["result_image"] = await file_info(result['result_image'])
+            if 'result_images' in result:
+                entry["result_images"] = await result_images_info(result['result_images'])
+            results.append(entry)
+        
+        failed = [entry["method"] for entry in results if entry["error"]]
+        return {
+            "success": not failed,
+            "message": f"Compared {len(results)} methods" + (f", failed: {', '.join(failed)}" if failed else ""),
+            "source_image": await file_info(source_path, source_image.filename),
+            "reference_image": await file_info(reference_path, reference_image.filename),
+            "results": results,
+            "chart_data": comparison['chart_data']
+        }
+        
+    except HTTPException:
+        raise
+    except MemoryBudgetError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/sweep", response_model=SweepResponse, responses={400: {"model": ErrorResponse}, 413: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
+async def sweep_parameters(
+    source_image: UploadFile = File(..., description="Source image to tune the method on"),
+    method: int = Form(..., description="Method to sweep: 1=Histogram Equalization (CLAHE), 4=Macenko, 5=Vahadane"),
+    grid: str = Form(..., description='JSON object of parameter -> list of values, e.g. {"beta": [0.1, 0.15, 0.2], "alpha": [1, 2]}. '
+                                      'Method 1: clip_limit; 4: beta, alpha, concentration_lamda; 5: threshold, lamda, concentration_lamda'),
+    reference_image: Optional[UploadFile] = File(None, description="Reference image (required for methods 4-5)"),
+    size: int = Form(256, ge=32, le=1024, description="Longest side of the low-resolution results in pixels")
+):
+    """Evaluate a parameter grid in one request and return a contact sheet of the results"""
+    try:
+        method_mapping = {
+            1: "histogram_equalization",
+            4: "macenko",
+            5: "vahadane"
+        }
+        
+        if method not in method_mapping:
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid method number. Only methods 1, 4 and 5 can be swept"
+            )
+        
+        method_name = method_mapping[method]
+        
+        try:
+            points = parameter_grid(method_name, json.loads(grid))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid grid: {str(e)}")
+        
+        if method_name != "histogram_equalization" and not reference_image:
+            raise HTTPException(status_code=400, detail=f"Method '{method_name}' requires a reference image")
+        
+        source_path = await save_upload_file(source_image)
+        reference_path = await save_upload_file(reference_image) if reference_image else None
+        
+        result = await NormalizationService.sweep(source_path, method_name, points, reference_path, size)
+        
         response = {
             "success": True,
-            "message": f"Image processed with {method_name} method",
+            "message": f"Evaluated {len(points)} {method_name} parameter combinations",
             "method": method_name,
-            "source_image": {
-                "filename": source_image.filename,
-                "path": str(source_path),
-                "url": f"/{source_path}",
-                "download_url": f"/api/normalization/download/{os.path.basename(source_path)}"
-            },
-            "chart_data": result.get('chart_data')  # Interactive charts replace static plots
+            "source_image": await file_info(source_path, source_image.filename),
+            "contact_sheet": await file_info(result['contact_sheet']),
+            "columns": result['columns'],
+            "points": result['points']
         }
-        
-        # Handle different response structures based on method
-        if method_name == "histogram_equalization":
-            # Multiple result images for histogram equalization
-            response["result_images"] = []
-            for img_info in result['result_images']:
-                response["result_images"].append({
-                    "name": img_info['name'],
-                    "filename": os.path.basename(img_info['path']),
-                    "path": str(img_info['path']),
-                    "url": f"/{img_info['path']}",
-                    "download_url": f"/api/normalization/download/{os.path.basename(img_info['path'])}",
-                    "key": img_info['key']
-                })
-        else:
-            # Single result image for other methods
-            response["result_image"] = {
-                "filename": os.path.basename(result['result_image']),
-                "path": str(result['result_image']),
-                "url": f"/{result['result_image']}",
-                "download_url": f"/api/normalization/download/{os.path.basename(result['result_image'])}"
-            }
-        
-        # Add reference image info if provided
         if reference_path:
-            response["reference_image"] = {
-                "filename": reference_image.filename,
-                "path": str(reference_path),                "url": f"/{reference_path}",
-                "download_url": f"/api/normalization/download/{os.path.basename(reference_path)}"
-            }
-        
+            response["reference_image"] = await file_info(reference_path, reference_image.filename)
         return response
         
+    except HTTPException:
+        raise
+    except MemoryBudgetError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
-        import traceback
-        error_detail = f"Error processing image: {str(e)}\n{traceback.format_exc()}"
-        print(f"ERROR in normalization route: {error_detail}")  # Add console logging
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/jobs/{job_id}", response_model=JobStatusResponse, responses={404: {"model": ErrorResponse}})
+async def get_job(job_id: str):
+    """Status of a background job; includes the full /process response once done"""
+    state = job_service.get(job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return state
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events with the job's status changes, ending with its result or error"""
+    if job_service.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def stream():
+        last_status = None
+        while True:
+            state = job_service.get(job_id)
+            if state is None:
+                yield f"event: {JOB_ERROR}\ndata: {json.dumps({'job_id': job_id, 'error': 'Job not found'})}\n\n"
+                return
+            if state["status"] != last_status:
+                last_status = state["status"]
+                yield f"event: {last_status}\ndata: {json.dumps(state, default=str)}\n\n"
+            if last_status in (JOB_DONE, JOB_ERROR):
+                return
+            await asyncio.sleep(JOB_EVENTS_POLL_INTERVAL)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@router.get("/stats", response_model=StatsResponse)
+async def get_stats():
+    """Scheduler queue waits, request coalescing and cache counters of this worker process"""
+    return {
+        "scheduler": scheduler.stats(),
+        "coalescing": single_flight.stats(),
+        "stain_cache": stain_cache.stats(),
+        "shared_cache": shared_cache.stats(),
+        "memory_budget": memory_budget.stats()
+    }
+
 @router.get("/download/{filename}")
-async def download_file(filename: str):
+async def download_file(filename: str, request: Request):
     """Download a processed image file"""
     try:
-        # Check in results directory first (normalized images)
-        result_file_path = RESULT_DIR / filename
-        if result_file_path.exists() and result_file_path.is_file():
-            return FileResponse(
-                path=str(result_file_path),
-                filename=filename,
-                media_type='application/octet-stream',
-                headers={"Content-Disposition": f"attachment; filename={filename}"}
-            )
-        
-        # If not found in results, check uploads directory
-        upload_file_path = UPLOAD_DIR / filename
-        if upload_file_path.exists() and upload_file_path.is_file():
-            return FileResponse(
-                path=str(upload_file_path),
-                filename=filename,
-                media_type='application/octet-stream',
-                headers={"Content-Disposition": f"attachment; filename={filename}"}
-            )
-        
-        # If not found in either directory, check subdirectories in results
-        for subdir in RESULT_DIR.iterdir():
-            if subdir.is_dir():
-                file_path = subdir / filename
-                if file_path.exists() and file_path.is_file():
-                    return FileResponse(
-                        path=str(file_path),
-                        filename=filename,
-                        media_type='application/octet-stream',
-                        headers={"Content-Disposition": f"attachment; filename={filename}"}
-                    )
+        # Check in results directory first (normalized images), then uploads,
+        # then the subdirectories of results
+        candidates = [RESULT_DIR / filename, UPLOAD_DIR / filename]
+        candidates += [subdir / filename for subdir in RESULT_DIR.iterdir() if subdir.is_dir()]
+        for file_path in candidates:
+            if file_path.exists() and file_path.is_file():
+                return await cached_file_response(
+                    request,
+                    file_path,
+                    filename=filename,
+                    media_type='application/octet-stream',
+                    headers={"Content-Disposition": f"attachment; filename={filename}"}
+                )
         
         raise HTTPException(status_code=404, detail="File not found")
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error downloading file: {str(e)}")
 
+@router.get("/files/{digest}/{file_path:path}", responses={404: {"model": ErrorResponse}})
+async def get_file(digest: str, file_path: str, request: Request):
+    """Uploaded or result file by the content-addressed url of its response entry (cached for good)"""
+    tag = content_urls.etag(digest)
+    if content_urls.not_modified(request.headers.get("if-none-match"), tag):
+        # The digest names the content, whether or not the file is still stored
+        return Response(status_code=304, headers={"etag": tag, "Cache-Control": content_urls.IMMUTABLE})
+    images_dir = IMAGES_DIR.resolve()
+    path = (images_dir / file_path).resolve()
+    if images_dir not in path.parents or not path.is_file() or await content_urls.content_digest_async(path) != digest:
+        # Unknown, removed, or rewritten since the url was issued
+        raise HTTPException(status_code=404, detail="File not found")
+    return await cached_file_response(request, path, digest)
+
+@router.get("/charts/{chart_id}", responses={404: {"model": ErrorResponse}})
+async def get_result_charts(chart_id: str, request: Request):
+    """Chart data of a /process result (its chart_url), computed on first request and then served from disk"""
+    chart_dir = RESULT_DIR / chart_id
+    if Path(chart_id).name != chart_id or not chart_dir.is_dir():
+        raise HTTPException(status_code=404, detail=f"Result '{chart_id}' not found")
+    try:
+        data_path = await NormalizationService.chart_data_file(chart_dir)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"The images of result '{chart_id}' are no longer available")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating chart data: {str(e)}")
+    return await cached_file_response(request, data_path, media_type="application/json")
+
 @router.get("/chart-data/{source_filename}")
 async def get_chart_data(source_filename: str):
     """Get histogram data for interactive charts"""
@@ -0,0 +1,82 @@
+import os
+from pathlib import Path
+from typing import Optional
+
+
+def _env_int(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.getenv(name)
+    if value is None or value.strip().lower() in ("", "auto"):
+        return default
+    return int(value)
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return float(value)
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+class Settings:
+    """Runtime configuration, read from COLOR_NORM_* environment variables"""
+
+    def __init__(self):
+        # Shared cache of fitted references and finished results (shared by all
+        # worker processes on one host, so it must not live under static/)
+        self.cache_enabled = _env_bool("COLOR_NORM_CACHE", True)
+        self.cache_dir = Path(os.getenv("COLOR_NORM_CACHE_DIR", "cache"))
+
+        # Macenko transforms of images with more pixels than chunked_min_pixels run in
+        # chunks of chunk_pixels pixels, bounding their transient memory (0 disables)
+        self.chunk_pixels = _env_int("COLOR_NORM_CHUNK_PIXELS", 1 << 16)
+        self.chunked_min_pixels = _env_int("COLOR_NORM_CHUNKED_MIN_PIXELS", 1 << 23)
+
+        # Per-pixel kernels: "numba" (JIT-compiled, needs numba), "numpy", or "auto"
+        # to use numba when it is installed
+        self.kernels = os.getenv("COLOR_NORM_KERNELS", "auto")
+
+        # Vahadane stain dictionary: "spams" (trainDL, needs spams), "nmf" (NumPy), or
+        # "auto" to use spams when it is installed
+        self.vahadane_backend = os.getenv("COLOR_NORM_VAHADANE_BACKEND", "auto")
+
+        # Production launcher (run.py --prod). Workers and compute threads per
+        # worker are derived from the available cores unless set ("auto")
+        self.host = os.getenv("COLOR_NORM_HOST", "0.0.0.0")
+        self.port = _env_int("COLOR_NORM_PORT", 8080)
+        self.workers = _env_int("COLOR_NORM_WORKERS", None)
+        self.compute_threads = _env_int("COLOR_NORM_COMPUTE_THREADS", None)
+
+        # Scheduler: requests estimated to take longer than expensive_cost seconds run on
+        # the expensive pool, all others on the cheap pool. Pool sizes are derived from
+        # the cores left to each worker process (cores / (workers x compute threads))
+        # unless set ("auto")
+        self.cheap_workers = _env_int("COLOR_NORM_CHEAP_WORKERS", None)
+        self.expensive_workers = _env_int("COLOR_NORM_EXPENSIVE_WORKERS", None)
+        self.expensive_cost = _env_float("COLOR_NORM_EXPENSIVE_COST", 0.5)
+
+        # Memory: per-request budget in MB for /process (requests predicted above it switch
+        # to a low-memory path or are rejected; unset means no budget), and per-stage peak
+        # memory measurement with tracemalloc (adds overhead to every allocation and runs the
+        # measured stages of a process one at a time)
+        self.memory_budget_mb = _env_int("COLOR_NORM_MEMORY_BUDGET_MB", None)
+        self.memory_tracking = _env_bool("COLOR_NORM_MEMORY_TRACKING", False)
+
+        # Compression of JSON (and other compressible) responses for clients that accept
+        # gzip: responses of at least gzip_min_bytes bytes (0 disables it) at gzip_level
+        self.gzip_min_bytes = _env_int("COLOR_NORM_GZIP_MIN_BYTES", 1024)
+        self.gzip_level = _env_int("COLOR_NORM_GZIP_LEVEL", 6)
+
+        # Debugging: allow /process requests to ask for a cProfile capture of their
+        # computation, summarized by its profile_top hottest functions
+        self.profiling = _env_bool("COLOR_NORM_PROFILING", False)
+        self.profile_top = _env_int("COLOR_NORM_PROFILE_TOP", 15)
+
+
+settings = Settings()
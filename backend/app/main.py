@@ -1,8 +1,15 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
 from fastapi.staticfiles import StaticFiles
 import os
 from app.services.cleanup_service import cleanup_service
+from app.config import settings
+from app.utils.threads import limit_threads
+from app.utils import kernels
+from app.utils import memory
+from app.normalization_methods import vahadane
 
 # This will create dir if does not exist
 os.makedirs("static/images/uploads", exist_ok=True)
@@ -15,9 +22,15 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# Startup event - start automatic cleanup
+# Startup event - limit compute threads, select the kernel and stain dictionary backends and start automatic cleanup
 @app.on_event("startup")
 async def startup_event():
+    if settings.compute_threads:
+        limit_threads(settings.compute_threads)
+    kernels.set_backend(settings.kernels)
+    vahadane.set_dictionary_backend(settings.vahadane_backend)
+    if settings.memory_tracking:
+        memory.start_tracking()
     cleanup_service.start_automatic_cleanup()
 
 # Shutdown event - stop automatic cleanup
@@ -34,6 +47,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large JSON responses (chart data); images, downloads and arrays are sent as they are
+if settings.gzip_min_bytes:
+    app.add_middleware(
+        GZipMiddleware,
+        minimum_size=settings.gzip_min_bytes,
+        compresslevel=settings.gzip_level,
+        exclude_content_types=DEFAULT_EXCLUDED_CONTENT_TYPES + ("application/octet-stream",),
+    )
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # Import and include API routers
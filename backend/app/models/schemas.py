@@ -51,11 +51,20 @@ class ScatterPlotData(BaseModel):
     color: str
     channel: str
 
+class ScatterDensity(BaseModel):
+    """Schema for the R-G density grid of the density scatter mode"""
+    bins: int
+    min: float  # Lower edge of the first cell on both axes (centered intensities)
+    max: float  # Upper edge of the last cell
+    counts: List[List[int]]  # bins x bins pixel counts, rows are red bins
+    dominant: List[List[int]]  # bins x bins dominant channel (0=red, 1=green, 2=blue, -1=empty)
+
 class ImageChartData(BaseModel):
     """Schema for chart data of a single image"""
     histograms: List[HistogramData]
     cdfs: List[CDFData]
-    scatter_plots: List[ScatterPlotData]
+    scatter_plots: List[ScatterPlotData] = []  # Not generated for grayscale images or in density mode
+    scatter_density: Optional[ScatterDensity] = None  # Density scatter mode only
 
 class ChartData(BaseModel):
     """Schema for complete chart data - flexible to handle different method types"""
@@ -64,6 +73,27 @@ class ChartData(BaseModel):
     # - Histogram equalization: original, rescale, equalize, adaptive_equalize
     images: Dict[str, ImageChartData]
     
+class HotFunction(BaseModel):
+    """Schema for one function of a profile summary"""
+    function: str
+    file: str
+    line: int
+    calls: int
+    self_seconds: float  # Time spent in the function itself
+    cumulative_seconds: float  # Including the functions it called
+    
+class ProfileInfo(BaseModel):
+    """Schema for the profile of a /process computation"""
+    file: ImageInfo  # pstats (.prof) file, e.g. for snakeviz or pstats.Stats
+    seconds: float
+    hot_functions: List[HotFunction]
+    
+class StageInfo(BaseModel):
+    """Schema for one processing stage of a /process computation"""
+    name: str  # decode, decode_reference, fit, transform, save, charts
+    seconds: float
+    peak_mb: Optional[float] = None  # Peak allocations during the stage (COLOR_NORM_MEMORY_TRACKING)
+    
 class NormalizationResponse(BaseModel):
     """Response schema for the normalization endpoint"""
     success: bool
@@ -74,6 +104,69 @@ class NormalizationResponse(BaseModel):
     result_images: Optional[List[ResultImageInfo]] = None  # For multiple results (histogram equalization)
     reference_image: Optional[ImageInfo] = None
     chart_data: Optional[ChartData] = None  # Interactive charts replace static plots
+    chart_url: Optional[str] = None  # Chart data of the result, computed on first request (deferred charts)
+    group_id: Optional[str] = None  # Slide/group whose cached source stains were used
+    background_fraction: Optional[float] = None  # Fraction of background pixels skipped by the stain solve
+    cached: Optional[bool] = None  # Result was reused from the shared cache
+    preview_image: Optional[ImageInfo] = None  # Low-resolution preview (preview mode)
+    job_id: Optional[str] = None  # Background job computing the full result (preview mode)
+    status_url: Optional[str] = None
+    events_url: Optional[str] = None
+    profile: Optional[ProfileInfo] = None  # Debug profile of the computation (profile mode)
+    stages: Optional[List[StageInfo]] = None  # Time and memory of each processing stage
+    low_memory: Optional[bool] = None  # The memory budget switched the request to the low-memory path
+    memory_estimate_mb: Optional[float] = None  # Predicted peak memory of the computation
+    stain_maps: Optional[List[ResultImageInfo]] = None  # Hematoxylin/eosin concentration maps (methods 4-5)
+    
+class JobStatusResponse(BaseModel):
+    """Response schema for background job status"""
+    job_id: str
+    status: str  # pending, running, done or error
+    result: Optional[NormalizationResponse] = None  # Full /process response once done
+    error: Optional[str] = None
+    
+class MethodResult(BaseModel):
+    """Schema for the result of one method in a comparison"""
+    method: str
+    result_image: Optional[ImageInfo] = None
+    result_images: Optional[List[ResultImageInfo]] = None  # Histogram equalization
+    error: Optional[str] = None  # Set when the method failed on this image
+    
+class CompareResponse(BaseModel):
+    """Response schema for running several methods on the same images"""
+    success: bool
+    message: str
+    source_image: ImageInfo
+    reference_image: ImageInfo
+    results: List[MethodResult]
+    chart_data: ChartData  # source, reference and one entry per method
+    
+class SweepPoint(BaseModel):
+    """Schema for one evaluated grid point of a parameter sweep"""
+    params: Dict[str, float]
+    label: str
+    row: int  # Tile position on the contact sheet
+    column: int
+    error: Optional[str] = None  # Set when the point could not be evaluated
+    
+class SweepResponse(BaseModel):
+    """Response schema for parameter sweeps"""
+    success: bool
+    message: str
+    method: str
+    source_image: ImageInfo
+    reference_image: Optional[ImageInfo] = None
+    contact_sheet: ImageInfo
+    columns: int
+    points: List[SweepPoint]
+    
+class StatsResponse(BaseModel):
+    """Response schema for the stats endpoint (counters of this worker process)"""
+    scheduler: Dict[str, Any]  # per class: pool size, job counts and queue wait seconds
+    coalescing: Dict[str, int]  # executions, coalesced and in-flight /process computations
+    stain_cache: Dict[str, int]
+    shared_cache: Dict[str, Any]
+    memory_budget: Dict[str, Any]  # budget_mb and planned, low-memory and rejected requests
     
 class ErrorResponse(BaseModel):
     """Schema for error responses"""
@@ -88,4 +181,6 @@ class MethodInfo(BaseModel):
     description: str
 
 class MethodsResponse(BaseModel):
-    methods: List[MethodInfo]
\ No newline at end of file
+    methods: List[MethodInfo]
+    kernel_backend: str
+    vahadane_backend: str
\ No newline at end of file
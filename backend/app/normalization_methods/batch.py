@@ -0,0 +1,50 @@
+"""
+Library-level batch API for in-process pipelines.
+
+Normalizes an N x H x W x 3 uint8 stack (e.g. from utils.build_stack(..., dtype=np.uint8))
+against a fitted target without any HTTP, file or chart overhead:
+
+    normalizer = fit_normalizer("macenko", target)
+    normalize_batch(normalizer, stack, out=out)
+"""
+
+from __future__ import division
+
+from app.normalization_methods.histogram_matching import Normalizer as HistogramMatchingNormalizer
+from app.normalization_methods.reinhard import Normalizer as ReinhardNormalizer
+from app.normalization_methods.macenko import Normalizer as MacenkoNormalizer
+from app.normalization_methods.vahadane import Normalizer as VahadaneNormalizer
+
+# Methods with a fitted target, by the names used in the API
+NORMALIZERS = {
+    "histogram_matching": HistogramMatchingNormalizer,
+    "reinhard": ReinhardNormalizer,
+    "macenko": MacenkoNormalizer,
+    "vahadane": VahadaneNormalizer,
+}
+
+
+def fit_normalizer(method, target, scale=1):
+    """
+    Create and fit a normalizer for a method.
+    :param method: one of NORMALIZERS
+    :param target: RGB uint8 reference image
+    :param scale: fit on a copy downscaled by this factor
+    :return:
+    """
+    if method not in NORMALIZERS:
+        raise ValueError(f"Unknown method: {method}")
+    normalizer = NORMALIZERS[method]()
+    normalizer.fit(target, scale=scale)
+    return normalizer
+
+
+def normalize_batch(normalizer, stack, out=None):
+    """
+    Normalize an N x H x W x 3 uint8 stack with a fitted normalizer.
+    :param normalizer: a fitted normalizer (see fit_normalizer)
+    :param stack: N x H x W x 3 uint8
+    :param out: optional uint8 array of the same shape to write into
+    :return: the normalized stack (out when given)
+    """
+    return normalizer.transform_batch(stack, out=out)
@@ -0,0 +1,190 @@
+"""
+Contrast Limited Adaptive Histogram Equalization on integer data, tile-parallel.
+
+Same algorithm and results as skimage.exposure.equalize_adapthist (Zuiderveld,
+'Contrast Limited Adaptive Histogram Equalization', Graphics Gems IV, 1994, as
+adapted by scikit-image) for 2D images, but:
+
+- pixels are only ever held as uint8 histogram bins and a uint16 result; the
+  14-bit quantization, the binning and the final rescale are lookup tables, so
+  there is no full-image float64 (or int64) intermediate
+- the contextual region histograms and the interpolation run in threads, one
+  band of contextual regions at a time (NumPy releases the GIL in the heavy
+  operations); each band reads the mappings of the regions above and below it,
+  so the bilinear interpolation across region boundaries is the same as for the
+  whole image
+"""
+
+from __future__ import division
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from skimage import exposure, img_as_uint
+
+from app.utils import threads
+
+# Gray levels of the internal quantization (as in skimage)
+NR_OF_GRAY = 2 ** 14
+
+# Rows per task when converting a float image to uint16
+_CONVERT_ROWS = 256
+
+
+def _workers(workers=None):
+    """
+    Threads to use: the given number, else the compute thread limit, else every core
+    :param workers:
+    :return:
+    """
+    if workers:
+        return workers
+    n = threads.num_threads()
+    return n if n > 0 else threads.available_cores()
+
+
+def _to_uint16(image, pool):
+    """
+    img_as_uint of a 2D image, converting floats in row blocks so only one block
+    of float temporaries exists per thread
+    :param image:
+    :param pool:
+    :return:
+    """
+    if image.dtype.kind != 'f':
+        return img_as_uint(image)
+    out = np.empty(image.shape, dtype=np.uint16)
+
+    def convert(start):
+        out[start:start + _CONVERT_ROWS] = img_as_uint(image[start:start + _CONVERT_ROWS])
+
+    list(pool.map(convert, range(0, image.shape[0], _CONVERT_ROWS)))
+    return out
+
+
+def _bin_lut(image, nbins):
+    """
+    uint16 value -> histogram bin: skimage's rescale to NR_OF_GRAY levels, rounding
+    and binning, evaluated once per possible value instead of once per pixel
+    :param image: uint16 image (for its intensity range)
+    :param nbins:
+    :return: 65536 uint8 lookup table
+    """
+    levels = np.arange(2 ** 16, dtype=np.uint16)
+    in_range = (image.min(), image.max())
+    quantized = np.round(exposure.rescale_intensity(levels, in_range=in_range, out_range=(0, NR_OF_GRAY - 1)))
+    quantized = quantized.astype(np.min_scalar_type(NR_OF_GRAY))
+    return (quantized // (1 + NR_OF_GRAY // nbins)).astype(np.uint8)
+
+
+def clip_histogram(hist, clip_limit):
+    """
+    Clip a histogram at clip_limit and redistribute the excess over the bins
+    (the same redistribution as skimage, so the mappings are identical)
+    :param hist: int histogram, modified in place
+    :param clip_limit: maximum bin count
+    :return:
+    """
+    excess_mask = hist > clip_limit
+    excess = hist[excess_mask]
+    n_excess = excess.sum() - excess.size * clip_limit
+    hist[excess_mask] = clip_limit
+
+    bin_incr = n_excess // hist.size
+    upper = clip_limit - bin_incr
+    low_mask = hist < upper
+    n_excess -= hist[low_mask].size * bin_incr
+    hist[low_mask] += bin_incr
+    mid_mask = np.logical_and(hist >= upper, hist < clip_limit)
+    mid = hist[mid_mask]
+    n_excess += mid.sum() - mid.size * clip_limit
+    hist[mid_mask] = clip_limit
+
+    while n_excess > 0:
+        prev_n_excess = n_excess
+        for index in range(hist.size):
+            under_mask = hist < clip_limit
+            step_size = max(1, np.count_nonzero(under_mask) // n_excess)
+            under_mask = under_mask[index::step_size]
+            hist[index::step_size][under_mask] += 1
+            n_excess -= np.count_nonzero(under_mask)
+            if n_excess <= 0:
+                break
+        if prev_n_excess == n_excess:
+            break
+    return hist
+
+
+def equalize_adapthist(image, kernel_size=None, clip_limit=0.01, nbins=256, workers=None):
+    """
+    CLAHE of a 2D image, equal to skimage.exposure.equalize_adapthist
+    :param image: 2D uint8, uint16 or float (in [0, 1]) image
+    :param kernel_size: shape of the contextual regions, int or (rows, cols) (default: 1/8 of the image)
+    :param clip_limit: normalized clipping limit between 0 and 1 (higher values give more contrast)
+    :param nbins: histogram bins (at most 256)
+    :param workers: threads (default: the compute thread limit, see app.utils.threads)
+    :return: float64 image in [0, 1]
+    """
+    if image.ndim != 2:
+        raise ValueError("Tiled CLAHE expects a 2D (grayscale) image")
+    if not 0 < nbins <= 256:
+        raise ValueError("nbins must be between 1 and 256")
+    if kernel_size is None:
+        kernel_size = tuple(max(s // 8, 1) for s in image.shape)
+    elif np.isscalar(kernel_size):
+        kernel_size = (kernel_size, kernel_size)
+    ky, kx = (int(k) for k in kernel_size)
+
+    with ThreadPoolExecutor(max_workers=_workers(workers)) as pool:
+        image = _to_uint16(image, pool)
+        bins = _bin_lut(image, nbins)[image]
+
+        # Pad by half a region in front and up to a whole number of regions (+ half) behind
+        pad = [(ky // 2, (ky - image.shape[0] % ky) % ky + (ky + 1) // 2),
+               (kx // 2, (kx - image.shape[1] % kx) % kx + (kx + 1) // 2)]
+        bins = np.pad(bins, pad, mode='reflect')
+        rows, cols = bins.shape[0] // ky, bins.shape[1] // kx
+
+        # Gray level mapping of every contextual region, centred half a region in
+        kernel_elements = ky * kx
+        clim = int(np.clip(clip_limit * kernel_elements, 1, None)) if clip_limit > 0 else kernel_elements
+        maps = np.empty((rows + 1, cols + 1, nbins), dtype=np.int64)
+
+        def region_row(r):
+            band = bins[ky // 2 + r * ky:ky // 2 + (r + 1) * ky, kx // 2:kx // 2 + (cols - 1) * kx]
+            tiles = band.reshape((ky, cols - 1, kx)).transpose((1, 0, 2)).reshape((cols - 1, -1))
+            cdf = np.empty((cols - 1, nbins))
+            for c in range(cols - 1):
+                cdf[c] = np.cumsum(clip_histogram(np.bincount(tiles[c], minlength=nbins), clim))
+            cdf *= (NR_OF_GRAY - 1) / kernel_elements
+            np.clip(cdf, None, NR_OF_GRAY - 1, out=cdf)
+            maps[r + 1, 1:cols] = cdf.astype(int)
+
+        list(pool.map(region_row, range(rows - 1)))
+        # Regions beyond the border repeat the outermost mappings
+        maps[0], maps[rows] = maps[1], maps[rows - 1]
+        maps[:, 0], maps[:, cols] = maps[:, 1], maps[:, cols - 1]
+
+        # Bilinear interpolation between the four surrounding mappings, one band of regions per task
+        wy = (np.arange(ky) / ky)[:, None]
+        wx = np.tile(np.arange(kx) / kx, cols)[None, :]
+        region = np.repeat(np.arange(cols), kx)[None, :]
+        result = np.empty(bins.shape, dtype=np.uint16)
+
+        def interpolate_row(r):
+            band = bins[r * ky:(r + 1) * ky].astype(np.intp)
+            acc = np.zeros(band.shape, dtype=np.float32)
+            for ey, ex in ((0, 0), (0, 1), (1, 0), (1, 1)):
+                weight = (wx if ex else 1 - wx) * (wy if ey else 1 - wy)
+                mapped = maps[r + ey].reshape(-1)[(region + ex) * nbins + band]
+                acc += (mapped * weight).astype(np.float32)
+            result[r * ky:(r + 1) * ky] = acc.astype(np.uint16)
+
+        list(pool.map(interpolate_row, range(rows)))
+
+    result = result[pad[0][0]:bins.shape[0] - pad[0][1], pad[1][0]:bins.shape[1] - pad[1][1]]
+    # Stretch the result to [0, 1] through a table of its NR_OF_GRAY levels
+    levels = np.arange(NR_OF_GRAY, dtype=np.float64)
+    lut = exposure.rescale_intensity(levels, in_range=(float(result.min()), float(result.max())),
+                                     out_range=(0., 1.))
+    return lut[result]
@@ -5,6 +5,8 @@ from skimage import exposure, img_as_float
 from skimage.color import rgb2gray
 import os
 from pathlib import Path
+from app.utils import utils as ut
+from app.normalization_methods import clahe
 
 # Set font size for plots
 matplotlib.rcParams['font.size'] = 8
@@ -33,7 +35,7 @@ def plot_img_and_hist(image, axes, bins=256):
 
     return ax_img, ax_hist, ax_cdf
 
-def histogram_equalization(img, save_dir=None, grayscale=True, generate_plot=True):
+def histogram_equalization(img, save_dir=None, grayscale=True, generate_plot=True, scale=1):
     """Apply histogram equalization techniques to a single image and optionally plot the results.
     
     Args:
@@ -41,6 +43,8 @@ def histogram_equalization(img, save_dir=None, grayscale=True, generate_plot=Tru
         save_dir: Directory to save the resulting images (default: None)
         grayscale: Whether to convert color images to grayscale (default: True)
         generate_plot: Whether to generate and save matplotlib plot (default: True)
+        scale: Estimate the contrast-stretching percentiles and the equalization CDF on a copy
+            downscaled by this factor; both are still applied to the full image (default: 1)
         
     Returns:
         dict: Dictionary containing processed images and paths
@@ -55,15 +59,22 @@ def histogram_equalization(img, save_dir=None, grayscale=True, generate_plot=Tru
     # Convert image to float for processing
     img_processed = img_as_float(img_processed)
     
+    # Global statistics may come from a downscaled copy
+    img_small = ut.downscale(img_processed, scale)
+    
     # Contrast stretching
-    p2, p98 = np.percentile(img_processed, (2, 98))
+    p2, p98 = ut.percentile(img_small, (2, 98))
     img_rescale = exposure.rescale_intensity(img_processed, in_range=(p2, p98))
     
-    # Histogram equalization
-    img_eq = exposure.equalize_hist(img_processed)
+    # Histogram equalization (same as exposure.equalize_hist, with the CDF taken from img_small)
+    cdf, bin_centers = exposure.cumulative_distribution(img_small, 256)
+    img_eq = np.interp(img_processed.flat, bin_centers, cdf).reshape(img_processed.shape)
     
-    # Adaptive histogram equalization
-    img_adapteq = exposure.equalize_adapthist(img_processed, clip_limit=0.03)
+    # Adaptive histogram equalization (tile-parallel on integer data for grayscale images)
+    if img_processed.ndim == 2:
+        img_adapteq = clahe.equalize_adapthist(img_processed, clip_limit=0.03)
+    else:
+        img_adapteq = exposure.equalize_adapthist(img_processed, clip_limit=0.03)
     
     result_paths = {}
     
@@ -7,8 +7,64 @@ the intensity distribution of source images to match a reference image across al
 
 from __future__ import division
 
+import cv2 as cv
 import numpy as np
-from skimage.exposure import match_histograms
+from app.utils import utils as ut
+
+
+def channel_histograms(I):
+    """
+    Per-channel 256-bin histograms of an RGB uint8 image.
+
+    Args:
+        I (numpy.ndarray): RGB uint8 image.
+
+    Returns:
+        numpy.ndarray: 3 x 256 array of pixel counts.
+    """
+    return np.stack([ut.uint8_histogram(I[..., c]) for c in range(I.shape[-1])])
+
+
+def match_cumulative_cdf(source, reference_counts, source_counts=None):
+    """
+    Map a uint8 channel so that its CDF matches the CDF given by reference counts.
+
+    This is the integer branch of skimage's ``_match_cumulative_cdf`` with the
+    reference expressed as a histogram, so merged histograms of many images can
+    be used as the template.
+
+    Args:
+        source (numpy.ndarray): uint8 channel to be mapped.
+        reference_counts (numpy.ndarray): 256-bin histogram of the reference.
+        source_counts (numpy.ndarray, optional): 256-bin histogram to take the source
+            CDF from (e.g. of a downscaled copy) instead of counting ``source``.
+
+    Returns:
+        numpy.ndarray: Mapped channel (float64), same shape as ``source``.
+    """
+    src_lookup = source.reshape(-1)
+    if source_counts is None:
+        source_counts = np.bincount(src_lookup, minlength=256)
+    return cdf_lookup_table(source_counts, reference_counts)[src_lookup].reshape(source.shape)
+
+
+def cdf_lookup_table(source_counts, reference_counts):
+    """
+    256-entry table mapping each source value to the reference value at the same quantile.
+
+    Args:
+        source_counts (numpy.ndarray): 256-bin histogram of the source.
+        reference_counts (numpy.ndarray): 256-bin histogram of the reference.
+
+    Returns:
+        numpy.ndarray: float64 lookup table of length 256.
+    """
+    tmpl_values = np.nonzero(reference_counts)[0]
+    tmpl_counts = reference_counts[tmpl_values]
+    src_quantiles = np.cumsum(source_counts) / source_counts.sum()
+    tmpl_quantiles = np.cumsum(tmpl_counts) / tmpl_counts.sum()
+    return np.interp(src_quantiles, tmpl_quantiles, tmpl_values)
+
 
 class Normalizer(object):
     """
@@ -22,26 +78,51 @@ class Normalizer(object):
         """
         Initialize the normalizer with no reference image set.
         """
-        self.reference = None
+        self.reference_counts = None
 
-    def fit(self, target):
+    def fit(self, target, scale=1):
         """
         Set the reference image for histogram matching.
 
         Args:
             target (numpy.ndarray): Reference image (RGB uint8) to which other images
                                    will be normalized.
+            scale (float): Take the reference histograms from a copy downscaled by this factor.
         """
         if not isinstance(target, np.ndarray) or target.dtype != np.uint8:
             raise ValueError("Target image must be a uint8 numpy array.")
-        self.reference = target
+        self.reference_counts = channel_histograms(ut.downscale(target, scale))
 
-    def transform(self, I):
+    def partial_fit(self, target):
+        """
+        Add a reference image to the target histograms.
+
+        The per-channel counts of every image are summed, so the merged CDF is the
+        CDF of all reference pixels seen so far (e.g. all tiles of a cohort).
+
+        Args:
+            target (numpy.ndarray): Reference image (RGB uint8).
+
+        Returns:
+            Normalizer: self
+        """
+        if not isinstance(target, np.ndarray) or target.dtype != np.uint8:
+            raise ValueError("Target image must be a uint8 numpy array.")
+        counts = channel_histograms(target)
+        if self.reference_counts is None:
+            self.reference_counts = counts
+        else:
+            self.reference_counts = self.reference_counts + counts
+        return self
+
+    def transform(self, I, scale=1):
         """
         Transform the input image to match the histogram of the reference image.
 
         Args:
             I (numpy.ndarray): Input image (RGB uint8) to be normalized.
+            scale (float): Take the source histograms from a copy downscaled by this factor;
+                           the mapping is still applied to every full-resolution pixel.
 
         Returns:
             numpy.ndarray: Normalized image with histogram matched to the reference.
@@ -50,8 +131,36 @@ class Normalizer(object):
             ValueError: If the normalizer has not been fitted yet or if the input
                         image is not a uint8 numpy array.
         """
-        if self.reference is None:
+        if self.reference_counts is None:
             raise ValueError("Normalizer has not been fitted yet. Call fit() first.")
         if not isinstance(I, np.ndarray) or I.dtype != np.uint8:
             raise ValueError("Input image must be a uint8 numpy array.")
-        return match_histograms(I, self.reference, channel_axis=-1)
\ No newline at end of file
+        source_counts = channel_histograms(ut.downscale(I, scale))
+        matched = np.empty(I.shape, dtype=I.dtype)
+        for c in range(I.shape[-1]):
+            matched[..., c] = match_cumulative_cdf(I[..., c], self.reference_counts[c], source_counts[c])
+        return matched
+
+    def transform_batch(self, stack, out=None):
+        """
+        Transform every image of a stack to match the reference histograms.
+
+        Each image is counted once and its per-channel lookup tables are applied in
+        a single cv.LUT pass straight into ``out``.
+
+        Args:
+            stack (numpy.ndarray): N x H x W x 3 uint8 stack (see utils.build_stack).
+            out (numpy.ndarray, optional): uint8 array of the same shape to write into.
+
+        Returns:
+            numpy.ndarray: The normalized stack (``out`` when given).
+        """
+        if self.reference_counts is None:
+            raise ValueError("Normalizer has not been fitted yet. Call fit() first.")
+        out = ut.check_batch(stack, out)
+        c = stack.shape[-1]
+        for n in range(stack.shape[0]):
+            counts = channel_histograms(stack[n])
+            lut = np.stack([cdf_lookup_table(counts[ch], self.reference_counts[ch]) for ch in range(c)], axis=-1)
+            out[n] = cv.LUT(stack[n], lut.astype(np.uint8).reshape((1, 256, c)))
+        return out
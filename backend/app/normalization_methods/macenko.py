@@ -14,26 +14,50 @@ from __future__ import division
 
 import numpy as np
 from app.utils import utils as ut
+from app.utils import kernels
 
 
-def get_stain_matrix(I, beta=0.15, alpha=1):
+def get_stain_matrix(I, beta=0.15, alpha=1, chunk_size=None, sample_size=200000):
     """
     Get stain matrix (2x3)
     :param I:
     :param beta:
     :param alpha:
+    :param chunk_size: optional number of pixels to process at a time; the covariance is then
+        accumulated chunk by chunk and the angle percentiles come from a sample of the pixels
+    :param sample_size: pixels kept for the angle percentiles with chunk_size
     :return:
     """
+    if chunk_size is not None:
+        moments = ut.RunningMoments(3)
+        sample = ut.ReservoirSample(sample_size, seed=0)
+        for _, _, OD in ut.iter_OD_chunks(I, chunk_size):
+            OD = OD[(OD > beta).any(axis=1), :]
+            moments.update(OD)
+            sample.update(OD)
+        return stain_matrix_from_OD(sample.rows, moments.covariance(), alpha=alpha)
     OD = ut.RGB_to_OD(I).reshape((-1, 3))
     OD = (OD[(OD > beta).any(axis=1), :])
-    _, V = np.linalg.eigh(np.cov(OD, rowvar=False))
+    return stain_matrix_from_OD(OD, np.cov(OD, rowvar=False), alpha=alpha)
+
+
+def stain_matrix_from_OD(OD, cov, alpha=1):
+    """
+    Get stain matrix (2x3) from thresholded optical densities and their covariance.
+    The covariance may come from a larger population than OD (e.g. a streaming
+    estimate with OD being a sample of it).
+    :param OD: npix x 3 optical densities above the beta threshold
+    :param cov: 3x3 covariance of the optical densities
+    :param alpha:
+    :return:
+    """
+    _, V = np.linalg.eigh(cov)
     V = V[:, [2, 1]]
     if V[0, 0] < 0: V[:, 0] *= -1
     if V[0, 1] < 0: V[:, 1] *= -1
     That = np.dot(OD, V)
     phi = np.arctan2(That[:, 1], That[:, 0])
-    minPhi = np.percentile(phi, alpha)
-    maxPhi = np.percentile(phi, 100 - alpha)
+    minPhi, maxPhi = ut.percentile(phi, (alpha, 100 - alpha))
     v1 = np.dot(V, np.array([np.cos(minPhi), np.sin(minPhi)]))
     v2 = np.dot(V, np.array([np.cos(maxPhi), np.sin(maxPhi)]))
     if v1[0] > v2[0]:
@@ -50,32 +74,235 @@ class Normalizer(object):
     A stain normalization object
     """
 
-    def __init__(self):
+    def __init__(self, beta=0.15, sample_size=200000, seed=0):
         self.stain_matrix_target = None
         self.target_concentrations = None
+        self.maxC_target = None
+        self.beta = beta
+        self.sample_size = sample_size
+        # Seed of the partial_fit pixel sample, so streaming the same images gives the same target
+        self.seed = seed
+        self._od_moments = None
+        self._od_sample = None
+        # Whether partial_fit has seen images the target was not derived from yet
+        self._stale = False
+        self.background_fraction = 0.0
+        self.concentrations = None
 
-    def fit(self, target):
-        target = ut.standardize_brightness(target)
-        self.stain_matrix_target = get_stain_matrix(target)
+    def fit(self, target, scale=1):
+        """
+        Fit to a target image.
+        :param target:
+        :param scale: estimate the target stains and concentrations on a copy downscaled by this factor
+        :return:
+        """
+        target = ut.standardize_brightness(ut.downscale(target, scale))
+        self.stain_matrix_target = get_stain_matrix(target, beta=self.beta)
         self.target_concentrations = ut.get_concentrations(target, self.stain_matrix_target)
+        self.maxC_target = ut.percentile(self.target_concentrations, 99, axis=0).reshape((1, 2))
+        self._od_moments = None
+        self._od_sample = None
+        self._stale = False
+
+    def partial_fit(self, target):
+        """
+        Update the target with one more reference image (e.g. one tile of a cohort).
+        Keeps a running covariance of the thresholded optical densities and a
+        fixed-size pixel sample for the angle and concentration percentiles, so
+        memory stays constant however many images are streamed through. The target
+        stains are only derived from them by finalize(), which the transforms call.
+        :param target:
+        :return:
+        """
+        if self._od_moments is None:
+            self._od_moments = ut.RunningMoments(3)
+            self._od_sample = ut.ReservoirSample(self.sample_size, seed=self.seed)
+        target = ut.standardize_brightness(target)
+        OD = ut.RGB_to_OD(target).reshape((-1, 3))
+        self._od_moments.update(OD[(OD > self.beta).any(axis=1), :])
+        self._od_sample.update(OD)
+        self._stale = True
+        return self
+
+    def finalize(self):
+        """
+        Derive the target stain matrix and concentration percentiles from the images
+        streamed through partial_fit, if any arrived since the last call.
+        :return:
+        """
+        if self._stale:
+            sample = self._od_sample.rows
+            self.stain_matrix_target = stain_matrix_from_OD(sample[(sample > self.beta).any(axis=1), :],
+                                                            self._od_moments.covariance())
+            self.target_concentrations = ut.OD_concentrations(sample, self.stain_matrix_target)
+            self.maxC_target = ut.percentile(self.target_concentrations, 99, axis=0).reshape((1, 2))
+            self._stale = False
+        return self
+
+    def __getstate__(self):
+        # The per-pixel target concentrations are only needed to fit; leave them
+        # out when pickling a fitted normalizer (e.g. into the shared cache)
+        state = self.__dict__.copy()
+        state['target_concentrations'] = None
+        return state
 
     def target_stains(self):
-        return ut.OD_to_RGB(self.stain_matrix_target)
+        return ut.OD_to_RGB(self.finalize().stain_matrix_target)
 
-    def transform(self, I):
+    def estimate_source(self, I):
+        """
+        Estimate the source stain matrix and 99th percentile concentrations of I.
+        The result can be passed to transform() for other images of the same slide.
+        :param I:
+        :return: dict with 'stain_matrix' (2x3) and 'max_concentrations' (1x2)
+        """
         I = ut.standardize_brightness(I)
-        stain_matrix_source = get_stain_matrix(I)
+        stain_matrix_source = get_stain_matrix(I, beta=self.beta)
         source_concentrations = ut.get_concentrations(I, stain_matrix_source)
-        maxC_source = np.percentile(source_concentrations, 99, axis=0).reshape((1, 2))
-        maxC_target = np.percentile(self.target_concentrations, 99, axis=0).reshape((1, 2))
-        source_concentrations *= (maxC_target / maxC_source)
-        return (255 * np.exp(-1 * np.dot(source_concentrations, self.stain_matrix_target).reshape(I.shape))).astype(
-            np.uint8)
+        return {
+            'stain_matrix': stain_matrix_source,
+            'max_concentrations': ut.percentile(source_concentrations, 99, axis=0).reshape((1, 2))
+        }
+
+    def transform(self, I, source=None, background=None, scale=1, standardized=None, chunk_size=None,
+                  keep_concentrations=False):
+        """
+        Normalize I to the target.
+        :param I:
+        :param source: optional estimate_source() result to reuse instead of estimating from I
+        :param background: None to solve every pixel, or one of ut.BACKGROUND_MODES to solve
+            only the tissue pixels and pass the background through / set it to white
+        :param scale: estimate the source brightness, stains and concentration percentiles on a
+            copy downscaled by this factor; the concentrations are still solved at full resolution
+        :param standardized: optional ut.standardized_OD(I) result shared with other stain methods
+        :param chunk_size: optional number of pixels to process at a time, so the transient
+            memory stays bounded whatever the image size (see transform_chunked)
+        :param keep_concentrations: also keep the solved source concentrations (before scaling
+            to the target) as H x W x 2 float32 maps in self.concentrations
+        :return:
+        """
+        self.finalize()
+        self.concentrations = None
+        small = ut.downscale(I, scale)
+        if source is None and small is not I:
+            source = self.estimate_source(small)
+        if chunk_size is not None and standardized is None:
+            return self.transform_chunked(I, chunk_size, source=source, background=background,
+                                          p=ut.brightness_percentile(small),
+                                          keep_concentrations=keep_concentrations)
+        if standardized is None:
+            standardized = ut.standardized_OD(I, p=ut.brightness_percentile(small))
+        I, OD = standardized
+        mask = None
+        self.background_fraction = 0.0
+        if background is not None:
+            mask = ut.tissue_mask(I)
+            self.background_fraction = 1.0 - np.count_nonzero(mask) / mask.shape[0]
+            if not mask.any():
+                if keep_concentrations:
+                    self.concentrations = ut.concentration_maps(np.zeros((0, 2)), I, mask)
+                return ut.concentrations_to_RGB(np.zeros((0, 2)), self.stain_matrix_target, I, mask, background)
+        if source is None:
+            OD_beta = OD[(OD > self.beta).any(axis=1), :]
+            stain_matrix_source = stain_matrix_from_OD(OD_beta, np.cov(OD_beta, rowvar=False))
+            source_concentrations = ut.OD_concentrations(OD if mask is None else OD[mask], stain_matrix_source)
+            maxC_source = ut.percentile(source_concentrations, 99, axis=0).reshape((1, 2))
+        else:
+            source_concentrations = ut.OD_concentrations(OD if mask is None else OD[mask], source['stain_matrix'])
+            maxC_source = source['max_concentrations']
+        if keep_concentrations:
+            self.concentrations = ut.concentration_maps(source_concentrations, I, mask)
+        source_concentrations *= (self.maxC_target / maxC_source)
+        return ut.concentrations_to_RGB(source_concentrations, self.stain_matrix_target, I, mask, background)
+
+    def transform_chunked(self, I, chunk_size=1 << 16, source=None, background=None, p=None,
+                          keep_concentrations=False):
+        """
+        Normalize I to the target in fixed-size pixel chunks, writing the uint8 result
+        chunk by chunk. Brightness and optical densities come from lookup tables, the
+        covariance is accumulated across chunks and the angle and concentration
+        percentiles come from fixed-size pixel samples (as in partial_fit), so only
+        one chunk of float arrays plus the samples is in memory at a time.
+        :param I:
+        :param chunk_size: pixels per chunk
+        :param source: optional estimate_source() result to reuse instead of estimating from I
+        :param background: see transform
+        :param p: optional brightness percentile (default: from I)
+        :param keep_concentrations: see transform
+        :return:
+        """
+        self.finalize()
+        if p is None:
+            p = ut.brightness_percentile(I)
+        tissue_mask = (lambda rgb: ut.tissue_mask(rgb[:, None, :])) if background is not None else None
+        if source is None:
+            moments = ut.RunningMoments(3)
+            stain_sample = ut.ReservoirSample(self.sample_size, seed=0)
+            concentration_sample = ut.ReservoirSample(self.sample_size, seed=1)
+            for _, rgb, OD in ut.iter_OD_chunks(I, chunk_size, p=p):
+                OD_beta = OD[(OD > self.beta).any(axis=1), :]
+                moments.update(OD_beta)
+                stain_sample.update(OD_beta)
+                concentration_sample.update(OD if tissue_mask is None else OD[tissue_mask(rgb)])
+            stain_matrix_source = stain_matrix_from_OD(stain_sample.rows, moments.covariance())
+            maxC_source = None
+            if concentration_sample.rows.shape[0]:
+                maxC_source = ut.percentile(ut.OD_concentrations(concentration_sample.rows, stain_matrix_source),
+                                            99, axis=0).reshape((1, 2))
+        else:
+            stain_matrix_source = source['stain_matrix']
+            maxC_source = source['max_concentrations']
+        out = np.empty(I.shape, dtype=np.uint8)
+        flat_out = out.reshape((-1, 3))
+        maps = np.empty((flat_out.shape[0], 2), dtype=np.float32) if keep_concentrations else None
+        n_background = 0
+        for chunk, rgb, OD in ut.iter_OD_chunks(I, chunk_size, p=p):
+            mask = None
+            if tissue_mask is not None:
+                mask = tissue_mask(rgb)
+                n_background += mask.shape[0] - np.count_nonzero(mask)
+                OD = OD[mask]
+            if OD.shape[0]:
+                C = ut.OD_concentrations(OD, stain_matrix_source)
+            else:
+                C = np.zeros((0, 2))
+            if maps is not None:
+                ut.concentration_maps(C, rgb, mask, out=maps[chunk])
+            if OD.shape[0]:
+                C *= (self.maxC_target / maxC_source)
+            flat_out[chunk] = ut.concentrations_to_RGB(C, self.stain_matrix_target, rgb, mask, background)
+        self.background_fraction = n_background / flat_out.shape[0]
+        if maps is not None:
+            self.concentrations = maps.reshape(I.shape[:2] + (2,))
+        return out
+
+    def transform_batch(self, stack, out=None):
+        """
+        Normalize every image of an N x H x W x 3 uint8 stack to the target.
+        Stain matrices are estimated per image, the concentrations of the whole
+        stack are solved in one batched pass (ut.OD_concentrations_batch).
+        :param stack: N x H x W x 3 uint8 (see ut.build_stack)
+        :param out: optional uint8 array of the same shape to write into
+        :return:
+        """
+        out = ut.check_batch(stack, out)
+        self.finalize()
+        N = stack.shape[0]
+        OD = ut.RGB_to_OD(ut.standardize_brightness_batch(stack)).reshape((N, -1, 3))
+        stain_matrices = np.empty((N, 2, 3))
+        for n in range(N):
+            OD_n = OD[n][(OD[n] > self.beta).any(axis=1), :]
+            stain_matrices[n] = stain_matrix_from_OD(OD_n, np.cov(OD_n, rowvar=False))
+        source_concentrations = ut.OD_concentrations_batch(OD, stain_matrices)
+        maxC_source = ut.percentile(source_concentrations, 99, axis=1)[:, None, :]
+        source_concentrations *= (self.maxC_target[None] / maxC_source)
+        out[...] = kernels.stains_to_uint8(source_concentrations.reshape((-1, 2)), self.stain_matrix_target).reshape(stack.shape)
+        return out
 
     def hematoxylin(self, I):
         I = ut.standardize_brightness(I)
         h, w, c = I.shape
-        stain_matrix_source = get_stain_matrix(I)
+        stain_matrix_source = get_stain_matrix(I, beta=self.beta)
         source_concentrations = ut.get_concentrations(I, stain_matrix_source)
         H = source_concentrations[:, 0].reshape(h, w)
         H = np.exp(-1 * H)
@@ -29,9 +29,9 @@ def lab_split(I):
     return I1, I2, I3
 
 
-def merge_back(I1, I2, I3):
+def lab_merge(I1, I2, I3):
     """
-    Take seperate LAB channels and merge back to give RGB uint8
+    Take seperate LAB channels (as given by lab_split) and merge back to give LAB uint8
     :param I1:
     :param I2:
     :param I3:
@@ -40,8 +40,7 @@ def merge_back(I1, I2, I3):
     I1 *= 2.55
     I2 += 128.0
     I3 += 128.0
-    I = np.clip(cv.merge((I1, I2, I3)), 0, 255).astype(np.uint8)
-    return cv.cvtColor(I, cv.COLOR_LAB2RGB)
+    return np.clip(cv.merge((I1, I2, I3)), 0, 255).astype(np.uint8)
 
 
 def get_mean_std(I):
@@ -69,18 +68,101 @@ class Normalizer(object):
     def __init__(self):
         self.target_means = None
         self.target_stds = None
-
-    def fit(self, target):
-        target = ut.standardize_brightness(target)
+        self._lab_moments = None
+
+    def fit(self, target, scale=1):
+        """
+        Fit to a target image.
+        :param target:
+        :param scale: compute the target LAB statistics on a copy downscaled by this factor
+        :return:
+        """
+        target = ut.standardize_brightness(ut.downscale(target, scale))
         means, stds = get_mean_std(target)
         self.target_means = means
         self.target_stds = stds
-
-    def transform(self, I):
-        I = ut.standardize_brightness(I)
-        I1, I2, I3 = lab_split(I)
-        means, stds = get_mean_std(I)
+        self._lab_moments = None
+
+    def partial_fit(self, target):
+        """
+        Update the target with one more reference image (e.g. one tile of a cohort).
+        Keeps running LAB means and variances, so the result equals fitting on all
+        images seen so far at once without holding them in memory. The target
+        statistics have the same (1, 1) arrays per channel as fit() stores.
+        :param target:
+        :return:
+        """
+        if self._lab_moments is None:
+            self._lab_moments = ut.RunningMoments(3)
+        target = ut.standardize_brightness(target)
+        I1, I2, I3 = lab_split(target)
+        self._lab_moments.update(np.stack((I1.ravel(), I2.ravel(), I3.ravel()), axis=1))
+        means = self._lab_moments.mean
+        stds = np.sqrt(self._lab_moments.variance())
+        self.target_means = tuple(means.reshape((3, 1, 1)))
+        self.target_stds = tuple(stds.reshape((3, 1, 1)))
+        return self
+
+    def transform(self, I, scale=1):
+        """
+        Normalize I to the target.
+        :param I:
+        :param scale: compute the source brightness and LAB statistics on a copy downscaled by
+            this factor; the LAB mapping is still applied at full resolution
+        :return:
+        """
+        small = ut.downscale(I, scale)
+        downscaled = small is not I
+        p = ut.brightness_percentile(small)
+        I = ut.standardize_brightness(I, p=p)
+        small = ut.standardize_brightness(small, p=p) if downscaled else I
+        means, stds = get_mean_std(small)
+        # The affine map of each LAB channel only depends on the uint8 LAB value,
+        # so it is applied as one lookup table pass instead of float channel math
+        lab = cv.LUT(cv.cvtColor(I, cv.COLOR_RGB2LAB), self._lab_lut(means, stds))
+        return cv.cvtColor(lab, cv.COLOR_LAB2RGB)
+
+    def _lab_lut(self, means, stds):
+        """
+        1 x 256 x 3 table of the LAB affine map (the float math of lab_split and lab_merge)
+        :param means: source LAB means (see get_mean_std)
+        :param stds: source LAB standard deviations
+        :return:
+        """
+        values = np.arange(256, dtype=np.float32)
+        I1, I2, I3 = values / 2.55, values - 128.0, values - 128.0
         norm1 = ((I1 - means[0]) * (self.target_stds[0] / stds[0])) + self.target_means[0]
         norm2 = ((I2 - means[1]) * (self.target_stds[1] / stds[1])) + self.target_means[1]
         norm3 = ((I3 - means[2]) * (self.target_stds[2] / stds[2])) + self.target_means[2]
-        return merge_back(norm1, norm2, norm3)
\ No newline at end of file
+        return lab_merge(norm1.reshape((1, 256)), norm2.reshape((1, 256)), norm3.reshape((1, 256)))
+
+    def transform_batch(self, stack, out=None):
+        """
+        Normalize every image of an N x H x W x 3 uint8 stack to the target.
+        The LAB affine map of each image and channel only depends on the uint8
+        LAB value, so per-image statistics come from its LAB histograms and the
+        map is applied as one cv.LUT pass per image.
+        :param stack: N x H x W x 3 uint8 (see ut.build_stack)
+        :param out: optional uint8 array of the same shape to write into
+        :return:
+        """
+        out = ut.check_batch(stack, out)
+        N, h, w, c = stack.shape
+        I = ut.standardize_brightness_batch(stack, out=out)
+        lab = cv.cvtColor(I.reshape((N * h, w, c)), cv.COLOR_RGB2LAB).reshape(stack.shape)
+        counts = np.stack([[ut.uint8_histogram(lab[n, ..., ch]) for ch in range(c)] for n in range(N)])
+        # LAB values as used by lab_split, per channel
+        values = np.arange(256, dtype=np.float64)
+        values = np.stack((values / 2.55, values - 128.0, values - 128.0))
+        means = (counts * values).sum(axis=2) / (h * w)
+        stds = np.sqrt((counts * (values[None] - means[..., None]) ** 2).sum(axis=2) / (h * w))
+        target_means = np.array(self.target_means)[:, 0, 0]
+        target_stds = np.array(self.target_stds)[:, 0, 0]
+        luts = (values[None] - means[..., None]) * (target_stds / stds)[..., None] + target_means[:, None]
+        luts[:, 0] *= 2.55
+        luts[:, 1:] += 128.0
+        luts = np.clip(luts, 0, 255).astype(np.uint8)
+        for n in range(N):
+            lab[n] = cv.LUT(lab[n], luts[n].T.reshape((1, 256, c)))
+        out[...] = cv.cvtColor(lab.reshape((N * h, w, c)), cv.COLOR_LAB2RGB).reshape(stack.shape)
+        return out
@@ -0,0 +1,238 @@
+"""
+Parameter sweeps for tuning a method on one source (and reference) image.
+
+Every grid point shares the expensive preprocessing: the images are decoded,
+brightness standardized and converted to optical density (and LAB lightness for
+the Vahadane tissue mask) once, and only the steps that depend on the swept
+parameters run per point. The stain matrices are learned once per combination
+of the parameters they depend on, so points that only change the concentration
+lamda just re-run the concentration solve. The points are evaluated in parallel:
+
+    sweep = Sweep("macenko", source, target)
+    points = parameter_grid("macenko", {"beta": [0.1, 0.15, 0.2], "alpha": [1, 2]})
+    images = sweep.run(points)
+    sheet = contact_sheet(images, [format_params(p) for p in points])
+"""
+
+from __future__ import division
+
+import itertools
+import math
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cv2 as cv
+import numpy as np
+from skimage import exposure, img_as_float, img_as_ubyte
+from skimage.color import rgb2gray
+
+from app.normalization_methods import macenko
+from app.normalization_methods import vahadane
+from app.utils import utils as ut
+from app.utils import threads
+
+# Parameters that can be swept per method, with the defaults used for the others
+SWEEP_PARAMETERS = {
+    "histogram_equalization": {"clip_limit": 0.03},
+    "macenko": {"beta": 0.15, "alpha": 1, "concentration_lamda": 0.01},
+    "vahadane": {"threshold": 0.8, "lamda": 0.1, "concentration_lamda": 0.01},
+}
+
+# Largest grid (number of points) a sweep accepts
+MAX_SWEEP_POINTS = 64
+
+# Height of the label strip under every contact sheet tile
+LABEL_HEIGHT = 18
+
+
+def parameter_grid(method, grid):
+    """
+    Expand a parameter grid into the list of points to evaluate (cartesian product).
+    Parameters not in the grid keep their defaults (see SWEEP_PARAMETERS).
+    :param method: one of SWEEP_PARAMETERS
+    :param grid: dict of parameter name -> list of values
+    :return: list of dicts with the swept parameters of every point
+    """
+    if method not in SWEEP_PARAMETERS:
+        raise ValueError(f"Method '{method}' cannot be swept. Choose from {', '.join(SWEEP_PARAMETERS)}")
+    if not isinstance(grid, dict) or not grid:
+        raise ValueError("The grid must map at least one parameter to a list of values.")
+    unknown = set(grid) - set(SWEEP_PARAMETERS[method])
+    if unknown:
+        raise ValueError(f"Unknown parameters for {method}: {', '.join(sorted(unknown))}. "
+                         f"Choose from {', '.join(SWEEP_PARAMETERS[method])}")
+    names = [name for name in SWEEP_PARAMETERS[method] if name in grid]
+    values = []
+    for name in names:
+        v = grid[name] if isinstance(grid[name], (list, tuple)) else [grid[name]]
+        if not v or not all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in v):
+            raise ValueError(f"Values of '{name}' must be a non-empty list of numbers.")
+        values.append(v)
+    n_points = int(np.prod([len(v) for v in values]))
+    if n_points > MAX_SWEEP_POINTS:
+        raise ValueError(f"The grid has {n_points} points, at most {MAX_SWEEP_POINTS} are allowed.")
+    return [dict(zip(names, point)) for point in itertools.product(*values)]
+
+
+def format_params(params):
+    """
+    Short label for a grid point, e.g. 'beta=0.1 alpha=2'
+    :param params:
+    :return:
+    """
+    return " ".join(f"{name}={value:g}" for name, value in params.items())
+
+
+class _Prepared(object):
+    """
+    Parameter independent intermediates of one image
+    """
+
+    def __init__(self, I, lightness=False):
+        self.I = ut.standardize_brightness(I)
+        self.OD = ut.RGB_to_OD(self.I.copy()).reshape((-1, 3))
+        self.OD_max = self.OD.max(axis=1)
+        # LAB lightness for the tissue mask (see ut.notwhite_mask)
+        self.L = cv.cvtColor(self.I, cv.COLOR_RGB2LAB)[:, :, 0].reshape((-1,)) / 255.0 if lightness else None
+
+
+class Sweep(object):
+    """
+    Evaluate grid points of one method on a source image (and reference image)
+    """
+
+    def __init__(self, method, source, target=None):
+        """
+        Compute the intermediates shared by every grid point.
+        :param method: one of SWEEP_PARAMETERS
+        :param source: RGB uint8 image
+        :param target: RGB uint8 reference image (not used by histogram_equalization)
+        """
+        if method not in SWEEP_PARAMETERS:
+            raise ValueError(f"Method '{method}' cannot be swept. Choose from {', '.join(SWEEP_PARAMETERS)}")
+        self.method = method
+        # (stain matrix target, stain matrix source) per stain parameters, see _stains()
+        self._stain_matrices = {}
+        self._stain_lock = threading.Lock()
+        if method == "histogram_equalization":
+            self.gray = img_as_float(rgb2gray(source))
+            return
+        if target is None:
+            raise ValueError(f"Method '{method}' requires a reference image")
+        lightness = method == "vahadane"
+        self.source = _Prepared(source, lightness)
+        self.target = _Prepared(target, lightness)
+
+    def evaluate(self, params):
+        """
+        Normalize the source with one grid point.
+        :param params: swept parameters (the others keep their defaults)
+        :return: RGB uint8 image
+        """
+        params = dict(SWEEP_PARAMETERS[self.method], **params)
+        if self.method == "histogram_equalization":
+            img = img_as_ubyte(exposure.equalize_adapthist(self.gray, clip_limit=params["clip_limit"]))
+            return np.stack((img,) * 3, axis=-1)
+        if self.method == "macenko":
+            stain_matrix_target, stain_matrix_source = self._stains(
+                (params["beta"], params["alpha"]),
+                lambda: (self._macenko_stains(self.target, params), self._macenko_stains(self.source, params)))
+            C_target = self._concentrations(self.target, stain_matrix_target, params)
+            C_source = self._concentrations(self.source, stain_matrix_source, params)
+            maxC_target = ut.percentile(C_target, 99, axis=0).reshape((1, 2))
+            maxC_source = ut.percentile(C_source, 99, axis=0).reshape((1, 2))
+            C_source *= (maxC_target / maxC_source)
+        else:
+            stain_matrix_target, stain_matrix_source = self._stains(
+                (params["threshold"], params["lamda"]),
+                lambda: (self._vahadane_stains(self.target, params), self._vahadane_stains(self.source, params)))
+            C_source = self._concentrations(self.source, stain_matrix_source, params)
+        return ut.concentrations_to_RGB(C_source, stain_matrix_target, self.source.I)
+
+    def try_evaluate(self, params):
+        """
+        evaluate() returning the exception a grid point raises instead of raising it
+        :param params:
+        :return: RGB uint8 image or exception
+        """
+        try:
+            return self.evaluate(params)
+        except Exception as e:
+            return e
+
+    def run(self, points, workers=None):
+        """
+        Evaluate the grid points in parallel (the API schedules try_evaluate per point instead).
+        :param points: list of parameter dicts (see parameter_grid)
+        :param workers: threads to use (default: one per available core)
+        :return: list with the RGB uint8 image of every point, or the exception it raised
+        """
+        workers = max(1, min(len(points), workers or threads.available_cores()))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(self.try_evaluate, points))
+
+    def _stains(self, key, estimate):
+        """
+        Stain matrices for the stain parameters key, estimated once per sweep. Points
+        with the same key wait for the estimation in flight instead of repeating it.
+        :param key: values of the parameters the stain matrices depend on
+        :param estimate: function returning (stain matrix target, stain matrix source)
+        :return: (stain matrix target, stain matrix source)
+        """
+        with self._stain_lock:
+            matrices = self._stain_matrices.get(key)
+            leader = matrices is None
+            if leader:
+                matrices = self._stain_matrices[key] = Future()
+        if leader:
+            try:
+                matrices.set_result(estimate())
+            except Exception as e:
+                matrices.set_exception(e)
+        return matrices.result()
+
+    @staticmethod
+    def _concentrations(prepared, stain_matrix, params):
+        # Closed-form solve of the same lasso as ut.get_concentrations; unlike spams it
+        # releases the GIL, so grid points evaluate concurrently
+        return ut.OD_concentrations_batch(prepared.OD[None], stain_matrix[None], params["concentration_lamda"])[0]
+
+    @staticmethod
+    def _macenko_stains(prepared, params):
+        OD = prepared.OD[prepared.OD_max > params["beta"]]
+        if OD.shape[0] < 2:
+            raise ValueError("no pixels above the beta threshold")
+        return macenko.stain_matrix_from_OD(OD, np.cov(OD, rowvar=False), alpha=params["alpha"])
+
+    @staticmethod
+    def _vahadane_stains(prepared, params):
+        # Grid points already run in parallel, one spams thread each
+        return vahadane.stain_matrix_from_OD(prepared.OD[prepared.L < params["threshold"]], lamda=params["lamda"],
+                                             num_threads=1)
+
+
+def contact_sheet(images, labels, columns=None):
+    """
+    Tile equally sized images into one labelled RGB uint8 sheet. Entries that
+    are not images (e.g. the exception of a failed grid point) become grey tiles.
+    :param images: list of H x W x 3 uint8 images (or exceptions)
+    :param labels: one label per image, drawn under its tile
+    :param columns: tiles per row (default: a near square grid)
+    :return: (sheet, columns)
+    """
+    shape = next(img.shape for img in images if isinstance(img, np.ndarray)) if any(
+        isinstance(img, np.ndarray) for img in images) else (64, 64, 3)
+    h, w = shape[:2]
+    columns = columns or math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    sheet = np.full((rows * (h + LABEL_HEIGHT), columns * w, 3), 255, dtype=np.uint8)
+    for i, (img, label) in enumerate(zip(images, labels)):
+        y, x = (i // columns) * (h + LABEL_HEIGHT), (i % columns) * w
+        if isinstance(img, np.ndarray):
+            sheet[y:y + h, x:x + w] = img
+        else:
+            sheet[y:y + h, x:x + w] = 128
+            label = f"{label} (failed)"
+        cv.putText(sheet, label, (x + 2, y + h + LABEL_HEIGHT - 5), cv.FONT_HERSHEY_SIMPLEX,
+                   0.35, (0, 0, 0), 1, cv.LINE_AA)
+    return sheet, columns
@@ -3,40 +3,166 @@ Stain normalization inspired by method of:
 
 A. Vahadane et al., ‘Structure-Preserving Color Normalization and Sparse Stain Separation for Histological Images’, IEEE Transactions on Medical Imaging, vol. 35, no. 8, pp. 1962–1971, Aug. 2016.
 
-Uses the spams package:
+The stain dictionary is learned with the spams package (trainDL):
 
 http://spams-devel.gforge.inria.fr/index.html
 
 Use with python via e.g https://anaconda.org/conda-forge/python-spams
+
+or, without spams, with a NumPy non-negative matrix factorization of the same
+sparse objective (nmf_dictionary). The backend is chosen at import (spams when
+installed) and can be forced with set_dictionary_backend (COLOR_NORM_VAHADANE_BACKEND
+in the API settings).
 """
 
 from __future__ import division
 
-import spams
 import numpy as np
 from app.utils import utils as ut
+from app.utils import kernels
+from app.utils import threads
+
+try:
+    import spams
+except ImportError:  # spams is optional, the NMF dictionary backend is always available
+    spams = None
+
+DICTIONARY_BACKENDS = ("spams", "nmf")
 
+_dictionary_backend = "spams" if spams is not None else "nmf"
 
-def get_stain_matrix(I, threshold=0.8, lamda=0.1):
+
+def set_dictionary_backend(name):
+    """
+    Select the stain dictionary backend
+    :param name: 'spams', 'nmf' or 'auto' (spams when installed)
+    :return: the backend in use
+    """
+    global _dictionary_backend
+    name = (name or "auto").strip().lower()
+    if name not in DICTIONARY_BACKENDS + ("auto",):
+        raise ValueError(f"Unknown stain dictionary backend '{name}'. "
+                         f"Choose from auto, {', '.join(DICTIONARY_BACKENDS)}")
+    if name == "spams" and spams is None:
+        raise ValueError("The spams stain dictionary backend requires spams to be installed")
+    _dictionary_backend = name if name != "auto" else ("spams" if spams is not None else "nmf")
+    return _dictionary_backend
+
+
+def dictionary_backend():
+    """
+    Name of the stain dictionary backend in use ('spams' or 'nmf')
+    :return:
+    """
+    return _dictionary_backend
+
+
+def get_stain_matrix(I, threshold=0.8, lamda=0.1, mask=None, backend=None):
     """
     Get 2x3 stain matrix. First row H and second row E
     :param I:
     :param threshold:
     :param lamda:
+    :param mask: optional precomputed flat tissue mask (overrides threshold)
+    :param backend: 'spams' or 'nmf' (default: dictionary_backend())
     :return:
     """
-    mask = ut.notwhite_mask(I, thresh=threshold).reshape((-1,))
+    if mask is None:
+        mask = ut.tissue_mask(I, thresh=threshold)
     OD = ut.RGB_to_OD(I).reshape((-1, 3))
-    OD = OD[mask]
+    return stain_matrix_from_OD(OD[mask], lamda=lamda, backend=backend)
+
+
+def stain_matrix_from_OD(OD, lamda=0.1, backend=None, num_threads=None):
+    """
+    Get 2x3 stain matrix (first row H and second row E) from the optical densities
+    of the tissue pixels
+    :param OD: ntissue x 3 optical densities
+    :param lamda:
+    :param backend: 'spams' or 'nmf' (default: dictionary_backend())
+    :param num_threads: spams threads (default: threads.num_threads())
+    :return:
+    """
     if OD.size == 0:
         raise ValueError("all pixels have all been masked as being to bright")
-    dictionary = spams.trainDL(OD.T, K=2, lambda1=lamda, mode=2, modeD=0, posAlpha=True, posD=True, verbose=False).T
+    if (backend or _dictionary_backend) == "spams":
+        if spams is None:
+            raise ValueError("The spams stain dictionary backend requires spams to be installed")
+        dictionary = spams.trainDL(OD.T, K=2, lambda1=lamda, mode=2, modeD=0, posAlpha=True, posD=True,
+                                   verbose=False, numThreads=num_threads or threads.num_threads()).T
+    else:
+        dictionary = nmf_dictionary(OD, lamda=lamda)
     if dictionary[0, 0] < dictionary[1, 0]:
         dictionary = dictionary[[1, 0], :]
     dictionary = ut.normalize_rows(dictionary)
     return dictionary
 
 
+def nmf_dictionary(OD, lamda=0.1, sample_size=20000, max_iter=200, tol=1e-5, seed=0):
+    """
+    Learn a 2x3 non-negative stain dictionary D minimizing
+    0.5 * ||OD - C D||^2 + lamda * |C|_1 over C, D >= 0 with rows of D in the unit
+    ball: the objective of spams.trainDL(mode=2, posAlpha, posD, modeD=0).
+    Alternates the exact sparse non-negative concentrations of the current
+    dictionary (the closed form of ut.OD_concentrations_batch) with HALS updates
+    of the dictionary rows, on a fixed random sample of the pixels, starting from
+    the Macenko directions; stops when the objective improves by less than tol
+    (relative).
+    Deterministic for a given seed.
+    :param OD: ntissue x 3 optical densities
+    :param lamda: sparsity of the concentrations
+    :param sample_size: pixels to learn from (all when fewer)
+    :param max_iter:
+    :param tol:
+    :param seed: seed of the pixel sample
+    :return: 2x3 dictionary (rows not ordered)
+    """
+    X = np.asarray(OD, dtype=np.float64)
+    if X.shape[0] > sample_size:
+        X = X[np.sort(np.random.default_rng(seed).choice(X.shape[0], sample_size, replace=False))]
+
+    # Start from the extreme directions of the pixels in the plane of the two leading
+    # singular vectors (where the stain vectors of a two-stain image lie)
+    _, V = np.linalg.eigh(np.dot(X.T, X))
+    V = V[:, [2, 1]] * np.where(V[0, [2, 1]] < 0, -1, 1)
+    phi = np.arctan2(np.dot(X, V[:, 1]), np.dot(X, V[:, 0]))
+    phi = np.percentile(phi, (1, 99))[:, None]
+    D = np.maximum(np.cos(phi) * V[:, 0] + np.sin(phi) * V[:, 1], 0)
+    D = _project_rows(D, X)
+
+    previous = np.inf
+    for _ in range(max_iter):
+        C = ut.OD_concentrations_batch(X[None], D[None], lamda)[0]
+        CtC, CtX = np.dot(C.T, C), np.dot(C.T, X)
+        for k in range(2):
+            if CtC[k, k] > 0:
+                D[k] = np.maximum(D[k] + (CtX[k] - np.dot(CtC[k], D)) / CtC[k, k], 0)
+        D = _project_rows(D, X)
+        residual = X - np.dot(C, D)
+        objective = 0.5 * np.einsum('ij,ij->', residual, residual) + lamda * C.sum()
+        if previous - objective <= tol * objective:
+            break
+        previous = objective
+    return D
+
+
+def _project_rows(D, X):
+    """
+    Project the dictionary rows onto the unit ball; a row that vanished is restarted
+    at the optical density least explained by the other one
+    :param D: 2x3
+    :param X: the optical densities learned from
+    :return:
+    """
+    norms = np.linalg.norm(D, axis=1)
+    for k in range(2):
+        if norms[k] == 0:
+            other = D[1 - k] / max(norms[1 - k], 1e-12)
+            D[k] = X[np.argmax(np.linalg.norm(X - np.outer(np.dot(X, other), other), axis=1))]
+            norms[k] = np.linalg.norm(D[k])
+    return D / np.maximum(norms, 1)[:, None]
+
+
 ###
 
 class Normalizer(object):
@@ -46,20 +172,101 @@ class Normalizer(object):
 
     def __init__(self):
         self.stain_matrix_target = None
+        self.background_fraction = 0.0
+        self.concentrations = None
 
-    def fit(self, target):
-        target = ut.standardize_brightness(target)
+    def fit(self, target, scale=1):
+        """
+        Fit to a target image.
+        :param target:
+        :param scale: estimate the target stains on a copy downscaled by this factor
+        :return:
+        """
+        target = ut.standardize_brightness(ut.downscale(target, scale))
         self.stain_matrix_target = get_stain_matrix(target)
 
     def target_stains(self):
         return ut.OD_to_RGB(self.stain_matrix_target)
 
-    def transform(self, I):
+    def estimate_source(self, I):
+        """
+        Estimate the source stain matrix of I.
+        The result can be passed to transform() for other images of the same slide.
+        :param I:
+        :return: dict with 'stain_matrix' (2x3)
+        """
         I = ut.standardize_brightness(I)
-        stain_matrix_source = get_stain_matrix(I)
-        source_concentrations = ut.get_concentrations(I, stain_matrix_source)
-        return (255 * np.exp(-1 * np.dot(source_concentrations, self.stain_matrix_target).reshape(I.shape))).astype(
-            np.uint8)
+        return {'stain_matrix': get_stain_matrix(I)}
+
+    def transform(self, I, source=None, background=None, scale=1, standardized=None, chunk_size=None,
+                  keep_concentrations=False):
+        """
+        Normalize I to the target.
+        :param I:
+        :param source: optional estimate_source() result to reuse instead of estimating from I
+        :param background: None to solve every pixel, or one of ut.BACKGROUND_MODES to solve
+            only the tissue pixels and pass the background through / set it to white
+        :param scale: estimate the source brightness and stains on a copy downscaled by this
+            factor; the concentrations are still solved at full resolution
+        :param standardized: optional ut.standardized_OD(I) result shared with other stain methods
+        :param chunk_size: optional number of pixels to convert and solve at a time, so only one
+            chunk of optical densities is in memory (see ut.get_concentrations)
+        :param keep_concentrations: also keep the solved source concentrations as H x W x 2
+            float32 maps in self.concentrations (see ut.concentration_maps)
+        :return:
+        """
+        self.concentrations = None
+        small = ut.downscale(I, scale)
+        if source is None and small is not I:
+            source = self.estimate_source(small)
+        if standardized is None:
+            p = ut.brightness_percentile(small)
+            if chunk_size is not None:
+                # Same pixels as standardized_OD leaves in I, the densities follow per chunk
+                standardized = (ut.remove_zeros(ut.standardize_brightness(I, p=p)), None)
+            else:
+                standardized = ut.standardized_OD(I, p=p)
+        I, OD = standardized
+        mask = None
+        self.background_fraction = 0.0
+        if background is not None:
+            mask = ut.tissue_mask(I)
+            self.background_fraction = 1.0 - np.count_nonzero(mask) / mask.shape[0]
+            if not mask.any():
+                if keep_concentrations:
+                    self.concentrations = ut.concentration_maps(np.zeros((0, 2)), I, mask)
+                return ut.concentrations_to_RGB(np.zeros((0, 2)), self.stain_matrix_target, I, mask, background)
+        if source is None:
+            tissue = ut.tissue_mask(I) if mask is None else mask
+            stain_matrix_source = stain_matrix_from_OD(
+                OD[tissue] if OD is not None else ut.RGB_to_OD(I.reshape((-1, 3))[tissue]))
+        else:
+            stain_matrix_source = source['stain_matrix']
+        if OD is None:
+            source_concentrations = ut.get_concentrations(I, stain_matrix_source, mask=mask, chunk_size=chunk_size)
+        else:
+            source_concentrations = ut.OD_concentrations(OD if mask is None else OD[mask], stain_matrix_source)
+        if keep_concentrations:
+            self.concentrations = ut.concentration_maps(source_concentrations, I, mask)
+        return ut.concentrations_to_RGB(source_concentrations, self.stain_matrix_target, I, mask, background)
+
+    def transform_batch(self, stack, out=None):
+        """
+        Normalize every image of an N x H x W x 3 uint8 stack to the target.
+        Stain matrices are learned per image, the concentrations of the whole
+        stack are solved in one batched pass (ut.OD_concentrations_batch).
+        :param stack: N x H x W x 3 uint8 (see ut.build_stack)
+        :param out: optional uint8 array of the same shape to write into
+        :return:
+        """
+        out = ut.check_batch(stack, out)
+        N = stack.shape[0]
+        I = ut.standardize_brightness_batch(stack)
+        stain_matrices = np.stack([get_stain_matrix(I[n]) for n in range(N)])
+        OD = ut.RGB_to_OD(I).reshape((N, -1, 3))
+        source_concentrations = ut.OD_concentrations_batch(OD, stain_matrices)
+        out[...] = kernels.stains_to_uint8(source_concentrations.reshape((-1, 2)), self.stain_matrix_target).reshape(stack.shape)
+        return out
 
     def hematoxylin(self, I):
         I = ut.standardize_brightness(I)
@@ -6,6 +6,8 @@ from typing import Optional
 import threading
 import time
 
+from app.services.shared_cache_service import shared_cache
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -50,6 +52,9 @@ class CleanupService:
             # Clean up results directory
             count += remove_dir_contents(self.result_dir)
             
+            # Drop shared cache entries (cached results point into the results directory)
+            count += shared_cache.clear()
+            
             logger.info(f"Cleanup completed: {count} files/directories removed")
             return {
                 "success": True,
@@ -0,0 +1,87 @@
+import asyncio
+import inspect
+import logging
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Optional, Union
+
+from app.services.shared_cache_service import shared_cache
+
+logger = logging.getLogger(__name__)
+
+# Job states reported by /jobs
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_ERROR = "error"
+
+
+class JobService:
+    """Background jobs for results that are delivered after a first response (e.g. a preview)
+
+    Job state is written to the shared cache as well as kept locally, so a client
+    polling through a different worker process still sees it. Both copies are
+    dropped retention seconds after the job was created.
+    """
+
+    def __init__(self, retention: float = 60 * 60):
+        self.retention = retention  # seconds finished jobs are kept
+        self._jobs = {}
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def create(self) -> str:
+        """Register a new pending job and return its id"""
+        self._prune()
+        job_id = uuid.uuid4().hex
+        self._save(job_id, {"job_id": job_id, "status": JOB_PENDING, "created": time.time()})
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """Current state of a job (status, and result or error once finished), or None"""
+        with self._lock:
+            state = self._jobs.get(job_id)
+        if state is None:
+            state = shared_cache.get(self._key(job_id))
+        return state
+
+    def start(self, job_id: str, work: Callable[[], Union[dict, Awaitable[dict]]]):
+        """Run work() (in a thread, or awaited if it is a coroutine function) and record its result on the job"""
+        task = asyncio.get_running_loop().create_task(self._run(job_id, work))
+        # Keep a reference so the task is not garbage collected while it runs
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job_id: str, work: Callable[[], Union[dict, Awaitable[dict]]]):
+        state = self.get(job_id)
+        self._save(job_id, dict(state, status=JOB_RUNNING, started=time.time()))
+        try:
+            if inspect.iscoroutinefunction(work):
+                result = await work()
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(None, work)
+            self._save(job_id, dict(state, status=JOB_DONE, finished=time.time(), result=result))
+        except Exception as e:
+            logger.exception(f"Job {job_id} failed")
+            self._save(job_id, dict(state, status=JOB_ERROR, finished=time.time(), error=str(e)))
+
+    def _save(self, job_id: str, state: dict):
+        with self._lock:
+            self._jobs[job_id] = state
+        shared_cache.put(self._key(job_id), "job", state)
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        with self._lock:
+            for job_id in [job_id for job_id, state in self._jobs.items() if state.get("finished", cutoff) < cutoff]:
+                del self._jobs[job_id]
+        shared_cache.expire("job", self.retention)
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"job-{job_id}"
+
+
+# Global job service instance
+job_service = JobService()
@@ -0,0 +1,148 @@
+import logging
+import math
+import threading
+from typing import Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Predicted peak memory of one request in bytes per source pixel (the transform's
+# float64 intermediates or the chart data, plus the decoded images), measured with
+# tracemalloc: (default path, low-memory path or None if the method has none)
+MEMORY_PER_PIXEL = {
+    "histogram_equalization": (50, None),
+    "histogram_matching": (25, 20),
+    "reinhard": (40, 20),
+    "macenko": (110, 20),
+    "vahadane": (100, 35),
+}
+
+# Methods that transform images above COLOR_NORM_CHUNKED_MIN_PIXELS in chunks on their
+# default path, with its bytes per source pixel (about those of the low-memory path)
+CHUNKED_MEMORY_PER_PIXEL = {
+    "macenko": 20,
+}
+
+# Bytes per pixel of a decoded image (the BGR read and its RGB conversion)
+DECODE_MEMORY_PER_PIXEL = 6
+
+# Low-memory paths estimate source statistics on a copy of at most this many pixels
+LOW_MEMORY_ESTIMATION_PIXELS = 1 << 20
+
+
+class MemoryBudgetError(Exception):
+    """A request's predicted memory footprint exceeds the budget even on the low-memory path"""
+
+
+class MemoryBudgetService:
+    """Per-request memory budget
+
+    Large uploads to Macenko or Vahadane hold several float64 copies of the image
+    (optical densities, concentrations, the reconstruction). The footprint of a
+    request is predicted from its method and pixel count before it starts; requests
+    above the budget switch to the low-memory path (statistics from a downscaled
+    copy, chunked optical densities) or are rejected when that does not fit either.
+    """
+
+    def __init__(self, budget_mb: Optional[int] = None):
+        self.budget_mb = budget_mb
+        self._lock = threading.Lock()
+        self.planned = 0
+        self.low_memory = 0
+        self.rejected = 0
+
+    @staticmethod
+    def runs_chunked(method: str, pixels: int) -> bool:
+        """Whether the default path of method transforms an image of pixels pixels in chunks"""
+        return (method in CHUNKED_MEMORY_PER_PIXEL and bool(settings.chunk_pixels)
+                and bool(settings.chunked_min_pixels) and pixels > settings.chunked_min_pixels)
+
+    @staticmethod
+    def estimate_mb(method: str, pixels: int, low_memory: bool = False) -> Optional[float]:
+        """Predicted peak MB of a request, or None if the method has no such path"""
+        if not low_memory and MemoryBudgetService.runs_chunked(method, pixels):
+            per_pixel = CHUNKED_MEMORY_PER_PIXEL[method]
+        else:
+            per_pixel = MEMORY_PER_PIXEL.get(method, MEMORY_PER_PIXEL["macenko"])[1 if low_memory else 0]
+        return per_pixel * pixels / 2 ** 20 if per_pixel is not None else None
+
+    @staticmethod
+    def low_memory_scale(pixels: int, scale: float = 1) -> float:
+        """Downscale factor for estimating statistics on at most LOW_MEMORY_ESTIMATION_PIXELS pixels"""
+        return max(scale, math.sqrt(pixels / LOW_MEMORY_ESTIMATION_PIXELS))
+
+    def plan(self, method: str, pixels: int) -> dict:
+        """Choose the path of a request: {'low_memory': bool, 'estimate_mb': float}
+
+        Raises MemoryBudgetError if neither path fits the budget.
+        """
+        estimate = self.estimate_mb(method, pixels)
+        with self._lock:
+            self.planned += 1
+        if self.budget_mb is None or estimate <= self.budget_mb:
+            return {"low_memory": False, "estimate_mb": estimate}
+        low_estimate = self.estimate_mb(method, pixels, low_memory=True)
+        if low_estimate is not None and low_estimate <= self.budget_mb:
+            with self._lock:
+                self.low_memory += 1
+            logger.info(f"{method} on {pixels / 1e6:.1f} MP: predicted {estimate:.0f} MB exceeds the "
+                        f"{self.budget_mb} MB budget, using the low-memory path ({low_estimate:.0f} MB)")
+            return {"low_memory": True, "estimate_mb": low_estimate}
+        with self._lock:
+            self.rejected += 1
+        raise MemoryBudgetError(
+            f"A {method} request on a {pixels / 1e6:.1f} MP image needs about "
+            f"{low_estimate if low_estimate is not None else estimate:.0f} MB, more than the "
+            f"{self.budget_mb} MB memory budget")
+
+    def plan_concurrent(self, methods, pixels: int, extra_mb: float = 0) -> dict:
+        """Choose the path of every method of a request that runs them concurrently on one image
+
+        Methods switch to their low-memory path, most expensive first, until the total
+        (plus extra_mb, e.g. shared decoded images) fits the budget.
+        Returns {method: plan}; raises MemoryBudgetError if even the smallest paths do not fit.
+        """
+        plans = {method: {"low_memory": False, "estimate_mb": self.estimate_mb(method, pixels)}
+                 for method in methods}
+        with self._lock:
+            self.planned += 1
+        if self.budget_mb is None:
+            return plans
+        for method in sorted(plans, key=lambda m: plans[m]["estimate_mb"], reverse=True):
+            if extra_mb + sum(plan["estimate_mb"] for plan in plans.values()) <= self.budget_mb:
+                break
+            low_estimate = self.estimate_mb(method, pixels, low_memory=True)
+            if low_estimate is not None and low_estimate < plans[method]["estimate_mb"]:
+                plans[method] = {"low_memory": True, "estimate_mb": low_estimate}
+        total = extra_mb + sum(plan["estimate_mb"] for plan in plans.values())
+        if total > self.budget_mb:
+            with self._lock:
+                self.rejected += 1
+            raise MemoryBudgetError(
+                f"Running {', '.join(plans)} on a {pixels / 1e6:.1f} MP image needs about {total:.0f} MB, "
+                f"more than the {self.budget_mb} MB memory budget")
+        if any(plan["low_memory"] for plan in plans.values()):
+            with self._lock:
+                self.low_memory += 1
+        return plans
+
+    def check(self, label: str, estimate_mb: float):
+        """Raise MemoryBudgetError if a request without a low-memory path (label) does not fit the budget"""
+        with self._lock:
+            self.planned += 1
+        if self.budget_mb is None or estimate_mb <= self.budget_mb:
+            return
+        with self._lock:
+            self.rejected += 1
+        raise MemoryBudgetError(
+            f"{label} needs about {estimate_mb:.0f} MB, more than the {self.budget_mb} MB memory budget")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"budget_mb": self.budget_mb, "planned": self.planned, "low_memory": self.low_memory,
+                    "rejected": self.rejected}
+
+
+# Global memory budget instance
+memory_budget = MemoryBudgetService(settings.memory_budget_mb)
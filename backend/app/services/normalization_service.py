@@ -1,11 +1,16 @@
+import asyncio
+import json
 import os
 import cv2
 import numpy as np
 from pathlib import Path
 import sys
+import uuid
 import importlib.util
 import base64
+import functools
 from skimage import exposure
+from PIL import Image
 
 # Add the src directory to Python path for importing modules
 src_path = Path("src").absolute()
@@ -18,53 +23,316 @@ from app.normalization_methods.histogram_matching import Normalizer as Histogram
 from app.normalization_methods.reinhard import Normalizer as ReinhardNormalizer
 from app.normalization_methods.macenko import Normalizer as MacenkoNormalizer
 from app.normalization_methods.vahadane import Normalizer as VahadaneNormalizer
+from app.normalization_methods import vahadane
+from app.normalization_methods.sweep import Sweep, contact_sheet, format_params
+from app.services.stain_cache_service import stain_cache
+from app.services.shared_cache_service import shared_cache
+from app.services.single_flight_service import single_flight
+from app.services.scheduler_service import scheduler
+from app.services.memory_budget_service import memory_budget, MEMORY_PER_PIXEL, DECODE_MEMORY_PER_PIXEL
+from app.utils import utils as ut
+from app.utils import profiling
+from app.utils import content_urls
+from app.utils.memory import StageRecorder
+from app.config import settings
+
+# Stain separation methods: their source stain estimate can be shared by the tiles
+# of one slide and their concentration solve can be restricted to tissue pixels
+STAIN_METHODS = ("macenko", "vahadane")
+
+# Encodings for results returned directly in the response body: (extension, media type)
+IMAGE_FORMATS = {
+    "png": (".png", "image/png"),
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp")
+}
+
+# Display names of the histogram equalization result images, by their key
+HISTOGRAM_EQUALIZATION_IMAGES = {
+    'original': 'Original Grayscale',
+    'rescale': 'Contrast Stretching',
+    'equalize': 'Histogram Equalization',
+    'adaptive_equalize': 'Adaptive Equalization'  # Match the key from histogram_equalization function
+}
+
+# Methods run by compare(), in the order of the /methods ids
+COMPARE_METHODS = ("histogram_equalization", "histogram_matching", "reinhard", "macenko", "vahadane")
+
+# Pixels per chunk of the low-memory path when COLOR_NORM_CHUNK_PIXELS disables chunking
+DEFAULT_CHUNK_PIXELS = 1 << 16
+
+# Stain separation outputs of Macenko/Vahadane: grayscale images or float16 arrays
+STAIN_MAP_FORMATS = ("image", "float16")
+
+# Chart data of /process results: computed with the result, or on first request of the
+# chart endpoint from the spec file written into the result directory
+CHART_MODES = ("deferred", "inline")
+CHART_SPEC_FILE = "chart_spec.json"
+CHART_DATA_FILE = "chart_data.json"
+
+# Bytes per source pixel of the standardized image and optical densities compare() shares
+# between the stain methods (see ut.standardized_OD)
+SHARED_OD_MEMORY_PER_PIXEL = 27
+
+# Result fields describing the run that computed it, not stored with cached results
+PER_RUN_FIELDS = ("stages", "chart_id", "cached")
+
+# Scatter plot data: 'sample' plots randomly sampled pixels, 'density' bins all pixels
+# on an R-G grid and plots one point per occupied bin
+SCATTER_MODES = ("sample", "density")
 
 
 class NormalizationService:
     """Service to handle different image normalization methods"""
     
     @staticmethod
-    async def normalize_image(source_path, method, reference_path=None):
+    async def normalize_image(source_path, method, reference_path=None, group_id=None, group_thumbnail=None,
+                              background=None, source_scale=1, reference_scale=1, scatter_mode="sample",
+                              profile=False, stain_maps=None, charts="inline"):
         """
-        Normalize an image using the specified method and generate histogram matching plots
+        Normalize an image using the specified method, on the scheduler pool for its estimated cost.
+        Identical requests in flight wait for one computation without taking a pool thread.
+        With profile=True the computation runs under cProfile (see _normalize_profiled).
         
         Args:
             source_path (Path): Path to the source image file
             method (str): Normalization method to use
             reference_path (Path, optional): Path to the reference image if required
+            group_id (str, optional): Slide/group id; Macenko and Vahadane estimate the source
+                stains once per group and reuse them for later tiles of the same group
+            group_thumbnail (ndarray, optional): RGB image (e.g. a slide thumbnail) to estimate
+                the group's source stains from instead of the first tile
+            background (str, optional): 'passthrough' or 'white' to solve Macenko/Vahadane
+                concentrations on tissue pixels only and pass through / whiten the background
+            source_scale (float): Estimate source statistics (stain vectors, LAB moments, histograms)
+                on a copy downscaled by this factor; the mapping is applied at full resolution
+            reference_scale (float): Fit the reference on a copy downscaled by this factor
+            scatter_mode (str): 'sample' or 'density' scatter plot data (see SCATTER_MODES)
+            stain_maps (str, optional): Macenko/Vahadane: also save the hematoxylin and eosin
+                concentration maps of the transform, as 'image' or 'float16' (see STAIN_MAP_FORMATS)
+            profile (bool): Profile the computation (the result is not cached)
+            charts (str): 'inline' to compute the chart data with the result, 'deferred' to leave
+                it to the first chart_data_file() request for result['chart_id'] (see CHART_MODES)
             
         Returns:
             dict: Dictionary containing paths to the processed image, histogram matching plot, and chart data
         """
-        # Read source image
-        source_img = cv2.imread(str(source_path))
-        if source_img is None:
-            raise ValueError(f"Could not read source image: {source_path}")
-        source_img = cv2.cvtColor(source_img, cv2.COLOR_BGR2RGB)
+        if profile:
+            return await scheduler.run(
+                lambda: NormalizationService._normalize_profiled(
+                    source_path, method, reference_path, group_id, group_thumbnail, background,
+                    source_scale, reference_scale, scatter_mode, stain_maps, charts),
+                scheduler.estimate_cost(method, NormalizationService.image_pixels(source_path)))
+        key, compute = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: NormalizationService._prepare_request(
+                source_path, method, reference_path, group_id, group_thumbnail, background,
+                source_scale, reference_scale, scatter_mode, stain_maps, charts))
+        cost = scheduler.estimate_cost(method, NormalizationService.image_pixels(source_path))
+        return await single_flight.do_async(key, lambda: scheduler.run(compute, cost))
+
+    @staticmethod
+    def _prepare_request(source_path, method, reference_path, group_id, group_thumbnail, background,
+                         source_scale, reference_scale, scatter_mode, stain_maps=None, charts="inline"):
+        """
+        Content key of a normalize_image request and the function computing its result.
+        Raises MemoryBudgetError before any work if the request does not fit the memory budget.
+        """
+        plan = memory_budget.plan(method, NormalizationService.image_pixels(source_path))
+        
+        # Content digests identify the request across all worker processes
+        source_digest = shared_cache.file_digest(source_path)
+        content_urls.remember(source_path, source_digest)
+        reference_digest = None
+        if reference_path and method != "histogram_equalization":
+            reference_digest = shared_cache.file_digest(reference_path)
+            content_urls.remember(reference_path, reference_digest)
         
         # Create results directory if it doesn't exist
         results_dir = Path("static/images/results")
         results_dir.mkdir(parents=True, exist_ok=True)
         
-        # Create method-specific directory
-        method_dir = results_dir / f"{method}_{os.path.basename(source_path).split('.')[0]}"
+        result_key = shared_cache.make_key(
+            "result", method, source_digest, reference_digest, background, source_scale, reference_scale,
+            scatter_mode, plan['low_memory'], stain_maps, charts, NormalizationService._stain_backend(method))
+        
+        # Results that depend on per-slide group state are not shared
+        if group_id:
+            def compute():
+                method_dir = results_dir / f"{method}_{os.path.basename(source_path).split('.')[0]}"
+                result = NormalizationService._normalize_files(
+                    source_path, method, reference_path, method_dir, reference_digest,
+                    group_id, group_thumbnail, background, source_scale, reference_scale, scatter_mode,
+                    plan, stain_maps, charts)
+                result['cached'] = False
+                NormalizationService._hash_result_files(result)
+                return result
+            
+            # The thumbnail's bytes are hashed as their own key part, not through repr
+            if group_thumbnail is None:
+                return shared_cache.make_key(result_key, group_id, None), compute
+            return shared_cache.make_key(result_key, group_id, group_thumbnail.shape, group_thumbnail.tobytes()), compute
+        
+        # Finished results are content-addressed, so any worker can reuse them
+        def compute():
+            result = NormalizationService._cached_result(result_key)
+            if result is None:
+                with shared_cache.lock(result_key):
+                    result = NormalizationService._cached_result(result_key)
+                    if result is None:
+                        method_dir = results_dir / f"{method}_{result_key[:16]}"
+                        result = NormalizationService._normalize_files(
+                            source_path, method, reference_path, method_dir, reference_digest,
+                            None, None, background, source_scale, reference_scale, scatter_mode, plan,
+                            stain_maps, charts)
+                        shared_cache.put(result_key, "result",
+                                         {k: v for k, v in result.items() if k not in PER_RUN_FIELDS})
+                        result = dict(result, cached=False)
+            NormalizationService._hash_result_files(result)
+            return result
+        
+        return result_key, compute
+
+    @staticmethod
+    def _normalize_profiled(source_path, method, reference_path, group_id, group_thumbnail, background,
+                            source_scale, reference_scale, scatter_mode, stain_maps=None, charts="inline"):
+        """
+        Compute a normalize_image result under cProfile. The result is never taken from
+        the cache or shared with other requests, so the profile is of this computation;
+        it is stored next to the result images and summarized in result['profile'].
+        """
+        plan = memory_budget.plan(method, NormalizationService.image_pixels(source_path))
+        reference_digest = None
+        if reference_path and method != "histogram_equalization":
+            reference_digest = shared_cache.file_digest(reference_path)
+        method_dir = Path("static/images/results") / f"{method}_profile_{uuid.uuid4().hex[:16]}"
+        method_dir.mkdir(parents=True, exist_ok=True)
+        profile_path = method_dir / f"{method_dir.name}.prof"
+        result, seconds = profiling.profile_call(
+            profile_path, NormalizationService._normalize_files, source_path, method, reference_path, method_dir,
+            reference_digest, group_id, group_thumbnail, background, source_scale, reference_scale, scatter_mode,
+            plan, stain_maps, charts)
+        result = dict(result, cached=False)
+        result['profile'] = {
+            'path': profile_path,
+            'seconds': seconds,
+            'hot_functions': profiling.hot_functions(profile_path, settings.profile_top)
+        }
+        NormalizationService._hash_result_files(result)
+        return result
+
+    @staticmethod
+    def _hash_result_files(result):
+        """
+        Hash the files of a result for their content-addressed urls here on the compute
+        thread, so building the response does not hash them on the event loop
+        """
+        paths = [result['result_image']] if 'result_image' in result else [
+            img['path'] for img in result.get('result_images', [])]
+        paths += [img['path'] for img in result.get('stain_maps') or []]
+        if result.get('profile'):
+            paths.append(result['profile']['path'])
+        for path in paths:
+            content_urls.content_digest(path)
+
+    @staticmethod
+    def image_pixels(path):
+        """Pixel count of an image file from its header (0 if it cannot be read)"""
+        try:
+            with Image.open(path) as img:
+                return img.width * img.height
+        except Image.DecompressionBombError:
+            # Pillow refuses to open images this large, its limit is a lower bound
+            return 2 * Image.MAX_IMAGE_PIXELS
+        except (OSError, ValueError):
+            return 0
+
+    @staticmethod
+    def _cached_result(result_key):
+        """
+        Return a cached result whose files still exist (they may have been cleaned up), or None.
+        It has no stage timings (nothing ran for this request); its chart id is the
+        directory of its result images.
+        """
+        result = shared_cache.get(result_key)
+        if result is None:
+            return None
+        paths = [result['result_image']] if 'result_image' in result else [
+            img['path'] for img in result.get('result_images', [])]
+        if not all(Path(path).exists() for path in paths):
+            shared_cache.delete(result_key)
+            return None
+        return dict(result, cached=True, stages=None, chart_id=Path(paths[0]).parent.name if paths else None)
+
+    @staticmethod
+    def _fit_normalizer(method, reference_img, reference_digest, reference_scale):
+        """Fit the normalizer for a reference, reusing a fit cached by any worker"""
+        def fit():
+            normalizer = NormalizationService.create_normalizer(method)
+            normalizer.fit(reference_img, scale=reference_scale)
+            return normalizer
+        
+        if reference_digest is None:
+            return fit()
+        fit_key = shared_cache.make_key("reference", method, reference_digest, reference_scale,
+                                        NormalizationService._stain_backend(method))
+        return shared_cache.get_or_compute(fit_key, "reference", fit)
+
+    @staticmethod
+    def _stain_backend(method):
+        """Stain dictionary backend a method's results depend on (part of their cache keys)"""
+        return vahadane.dictionary_backend() if method == "vahadane" else None
+
+    @staticmethod
+    def create_normalizer(method):
+        """Create an unfitted normalizer for a reference-based method"""
+        if method == "histogram_matching":
+            return HistogramMatchingNormalizer()
+        elif method == "reinhard":
+            return ReinhardNormalizer()
+        elif method == "macenko":
+            return MacenkoNormalizer()
+        elif method == "vahadane":
+            return VahadaneNormalizer()
+        raise ValueError(f"Unknown method: {method}")
+
+    @staticmethod
+    def _normalize_files(source_path, method, reference_path, method_dir, reference_digest=None,
+                         group_id=None, group_thumbnail=None, background=None, source_scale=1,
+                         reference_scale=1, scatter_mode="sample", plan=None, stain_maps=None,
+                         charts="inline"):
+        """
+        Run the normalization, writing the result images into method_dir (see normalize_image).
+        plan is the memory_budget.plan() of the request; the result reports it along with
+        the time (and peak memory, when tracking) of every stage.
+        """
+        plan = plan or {'low_memory': False, 'estimate_mb': None}
+        stages = StageRecorder()
+        
+        # Read source image
+        with stages.stage("decode"):
+            source_img = cv2.imread(str(source_path))
+            if source_img is None:
+                raise ValueError(f"Could not read source image: {source_path}")
+            source_img = cv2.cvtColor(source_img, cv2.COLOR_BGR2RGB)
+        
         method_dir.mkdir(parents=True, exist_ok=True)
+        memory_info = {
+            'chart_id': method_dir.name,
+            'stages': stages.stages,
+            'low_memory': plan['low_memory'],
+            'memory_estimate_mb': plan['estimate_mb']
+        }
 
         try:
             # ============= HISTOGRAM EQUALIZATION (SEPARATE WORKFLOW) =============
             if method == "histogram_equalization":
                 # Call histogram equalization function (without plot generation)
-                result = histogram_equalization(source_img, save_dir=method_dir, generate_plot=False)
+                with stages.stage("transform"):
+                    result = histogram_equalization(source_img, save_dir=method_dir, generate_plot=False,
+                                                    scale=source_scale)
                   # Return all 4 processed images for histogram equalization
                 result_images = []
-                image_names = {
-                    'original': 'Original Grayscale',
-                    'rescale': 'Contrast Stretching', 
-                    'equalize': 'Histogram Equalization',
-                    'adaptive_equalize': 'Adaptive Equalization'  # Match the key from histogram_equalization function
-                }
-                
-                for img_key, display_name in image_names.items():
+                for img_key, display_name in HISTOGRAM_EQUALIZATION_IMAGES.items():
                     if img_key in result['paths']:
                         result_images.append({
                             'name': display_name,
@@ -73,12 +341,17 @@ class NormalizationService:
                         })
                 
                 # Extract chart data for histogram equalization (4 images)
-                chart_data = NormalizationService.extract_histogram_equalization_data(result['images'])
+                chart_data = None
+                NormalizationService._write_chart_spec(method_dir, {
+                    'method': method, 'source_path': str(source_path), 'source_scale': source_scale})
+                if charts == "inline":
+                    with stages.stage("charts"):
+                        chart_data = NormalizationService.extract_histogram_equalization_data(result['images'])
                 
-                return {
+                return dict({
                     'result_images': result_images,  # Multiple images for histogram equalization
                     'chart_data': chart_data
-                }
+                }, **memory_info)
             
             # ============= OTHER METHODS (RGB WORKFLOW) =============
             else:
@@ -87,44 +360,42 @@ class NormalizationService:
                     raise ValueError(f"Method '{method}' requires a reference image")
                 
                 # Read reference image
-                reference_img = cv2.imread(str(reference_path))
-                if reference_img is None:
-                    raise ValueError(f"Could not read reference image: {reference_path}")
-                reference_img = cv2.cvtColor(reference_img, cv2.COLOR_BGR2RGB)
+                with stages.stage("decode_reference"):
+                    reference_img = cv2.imread(str(reference_path))
+                    if reference_img is None:
+                        raise ValueError(f"Could not read reference image: {reference_path}")
+                    reference_img = cv2.cvtColor(reference_img, cv2.COLOR_BGR2RGB)
                 
                 # Apply normalization based on method
-                if method == "histogram_matching":
-                    normalizer = HistogramMatchingNormalizer()
-                elif method == "reinhard":
-                    normalizer = ReinhardNormalizer()
-                elif method == "macenko":
-                    normalizer = MacenkoNormalizer()
-                elif method == "vahadane":
-                    normalizer = VahadaneNormalizer()
-                else:
-                    raise ValueError(f"Unknown method: {method}")
-                
-                normalizer.fit(reference_img)
-                result_img = normalizer.transform(source_img)
-
-                # Convert result_img to uint8 before saving
-                if result_img.dtype != np.uint8:
-                    if result_img.max() <= 1.0:
-                        result_img = (result_img * 255).astype(np.uint8)
-                    else:
-                        result_img = result_img.astype(np.uint8)
+                maps = {} if stain_maps and method in STAIN_METHODS else None
+                result_img, background_fraction = NormalizationService.normalize_rgb(
+                    source_img, method, reference_img, reference_digest, group_id, group_thumbnail,
+                    background, source_scale, reference_scale, low_memory=plan['low_memory'], stages=stages,
+                    maps=maps)
 
                 # Save the normalized result image
                 result_path = method_dir / f"{method}_result.png"
-                cv2.imwrite(str(result_path), cv2.cvtColor(result_img, cv2.COLOR_RGB2BGR))
+                with stages.stage("save"):
+                    cv2.imwrite(str(result_path), cv2.cvtColor(result_img, cv2.COLOR_RGB2BGR))
+                    if maps is not None:
+                        memory_info['stain_maps'] = NormalizationService.save_stain_maps(
+                            maps['concentrations'], method_dir, method, stain_maps)
 
                 # Extract chart data for RGB methods (3 images)
-                chart_data = NormalizationService.extract_rgb_chart_data(source_img, reference_img, result_img)
+                chart_data = None
+                NormalizationService._write_chart_spec(method_dir, {
+                    'method': method, 'source_path': str(source_path), 'reference_path': str(reference_path),
+                    'result_path': str(result_path), 'scatter_mode': scatter_mode})
+                if charts == "inline":
+                    with stages.stage("charts"):
+                        chart_data = NormalizationService.extract_rgb_chart_data(
+                            source_img, reference_img, result_img, scatter_mode)
 
-                return {
+                return dict({
                     'result_image': result_path,
-                    'chart_data': chart_data
-                }
+                    'chart_data': chart_data,
+                    'background_fraction': background_fraction
+                }, **memory_info)
 
         except Exception as e:
             # Clean up the directory if there's an error
@@ -133,6 +404,418 @@ class NormalizationService:
                 shutil.rmtree(method_dir)
             raise e
 
+    @staticmethod
+    def _write_chart_spec(method_dir, spec):
+        """Record what the chart data of a result is computed from (see chart_data_file)"""
+        with open(method_dir / CHART_SPEC_FILE, "w") as f:
+            json.dump(spec, f)
+        # A rewritten result directory (e.g. a group tile processed again) must not keep old charts
+        (method_dir / CHART_DATA_FILE).unlink(missing_ok=True)
+
+    @staticmethod
+    async def chart_data_file(chart_dir):
+        """
+        Path of the chart data JSON of a result directory, computed on the scheduler on first
+        access and kept next to the result; concurrent first requests share one computation.
+        Raises FileNotFoundError if the result (or its source images) no longer exists.
+        """
+        chart_dir = Path(chart_dir)
+        data_path = chart_dir / CHART_DATA_FILE
+        if data_path.exists():
+            return data_path
+        with open(chart_dir / CHART_SPEC_FILE) as f:
+            spec = json.load(f)
+        chart_method = spec['method'] if spec['method'] == "histogram_equalization" else "histogram_matching"
+        cost = scheduler.estimate_cost(chart_method, NormalizationService.image_pixels(spec['source_path']))
+        return await single_flight.do_async(
+            f"charts:{chart_dir}",
+            lambda: scheduler.run(lambda: NormalizationService._compute_chart_file(chart_dir, spec), cost))
+
+    @staticmethod
+    def _compute_chart_file(chart_dir, spec):
+        """Compute the chart data described by a chart spec and write it into chart_dir"""
+        data_path = chart_dir / CHART_DATA_FILE
+        if data_path.exists():
+            return data_path
+        source_img = NormalizationService._read_rgb(spec['source_path'])
+        if spec['method'] == "histogram_equalization":
+            # The charts are of the float images, so they are recomputed rather than read back
+            images = histogram_equalization(source_img, generate_plot=False, scale=spec['source_scale'])['images']
+            chart_data = NormalizationService.extract_histogram_equalization_data(images)
+        else:
+            chart_data = NormalizationService.extract_rgb_chart_data(
+                source_img, NormalizationService._read_rgb(spec['reference_path']),
+                NormalizationService._read_rgb(spec['result_path']), spec['scatter_mode'])
+        # Written under a temporary name so readers never see a partial file
+        tmp_path = chart_dir / f"{CHART_DATA_FILE}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(chart_data, f)
+        os.replace(tmp_path, data_path)
+        return data_path
+
+    @staticmethod
+    def _read_rgb(path):
+        """RGB uint8 image of a file (FileNotFoundError if it is gone or unreadable)"""
+        img = cv2.imread(str(path))
+        if img is None:
+            raise FileNotFoundError(f"Could not read image: {path}")
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    @staticmethod
+    def save_stain_maps(concentrations, method_dir, method, stain_format="image"):
+        """
+        Save hematoxylin and eosin concentration maps into method_dir
+        
+        Args:
+            concentrations (ndarray): H x W x 2 source concentrations (see Normalizer.transform)
+            method_dir (Path): Result directory of the request
+            method (str): Method name, prefixes the file names
+            stain_format (str): 'image' for one grayscale PNG per stain (optical transmission
+                exp(-C), dark where the stain is dense) or 'float16' for one H x W x 2 .npy array
+            
+        Returns:
+            list: Entries with 'name', 'path' and 'key' like the histogram equalization images
+        """
+        if stain_format == "float16":
+            path = method_dir / f"{method}_stains.npy"
+            np.save(path, concentrations.astype(np.float16))
+            return [{'name': 'Hematoxylin & Eosin Concentrations', 'path': path, 'key': 'concentrations'}]
+        entries = []
+        for index, (key, name) in enumerate((("hematoxylin", "Hematoxylin"), ("eosin", "Eosin"))):
+            path = method_dir / f"{method}_{key}.png"
+            cv2.imwrite(str(path), np.rint(255 * np.exp(-concentrations[..., index])).astype(np.uint8))
+            entries.append({'name': name, 'path': path, 'key': key})
+        return entries
+
+    @staticmethod
+    def normalize_rgb(source_img, method, reference_img, reference_digest=None, group_id=None,
+                      group_thumbnail=None, background=None, source_scale=1, reference_scale=1,
+                      standardized=None, low_memory=False, stages=None, maps=None):
+        """
+        Normalize an RGB image against a reference image in memory
+        
+        Args:
+            source_img: RGB uint8 source image
+            method (str): Reference-based normalization method
+            reference_img: RGB uint8 reference image
+            reference_digest (str, optional): Content digest of the reference; when given the
+                fitted normalizer is shared through the cache, otherwise nothing touches disk
+            group_id, group_thumbnail, background, source_scale, reference_scale: see normalize_image
+            standardized (tuple, optional): ut.standardized_OD(source_img) shared by the stain methods
+            low_memory (bool): Take source statistics from a downscaled copy and convert the stain
+                methods' optical densities in chunks (see memory_budget.plan)
+            stages (StageRecorder, optional): Records the fit and transform stages
+            maps (dict, optional): Stain methods: receives the H x W x 2 float32 source hematoxylin
+                and eosin concentrations solved by the transform under 'concentrations'
+            
+        Returns:
+            tuple: (RGB uint8 result image, fraction of skipped background pixels or None)
+        """
+        stages = stages or StageRecorder()
+        pixels = source_img.shape[0] * source_img.shape[1]
+        chunk_size = None
+        if memory_budget.runs_chunked(method, pixels):
+            # Large images run in bounded memory
+            chunk_size = settings.chunk_pixels
+        if low_memory:
+            source_scale = memory_budget.low_memory_scale(pixels, source_scale)
+            chunk_size = settings.chunk_pixels or DEFAULT_CHUNK_PIXELS
+        
+        with stages.stage("fit"):
+            normalizer = NormalizationService._fit_normalizer(
+                method, reference_img, reference_digest, reference_scale)
+        background_fraction = None
+        with stages.stage("transform"):
+            if method in STAIN_METHODS:
+                source = None
+                if group_id:
+                    variant = NormalizationService._stain_backend(method)
+                    if group_thumbnail is not None:
+                        stain_cache.set(group_id, method, normalizer.estimate_source(group_thumbnail), variant)
+                    source = stain_cache.get_or_estimate(group_id, method, normalizer, source_img, variant)
+                result_img = normalizer.transform(source_img, source=source, background=background,
+                                                  scale=source_scale, standardized=standardized,
+                                                  chunk_size=chunk_size, keep_concentrations=maps is not None)
+                if background is not None:
+                    background_fraction = normalizer.background_fraction
+                if maps is not None:
+                    maps['concentrations'] = normalizer.concentrations
+            else:
+                result_img = normalizer.transform(source_img, scale=source_scale)
+
+        # Convert result_img to uint8
+        if result_img.dtype != np.uint8:
+            if result_img.max() <= 1.0:
+                result_img = (result_img * 255).astype(np.uint8)
+            else:
+                result_img = result_img.astype(np.uint8)
+        return result_img, background_fraction
+
+    @staticmethod
+    def preview_image(source_path, method, reference_path=None, preview_size=512, background=None,
+                      reference_scale=1):
+        """
+        Normalize a downscaled copy of the source with the same fitted target as the
+        full-resolution result, for showing a preview while that is computed
+        
+        Args:
+            source_path (Path): Path to the source image file
+            method (str): Normalization method to use
+            reference_path (Path, optional): Path to the reference image if required
+            preview_size (int): Longest side of the preview in pixels
+            background, reference_scale: see normalize_image
+            
+        Returns:
+            Path: Path to the preview image
+        """
+        source_img = cv2.imread(str(source_path))
+        if source_img is None:
+            raise ValueError(f"Could not read source image: {source_path}")
+        source_img = cv2.cvtColor(source_img, cv2.COLOR_BGR2RGB)
+        source_img = ut.downscale(source_img, max(source_img.shape[:2]) / preview_size)
+        
+        reference_digest = None
+        reference_img = None
+        if method != "histogram_equalization":
+            if not reference_path:
+                raise ValueError(f"Method '{method}' requires a reference image")
+            reference_img = cv2.imread(str(reference_path))
+            if reference_img is None:
+                raise ValueError(f"Could not read reference image: {reference_path}")
+            reference_img = cv2.cvtColor(reference_img, cv2.COLOR_BGR2RGB)
+            # The fit is shared through the cache, so the full result reuses it
+            reference_digest = shared_cache.file_digest(reference_path)
+        
+        if method == "histogram_equalization":
+            preview_img = histogram_equalization(source_img, generate_plot=False)['images']['adaptive_equalize']
+            preview_img = exposure.rescale_intensity(preview_img, out_range=(0, 255)).astype(np.uint8)
+        else:
+            preview_img, _ = NormalizationService.normalize_rgb(
+                source_img, method, reference_img, reference_digest, background=background,
+                reference_scale=reference_scale)
+            preview_img = cv2.cvtColor(preview_img, cv2.COLOR_RGB2BGR)
+        
+        preview_dir = Path("static/images/results/previews")
+        preview_dir.mkdir(parents=True, exist_ok=True)
+        preview_path = preview_dir / f"{method}_preview_{os.path.basename(source_path).split('.')[0]}.png"
+        cv2.imwrite(str(preview_path), preview_img)
+        return preview_path
+
+    @staticmethod
+    async def compare(source_path, reference_path, methods=None, scatter_mode="sample"):
+        """
+        Run several methods on the same source and reference, decoding both once; Macenko
+        and Vahadane share one brightness standardization and OD conversion. Every method
+        and chart runs as its own task on the scheduler pool for its estimated cost.
+        Raises MemoryBudgetError before any work if the methods together do not fit the
+        memory budget; methods switch to their low-memory path where that makes them fit.
+        
+        Args:
+            source_path (Path): Path to the source image file
+            reference_path (Path): Path to the reference image file
+            methods (list, optional): Methods to run (default: all COMPARE_METHODS)
+            scatter_mode (str): 'sample' or 'density' scatter plot data (see SCATTER_MODES)
+            
+        Returns:
+            dict: Result images (or error) per method and one chart payload with the source,
+                the reference and every result
+        """
+        methods = list(methods or COMPARE_METHODS)
+        pixels = NormalizationService.image_pixels(source_path)
+        reference_pixels = NormalizationService.image_pixels(reference_path)
+        # Decoded source and reference, the shared standardized optical densities and the
+        # source and reference charts are held next to the methods' own intermediates
+        shared_mb = (DECODE_MEMORY_PER_PIXEL * (pixels + reference_pixels)
+                     + (SHARED_OD_MEMORY_PER_PIXEL if any(m in STAIN_METHODS for m in methods) else 0) * pixels
+                     ) / 2 ** 20
+        plans = memory_budget.plan_concurrent(methods, pixels, shared_mb)
+        # Decoding, OD conversion and chart data cost about as much as histogram matching
+        light_cost = scheduler.estimate_cost("histogram_matching", pixels)
+        
+        def prepare():
+            source_img = cv2.imread(str(source_path))
+            if source_img is None:
+                raise ValueError(f"Could not read source image: {source_path}")
+            source_img = cv2.cvtColor(source_img, cv2.COLOR_BGR2RGB)
+            reference_img = cv2.imread(str(reference_path))
+            if reference_img is None:
+                raise ValueError(f"Could not read reference image: {reference_path}")
+            reference_img = cv2.cvtColor(reference_img, cv2.COLOR_BGR2RGB)
+            # First step of both stain methods, computed once
+            shared = any(m in STAIN_METHODS and not plans[m]['low_memory'] for m in methods)
+            standardized = ut.standardized_OD(source_img) if shared else None
+            return source_img, reference_img, shared_cache.file_digest(reference_path), standardized
+        
+        source_img, reference_img, reference_digest, standardized = await scheduler.run(prepare, light_cost)
+        
+        compare_dir = Path("static/images/results") / f"compare_{os.path.basename(source_path).split('.')[0]}"
+        compare_dir.mkdir(parents=True, exist_ok=True)
+        
+        def run(method):
+            if method == "histogram_equalization":
+                result = histogram_equalization(source_img, save_dir=compare_dir, generate_plot=False)
+                return {
+                    'result_images': [
+                        {'name': display_name, 'path': result['paths'][key], 'key': key}
+                        for key, display_name in HISTOGRAM_EQUALIZATION_IMAGES.items()
+                    ],
+                    'chart_data': NormalizationService._gray_chart_data(result['images']['adaptive_equalize'])
+                }
+            low_memory = plans[method]['low_memory']
+            result_img, _ = NormalizationService.normalize_rgb(
+                source_img, method, reference_img, reference_digest,
+                standardized=standardized if method in STAIN_METHODS and not low_memory else None,
+                low_memory=low_memory)
+            result_path = compare_dir / f"{method}_result.png"
+            cv2.imwrite(str(result_path), cv2.cvtColor(result_img, cv2.COLOR_RGB2BGR))
+            return {
+                'result_image': result_path,
+                'chart_data': NormalizationService._rgb_chart_data(result_img, scatter_mode)
+            }
+        
+        def run_safe(method):
+            try:
+                return run(method)
+            except Exception as e:
+                return {'error': str(e)}
+        
+        outputs = await asyncio.gather(
+            *[scheduler.run(functools.partial(run_safe, method), scheduler.estimate_cost(method, pixels))
+              for method in methods],
+            scheduler.run(functools.partial(NormalizationService._rgb_chart_data, source_img, scatter_mode),
+                          light_cost),
+            scheduler.run(functools.partial(NormalizationService._rgb_chart_data, reference_img, scatter_mode),
+                          light_cost))
+        results = dict(zip(methods, outputs))
+        chart_data = {"source": outputs[-2], "reference": outputs[-1]}
+        
+        for method, result in results.items():
+            if 'chart_data' in result:
+                chart_data[method] = result.pop('chart_data')
+        
+        return {'results': results, 'chart_data': {"images": chart_data}}
+
+    @staticmethod
+    async def sweep(source_path, method, points, reference_path=None, size=256):
+        """
+        Evaluate a parameter grid on downscaled copies of the source and reference and
+        save the low-resolution results as one labelled contact sheet. Every grid point
+        runs as its own task on the scheduler pool for its estimated cost.
+        Raises MemoryBudgetError before any work if the decoded images and the grid points
+        that run at once do not fit the memory budget.
+        
+        Args:
+            source_path (Path): Path to the source image file
+            method (str): Method to sweep (see sweep.SWEEP_PARAMETERS)
+            points (list): Parameter dicts to evaluate (see sweep.parameter_grid)
+            reference_path (Path, optional): Path to the reference image if required
+            size (int): Longest side of the source (and reference) copies in pixels
+            
+        Returns:
+            dict: Path to the contact sheet, its number of columns and the tile of every point
+        """
+        def prepare():
+            source_img = cv2.imread(str(source_path))
+            if source_img is None:
+                raise ValueError(f"Could not read source image: {source_path}")
+            source_img = cv2.cvtColor(source_img, cv2.COLOR_BGR2RGB)
+            source_img = ut.downscale(source_img, max(source_img.shape[:2]) / size)
+            
+            reference_img = None
+            if method != "histogram_equalization":
+                if not reference_path:
+                    raise ValueError(f"Method '{method}' requires a reference image")
+                reference_img = cv2.imread(str(reference_path))
+                if reference_img is None:
+                    raise ValueError(f"Could not read reference image: {reference_path}")
+                reference_img = cv2.cvtColor(reference_img, cv2.COLOR_BGR2RGB)
+                reference_img = ut.downscale(reference_img, max(reference_img.shape[:2]) / size)
+            return Sweep(method, source_img, reference_img)
+        
+        point_cost = scheduler.estimate_cost(method, size * size)
+        decoded_pixels = NormalizationService.image_pixels(source_path) + (
+            NormalizationService.image_pixels(reference_path) if reference_path else 0)
+        concurrent_points = min(len(points), scheduler.concurrency(point_cost))
+        memory_budget.check(
+            f"A {method} sweep of {len(points)} points at {size} px",
+            (DECODE_MEMORY_PER_PIXEL * decoded_pixels
+             + concurrent_points * MEMORY_PER_PIXEL.get(method, MEMORY_PER_PIXEL["macenko"])[0] * size * size) / 2 ** 20)
+        sweep = await scheduler.run(prepare, point_cost)
+        images = await asyncio.gather(
+            *[scheduler.run(functools.partial(sweep.try_evaluate, params), point_cost) for params in points])
+        labels = [format_params(params) for params in points]
+        
+        def save_sheet():
+            sheet, columns = contact_sheet(images, labels)
+            sweep_dir = Path("static/images/results/sweeps")
+            sweep_dir.mkdir(parents=True, exist_ok=True)
+            sheet_path = sweep_dir / f"{method}_sweep_{os.path.basename(source_path).split('.')[0]}.png"
+            cv2.imwrite(str(sheet_path), cv2.cvtColor(sheet, cv2.COLOR_RGB2BGR))
+            return sheet_path, columns
+        
+        sheet_path, columns = await scheduler.run(save_sheet, 0)
+        
+        return {
+            'contact_sheet': sheet_path,
+            'columns': columns,
+            'points': [
+                {
+                    'params': params,
+                    'label': label,
+                    'row': i // columns,
+                    'column': i % columns,
+                    'error': str(img) if isinstance(img, Exception) else None
+                }
+                for i, (params, label, img) in enumerate(zip(points, labels, images))
+            ]
+        }
+
+    @staticmethod
+    def normalize_to_bytes(source_img, method, reference_img=None, image_format="png",
+                           result_key="adaptive_equalize", group_id=None, group_thumbnail=None,
+                           background=None, source_scale=1, reference_scale=1):
+        """
+        Normalize in memory and return the encoded result image, without chart data
+        and without writing anything to disk
+        
+        Args:
+            source_img: RGB uint8 source image
+            method (str): Normalization method to use
+            reference_img: RGB uint8 reference image (required for reference-based methods)
+            image_format (str): One of IMAGE_FORMATS
+            result_key (str): Histogram equalization only: which of its images to return
+            group_id, group_thumbnail, background, source_scale, reference_scale: see normalize_image
+            
+        Returns:
+            tuple: (encoded image bytes, media type, background fraction or None)
+        """
+        plan = memory_budget.plan(method, source_img.shape[0] * source_img.shape[1])
+        background_fraction = None
+        if method == "histogram_equalization":
+            images = histogram_equalization(source_img, generate_plot=False, scale=source_scale)['images']
+            if result_key not in images:
+                raise ValueError(f"Unknown histogram equalization image '{result_key}'. "
+                                 f"Please choose from {', '.join(images)}")
+            result_img = exposure.rescale_intensity(images[result_key], out_range=(0, 255)).astype(np.uint8)
+        else:
+            if reference_img is None:
+                raise ValueError(f"Method '{method}' requires a reference image")
+            result_img, background_fraction = NormalizationService.normalize_rgb(
+                source_img, method, reference_img, None, group_id, group_thumbnail,
+                background, source_scale, reference_scale, low_memory=plan['low_memory'])
+            result_img = cv2.cvtColor(result_img, cv2.COLOR_RGB2BGR)
+        content, media_type = NormalizationService.encode_image(result_img, image_format)
+        return content, media_type, background_fraction
+
+    @staticmethod
+    def encode_image(img, image_format="png"):
+        """Encode a BGR (or grayscale) uint8 image, returns (bytes, media type)"""
+        extension, media_type = IMAGE_FORMATS[image_format]
+        ok, buffer = cv2.imencode(extension, img)
+        if not ok:
+            raise ValueError(f"Could not encode result image as {image_format}")
+        return buffer.tobytes(), media_type
+
     @staticmethod
     def get_available_methods():
         """Get information about available normalization methods"""
@@ -187,44 +870,52 @@ class NormalizationService:
             "adaptive_equalize": {"histograms": [], "cdfs": []}
         }
         
-        # Use same parameters as matplotlib function
-        nbins = 256
-        
         # For histogram equalization, we work with grayscale images
         for img_key, img in images.items():
-            # Ensure image is float and 2D (grayscale)
-            if img.ndim == 3:
-                from skimage.color import rgb2gray
-                img = rgb2gray(img)
-            
-            # Get histogram and CDF data
-            from skimage import exposure
-            img_hist, bins = exposure.histogram(img, nbins=nbins, source_range='dtype')
-            img_cdf, cdf_bins = exposure.cumulative_distribution(img, nbins=nbins)
-            
-            # Normalize histogram 
-            normalized_hist = (img_hist / img_hist.max()) if img_hist.max() > 0 else img_hist
-            
-            # Store histogram data (single channel for grayscale)
-            for j in range(len(bins)):
-                chart_data[img_key]["histograms"].append({
-                    "bin": float(bins[j]),
-                    "count": float(img_hist[j]),
-                    "normalized_count": float(normalized_hist[j]),
-                    "channel": "gray"  # Single grayscale channel
-                })
-              # Store CDF data
-            for j in range(len(cdf_bins)):
-                chart_data[img_key]["cdfs"].append({
-                    "bin": float(cdf_bins[j]),
-                    "cdf": float(img_cdf[j]),
-                    "channel": "gray"
-                })
+            chart_data[img_key] = NormalizationService._gray_chart_data(img)
         
         return {"images": chart_data}
     
     @staticmethod
-    def extract_rgb_chart_data(source_img, reference_img, result_img):
+    def _gray_chart_data(img):
+        """Histogram and CDF data of one grayscale image (see extract_histogram_equalization_data)"""
+        chart_data_entry = {"histograms": [], "cdfs": [], "scatter_plots": []}
+        
+        # Use same parameters as matplotlib function
+        nbins = 256
+        
+        # Ensure image is float and 2D (grayscale)
+        if img.ndim == 3:
+            from skimage.color import rgb2gray
+            img = rgb2gray(img)
+        
+        # Get histogram and CDF data
+        img_hist, bins = exposure.histogram(img, nbins=nbins, source_range='dtype')
+        img_cdf, cdf_bins = exposure.cumulative_distribution(img, nbins=nbins)
+        
+        # Normalize histogram 
+        normalized_hist = (img_hist / img_hist.max()) if img_hist.max() > 0 else img_hist
+        
+        # Store histogram data (single channel for grayscale)
+        for j in range(len(bins)):
+            chart_data_entry["histograms"].append({
+                "bin": float(bins[j]),
+                "count": float(img_hist[j]),
+                "normalized_count": float(normalized_hist[j]),
+                "channel": "gray"  # Single grayscale channel
+            })
+        # Store CDF data
+        for j in range(len(cdf_bins)):
+            chart_data_entry["cdfs"].append({
+                "bin": float(cdf_bins[j]),
+                "cdf": float(img_cdf[j]),
+                "channel": "gray"
+            })
+        
+        return chart_data_entry
+    
+    @staticmethod
+    def extract_rgb_chart_data(source_img, reference_img, result_img, scatter_mode="sample"):
         """
         Extract histogram and scatter plot data for RGB methods (color images)
         
@@ -232,53 +923,63 @@ class NormalizationService:
             source_img: Original source image (before normalization)
             reference_img: Reference image used for matching  
             result_img: Result image after normalization
+            scatter_mode (str): 'sample' or 'density' scatter plot data (see SCATTER_MODES)
             
         Returns:
             dict: Dictionary containing histogram, CDF, and scatter plot data for RGB images
         """
+        images = [source_img, reference_img, result_img]
+        image_keys = ["source", "reference", "result"]
         chart_data = {
-            "source": {"histograms": [], "cdfs": [], "scatter_plots": []},
-            "reference": {"histograms": [], "cdfs": [], "scatter_plots": []}, 
-            "result": {"histograms": [], "cdfs": [], "scatter_plots": []}
+            img_key: NormalizationService._rgb_chart_data(img, scatter_mode)
+            for img, img_key in zip(images, image_keys)
         }
         
+        return {"images": chart_data}
+    
+    @staticmethod
+    def _rgb_chart_data(img, scatter_mode="sample"):
+        """Histogram, CDF and scatter plot data of one RGB image (see extract_rgb_chart_data)"""
+        chart_data_entry = {"histograms": [], "cdfs": [], "scatter_plots": []}
+        
         # Use same parameters as matplotlib function
         nbins = 256
-        images = [source_img, reference_img, result_img]
-        image_keys = ["source", "reference", "result"]
         colors = ['red', 'green', 'blue']
         
-        for img_idx, (img, img_key) in enumerate(zip(images, image_keys)):
-            for c, color in enumerate(colors):
-                # Get histogram and bins (same as matplotlib)
-                img_hist, bins = exposure.histogram(img[..., c], nbins=nbins, source_range='dtype')
-                
-                # Get CDF (same as matplotlib)
-                img_cdf, cdf_bins = exposure.cumulative_distribution(img[..., c], nbins=nbins)
-                
-                # Normalize histogram (same as matplotlib: img_hist / img_hist.max())
-                normalized_hist = (img_hist / img_hist.max()) if img_hist.max() > 0 else img_hist
-                
-                # Store histogram data
-                for j in range(len(bins)):
-                    chart_data[img_key]["histograms"].append({
-                        "bin": float(bins[j]),
-                        "count": float(img_hist[j]),
-                        "normalized_count": float(normalized_hist[j]),
-                        "channel": color                    })
-                
-                # Store CDF data  
-                for j in range(len(cdf_bins)):
-                    chart_data[img_key]["cdfs"].append({
-                        "bin": float(cdf_bins[j]),
-                        "cdf": float(img_cdf[j]),
-                        "channel": color
-                    })
+        for c, color in enumerate(colors):
+            # Get histogram and bins (same as matplotlib)
+            img_hist, bins = exposure.histogram(img[..., c], nbins=nbins, source_range='dtype')
+            
+            # Get CDF (same as matplotlib)
+            img_cdf, cdf_bins = exposure.cumulative_distribution(img[..., c], nbins=nbins)
+            
+            # Normalize histogram (same as matplotlib: img_hist / img_hist.max())
+            normalized_hist = (img_hist / img_hist.max()) if img_hist.max() > 0 else img_hist
             
-            # Generate scatter plot data for this image
-            NormalizationService._generate_scatter_plot_data(img, chart_data[img_key])
+            # Store histogram data
+            for j in range(len(bins)):
+                chart_data_entry["histograms"].append({
+                    "bin": float(bins[j]),
+                    "count": float(img_hist[j]),
+                    "normalized_count": float(normalized_hist[j]),
+                    "channel": color
+                })
+            
+            # Store CDF data  
+            for j in range(len(cdf_bins)):
+                chart_data_entry["cdfs"].append({
+                    "bin": float(cdf_bins[j]),
+                    "cdf": float(img_cdf[j]),
+                    "channel": color
+                })
         
-        return {"images": chart_data}
+        # Generate scatter plot data for this image
+        if scatter_mode == "density":
+            NormalizationService._generate_density_scatter_data(img, chart_data_entry)
+        else:
+            NormalizationService._generate_scatter_plot_data(img, chart_data_entry)
+        
+        return chart_data_entry
     
     @staticmethod
     def _generate_scatter_plot_data(img, chart_data_entry, sample_size=2000):
@@ -296,19 +997,16 @@ class NormalizationService:
         if len(img.shape) == 2:
             img = np.stack((img,) * 3, axis=-1)
         
-        # Extract RGB channels and flatten them
-        R = img[:, :, 0].flatten().astype(float)
-        G = img[:, :, 1].flatten().astype(float)
-        B = img[:, :, 2].flatten().astype(float)
+        # Flatten to pixels; only the sampled ones are converted to float
+        pixels = img.reshape((-1, 3))
         
         # Sample pixels to avoid overwhelming the frontend with too much data
-        total_pixels = len(R)
+        total_pixels = pixels.shape[0]
         if total_pixels > sample_size:
             # Random sampling
             indices = np.random.choice(total_pixels, sample_size, replace=False)
-            R = R[indices]
-            G = G[indices]
-            B = B[indices]
+            pixels = pixels[indices]
+        R, G, B = pixels.astype(float).T
         
         # Center the values for axis positions (assuming 0-255 range)
         R_centered = R - 127.5
@@ -328,4 +1026,43 @@ class NormalizationService:
                 "y": float(G_centered[i]),
                 "color": colors[i],
                 "channel": colors[i]  # For compatibility
-            })
\ No newline at end of file
+            })
+
+    @staticmethod
+    def _generate_density_scatter_data(img, chart_data_entry, bins=64):
+        """
+        Generate a fixed-size 2D R-G density grid over all pixels
+        
+        Every pixel falls into one of bins x bins cells of the R-G plane. The entry gets
+        'scatter_density' with the pixel count of every cell and the channel that dominates
+        most of its pixels (0=red, 1=green, 2=blue, -1 for empty cells), both bins x bins
+        with the red bin as the row, so the payload and its cost do not depend on the
+        image content; the frontend draws the occupied cells.
+        
+        Args:
+            img: RGB uint8 image array
+            chart_data_entry: Dictionary entry to add the density grid to
+            bins: Number of bins per axis (default 64)
+        """
+        # Ensure the image is RGB
+        if img.ndim == 2:
+            img = np.stack((img,) * 3, axis=-1)
+        pixels = img.reshape(-1, 3)
+        if pixels.dtype != np.uint8:
+            pixels = np.clip(pixels, 0, 255).astype(np.uint8)
+        
+        # Cell of every pixel and its dominant channel, counted in one pass
+        cells = (pixels[:, 0].astype(np.intp) * bins >> 8) * bins + (pixels[:, 1].astype(np.intp) * bins >> 8)
+        dominant = np.argmax(pixels, axis=1)
+        channel_counts = np.bincount(cells * 3 + dominant, minlength=bins * bins * 3).reshape((bins, bins, 3))
+        counts = channel_counts.sum(axis=2)
+        cell_dominant = np.where(counts > 0, np.argmax(channel_counts, axis=2), -1)
+        
+        chart_data_entry["scatter_density"] = {
+            "bins": bins,
+            # Cell edges in the centered 0-255 range of the sampled points
+            "min": -127.5,
+            "max": 128.5,
+            "counts": counts.tolist(),
+            "dominant": cell_dominant.tolist()
+        }
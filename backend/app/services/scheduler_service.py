@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+from app.config import settings
+from app.utils import threads
+
+logger = logging.getLogger(__name__)
+
+# Rough cost of one request per method on one core, including its chart data:
+# (fixed seconds, seconds per megapixel). Vahadane's fixed part is trainDL on the
+# reference and source stains
+METHOD_COSTS = {
+    "histogram_equalization": (0.01, 0.2),
+    "histogram_matching": (0.0, 0.1),
+    "reinhard": (0.0, 0.1),
+    "macenko": (0.01, 0.4),
+    "vahadane": (2.0, 0.3),
+}
+
+# Scheduling classes, each with its own pool
+CHEAP = "cheap"
+EXPENSIVE = "expensive"
+
+
+class _Pool:
+    """Thread pool of one scheduling class with its counters"""
+
+    def __init__(self, name: str, workers: int, window: int):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-pool")
+        self.waits = deque(maxlen=window)  # queue wait of the most recent jobs, in seconds
+        self.submitted = 0
+        self.completed = 0
+        self.running = 0
+
+
+class SchedulerService:
+    """Cost-aware scheduling of compute work on separate cheap and expensive pools
+
+    Reinhard and histogram matching finish in milliseconds while a Vahadane request
+    takes seconds. On one shared pool a burst of Vahadane requests queues every
+    other request behind it, so work is classified by its estimated cost (method
+    and pixel count) and each class runs on its own, independently sized pool.
+    Pools are sized from the compute slots of this worker process (see
+    threads.compute_slots), so all workers together do not oversubscribe the cores.
+    """
+
+    def __init__(self, cheap_workers: Optional[int] = None, expensive_workers: Optional[int] = None,
+                 expensive_cost: float = 0.5, window: int = 1024):
+        slots = threads.compute_slots(settings.workers, settings.compute_threads)
+        self.expensive_cost = expensive_cost
+        self._pools = {
+            CHEAP: _Pool(CHEAP, cheap_workers or slots, window),
+            EXPENSIVE: _Pool(EXPENSIVE, expensive_workers or max(1, slots // 2), window),
+        }
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_cost(method: str, pixels: int) -> float:
+        """Estimated seconds one request of method takes on an image of pixels pixels"""
+        fixed, per_megapixel = METHOD_COSTS.get(method, METHOD_COSTS["vahadane"])
+        return fixed + per_megapixel * pixels / 1e6
+
+    def classify(self, cost: float) -> str:
+        """Scheduling class of work with the given estimated cost"""
+        return EXPENSIVE if cost > self.expensive_cost else CHEAP
+
+    def concurrency(self, cost: float) -> int:
+        """How many tasks of the given estimated cost can run at once (their pool size)"""
+        return self._pools[self.classify(cost)].workers
+
+    async def run(self, work: Callable[[], Any], cost: float) -> Any:
+        """Run work() on the pool of its cost class and return its result"""
+        pool = self._pools[self.classify(cost)]
+        submitted = time.perf_counter()
+        with self._lock:
+            pool.submitted += 1
+
+        def timed():
+            with self._lock:
+                pool.waits.append(time.perf_counter() - submitted)
+                pool.running += 1
+            try:
+                return work()
+            finally:
+                with self._lock:
+                    pool.running -= 1
+                    pool.completed += 1
+
+        return await asyncio.get_running_loop().run_in_executor(pool.executor, timed)
+
+    def stats(self) -> dict:
+        """Per class: pool size, job counts and queue wait times (seconds, recent jobs)"""
+        stats = {"expensive_cost": self.expensive_cost}
+        with self._lock:
+            for name, pool in self._pools.items():
+                waits = np.array(pool.waits)
+                stats[name] = {
+                    "workers": pool.workers,
+                    "submitted": pool.submitted,
+                    "completed": pool.completed,
+                    "running": pool.running,
+                    "queued": pool.submitted - pool.completed - pool.running,
+                    "wait_mean": float(waits.mean()) if waits.size else 0.0,
+                    "wait_p95": float(np.percentile(waits, 95)) if waits.size else 0.0,
+                    "wait_max": float(waits.max()) if waits.size else 0.0,
+                }
+        return stats
+
+
+# Global scheduler instance
+scheduler = SchedulerService(settings.cheap_workers, settings.expensive_workers, settings.expensive_cost)
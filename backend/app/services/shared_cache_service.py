@@ -0,0 +1,230 @@
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from app.config import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to locks that only cover this process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class SharedCacheService:
+    """Cache of fitted references and finished results shared by all worker processes
+
+    Entries are pickled blobs on disk indexed by a small SQLite database, so any
+    uvicorn worker on the host can reuse a fit or result computed by another one.
+    Writers take a per-key file lock, so identical requests wait for each other
+    while unrelated requests never serialize. The in-process lock of a key only
+    exists while someone holds or waits for it; lock files are removed by clear().
+    """
+
+    def __init__(self, root: Path, enabled: bool = True):
+        self.root = Path(root)
+        self.enabled = enabled
+        self.blob_dir = self.root / "blobs"
+        self.lock_dir = self.root / "locks"
+        self.index_path = self.root / "index.sqlite"
+        self._local_locks = {}  # key -> [lock, number of holders and waiters]
+        self._local_locks_guard = threading.Lock()
+        self._initialized = False
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """Content key for the given parts (bytes are hashed as-is, anything else via repr)"""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part if isinstance(part, bytes) else repr(part).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_digest(path) -> str:
+        """SHA-256 of a file's content"""
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._initialized:
+            self.blob_dir.mkdir(parents=True, exist_ok=True)
+            self.lock_dir.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.index_path), timeout=30)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, kind TEXT, path TEXT, size INTEGER, created REAL, last_access REAL)"
+            )
+            conn.commit()
+            self._initialized = True
+        return conn
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for key, or None"""
+        if not self.enabled:
+            return None
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(row[0], "rb") as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            return value
+        finally:
+            conn.close()
+
+    def put(self, key: str, kind: str, value: Any):
+        """Store value under key (written atomically, so readers never see partial blobs)"""
+        if not self.enabled:
+            return
+        conn = self._connect()
+        try:
+            path = self.blob_dir / f"{key}.pkl"
+            tmp_path = self.blob_dir / f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, kind, path, size, created, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, str(path), path.stat().st_size, now, now),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def delete(self, key: str):
+        """Drop an entry (e.g. when the files it points to are gone)"""
+        if not self.enabled:
+            return
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            conn.commit()
+        finally:
+            conn.close()
+        (self.blob_dir / f"{key}.pkl").unlink(missing_ok=True)
+
+    def expire(self, kind: str, max_age: float) -> int:
+        """Drop the entries of one kind created more than max_age seconds ago, returns how many"""
+        if not self.enabled:
+            return 0
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT key, path FROM entries WHERE kind = ? AND created < ?",
+                                (kind, time.time() - max_age)).fetchall()
+            conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in rows])
+            conn.commit()
+        finally:
+            conn.close()
+        for _, path in rows:
+            Path(path).unlink(missing_ok=True)
+        return len(rows)
+
+    @contextmanager
+    def lock(self, key: str):
+        """
+        Exclusive lock on one key across threads and worker processes (only across
+        threads when the cache is disabled)
+        """
+        with self._local_locks_guard:
+            entry = self._local_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                if not self.enabled or fcntl is None:
+                    yield
+                    return
+                self.lock_dir.mkdir(parents=True, exist_ok=True)
+                with open(self.lock_dir / f"{key}.lock", "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            with self._local_locks_guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._local_locks[key]
+
+    def get_or_compute(self, key: str, kind: str, compute: Callable[[], Any]) -> Any:
+        """Return the cached value for key, computing and storing it under the key's lock on a miss"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self.lock(key):
+            value = self.get(key)
+            if value is None:
+                value = compute()
+                self.put(key, kind, value)
+            return value
+
+    def clear(self) -> int:
+        """Remove all entries, blobs and unused lock files, returns the number of entries removed"""
+        if not self.enabled or not self.root.exists():
+            return 0
+        conn = self._connect()
+        try:
+            count = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            conn.execute("DELETE FROM entries")
+            conn.commit()
+        finally:
+            conn.close()
+        for blob in self.blob_dir.glob("*.pkl"):
+            try:
+                blob.unlink()
+            except OSError as e:
+                logger.warning(f"Could not remove cache blob {blob}: {e}")
+        for lock_path in self.lock_dir.glob("*.lock"):
+            self._remove_lock_file(lock_path)
+        return count
+
+    @staticmethod
+    def _remove_lock_file(lock_path: Path):
+        """Remove a lock file unless some thread or process holds it"""
+        try:
+            with open(lock_path, "a") as lock_file:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        return
+                lock_path.unlink()
+        except OSError as e:
+            logger.warning(f"Could not remove cache lock file {lock_path}: {e}")
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT kind, COUNT(*), COALESCE(SUM(size), 0) FROM entries GROUP BY kind").fetchall()
+        finally:
+            conn.close()
+        return {"enabled": True, "entries": {kind: {"count": count, "bytes": size} for kind, count, size in rows}}
+
+
+# Global shared cache instance
+shared_cache = SharedCacheService(settings.cache_dir, enabled=settings.cache_enabled)
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlightService:
+    """Coalesce identical concurrent computations within this process
+
+    The first caller for a key runs the computation; callers arriving while it is
+    still in flight wait for it and share its result (or its exception) instead of
+    repeating the work and writing the same result files. Finished results are not
+    kept here, reuse after completion is the shared cache's job.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do_async(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Return await compute(), or the result of the identical computation already in flight
+        for key; waiting callers do not hold a thread while the computation runs
+        """
+        call, leader = self._join(key)
+        if not leader:
+            # Shielded: a cancelled waiter (e.g. a disconnected client) must not cancel the shared call
+            return await asyncio.shield(asyncio.wrap_future(call))
+        try:
+            result = await compute()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            self._leave(key)
+
+    def _join(self, key: str) -> Tuple[Future, bool]:
+        """The future of the computation for key, and whether the caller has to run it"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            logger.info(f"Coalesced request {key[:16]} with the computation in flight")
+        return call, leader
+
+    def _leave(self, key: str):
+        with self._lock:
+            del self._calls[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"executions": self.executions, "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+
+# Global single-flight instance
+single_flight = SingleFlightService()
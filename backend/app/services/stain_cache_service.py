@@ -0,0 +1,104 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from app.services.shared_cache_service import shared_cache
+
+logger = logging.getLogger(__name__)
+
+
+class StainCacheService:
+    """Per-slide cache of source stain estimates
+
+    Tiles of one slide share their stain vectors, so the source stain matrix
+    (and concentration percentiles) are estimated once per group id and
+    reused for every later tile of the same group.
+
+    Estimates are kept in the shared cache (so every worker process reuses them)
+    and in a small in-process LRU. The first tiles of a group that arrive together
+    wait on the group's lock for a single estimate instead of each making their own.
+    variant names anything else the estimate depends on (e.g. the Vahadane
+    dictionary backend).
+    """
+
+    def __init__(self, max_groups: int = 256):
+        self.max_groups = max_groups
+        self._entries: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _shared_key(key: tuple) -> str:
+        return shared_cache.make_key("group", *key)
+
+    def _lookup(self, key: tuple) -> Optional[dict]:
+        """The estimate in this process, else in the shared cache (remembered locally), or None"""
+        with self._lock:
+            source = self._entries.get(key)
+            if source is not None:
+                self._entries.move_to_end(key)
+                return source
+        source = shared_cache.get(self._shared_key(key))
+        if source is not None:
+            self._remember(key, source)
+        return source
+
+    def _remember(self, key: tuple, source: dict):
+        """Keep an estimate in this process, evicting the least recently used group"""
+        with self._lock:
+            self._entries[key] = source
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_groups:
+                evicted, _ = self._entries.popitem(last=False)
+                logger.info(f"Evicted stain estimate for group {evicted[0]} ({evicted[1]})")
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, group_id: str, method: str, variant=None) -> Optional[dict]:
+        """Return the cached source estimate for a group, or None"""
+        source = self._lookup((group_id, method, variant))
+        self._count(source is not None)
+        return source
+
+    def set(self, group_id: str, method: str, source: dict, variant=None):
+        """Store the source estimate for a group (replacing any earlier one)"""
+        key = (group_id, method, variant)
+        with shared_cache.lock(self._shared_key(key)):
+            shared_cache.put(self._shared_key(key), "group", source)
+            self._remember(key, source)
+
+    def get_or_estimate(self, group_id: str, method: str, normalizer, image, variant=None) -> dict:
+        """Return the group's source estimate, estimating it from image on first use (once per group)"""
+        key = (group_id, method, variant)
+        source = self._lookup(key)
+        if source is None:
+            with shared_cache.lock(self._shared_key(key)):
+                source = self._lookup(key)
+                if source is None:
+                    self._count(False)
+                    source = normalizer.estimate_source(image)
+                    shared_cache.put(self._shared_key(key), "group", source)
+                    self._remember(key, source)
+                    return source
+        self._count(True)
+        return source
+
+    def clear(self):
+        """Drop the estimates kept in this process (the shared cache is cleared with its other entries)"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"groups": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# Global stain cache instance
+stain_cache = StainCacheService()
@@ -0,0 +1,104 @@
+"""
+Content-addressed URLs and HTTP caching of stored files.
+
+A file's URL carries the digest of its bytes, so a URL always names the same
+content: it can be cached by browsers for good (Cache-Control immutable) and a
+result that is recomputed or rewritten gets a new URL instead of a stale hit.
+Files served under their plain names (downloads, chart data) get an ETag and
+are revalidated instead.
+"""
+
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+# Cache-Control of content-addressed URLs and of files served under their plain names
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# Hex digits of the SHA-256 in URLs and ETags (128 bits)
+DIGEST_LENGTH = 32
+
+# Digests of recently served files, keyed by (path, size, mtime) so a rewritten file is hashed again
+_MAX_DIGESTS = 4096
+_digests = OrderedDict()
+_lock = threading.Lock()
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def _remembered(key):
+    with _lock:
+        digest = _digests.get(key)
+        if digest is not None:
+            _digests.move_to_end(key)
+        return digest
+
+
+def remember(path, digest):
+    """
+    Remember the digest of a file hashed elsewhere (e.g. the shared cache's file_digest)
+    :param path:
+    :param digest: hex SHA-256 of the file's content (full or truncated)
+    :return:
+    """
+    key = _file_key(path)
+    with _lock:
+        _digests[key] = digest[:DIGEST_LENGTH]
+        while len(_digests) > _MAX_DIGESTS:
+            _digests.popitem(last=False)
+
+
+def content_digest(path):
+    """
+    Truncated SHA-256 of a file's content, remembered while the file is unchanged
+    :param path:
+    :return:
+    """
+    digest = _remembered(_file_key(path))
+    if digest is not None:
+        return digest
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    remember(path, digest)
+    return digest[:DIGEST_LENGTH]
+
+
+async def content_digest_async(path):
+    """
+    content_digest for async handlers: a file that is not remembered is hashed in the
+    default executor, so large files never block the event loop
+    :param path:
+    :return:
+    """
+    digest = _remembered(_file_key(path))
+    if digest is not None:
+        return digest
+    return await asyncio.get_running_loop().run_in_executor(None, content_digest, path)
+
+
+def etag(digest):
+    return f'"{digest}"'
+
+
+def not_modified(if_none_match, tag):
+    """
+    Whether an If-None-Match request header matches the ETag (weak comparison, as
+    compressed responses may carry a weakened tag)
+    :param if_none_match: header value or None
+    :param tag: quoted ETag
+    :return:
+    """
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or tag in [candidate[2:] if candidate.startswith("W/") else candidate
+                                        for candidate in candidates]
@@ -0,0 +1,153 @@
+"""
+Per-pixel kernels with an optional JIT-compiled backend.
+
+The brightness standardization with the optical density lookup, and the stain
+reconstruction 255 * exp(-C S), run once per pixel on every Macenko and Vahadane
+request. When numba is installed each is compiled into a single parallel pass
+over the pixels (prange over the compute threads of the request, see
+app.utils.threads; no float64 temporaries of the image size, and the GIL is
+released, so concurrent requests and sweep points run in parallel too);
+otherwise the NumPy expressions are used. The compiled exp may differ from
+NumPy's in the last bit, which very rarely moves an output value by one.
+
+The kernels are called from many request threads at once. numba's OpenMP
+threading layer is preferred: its workqueue layer aborts the process on
+concurrent calls (so they are serialized when it is the only one available)
+and its TBB layer can hang the process at exit when called from threads.
+NUMBA_THREADING_LAYER still overrides the choice.
+
+The backend is chosen at import and can be forced with set_backend("numpy")
+(COLOR_NORM_KERNELS in the API settings).
+"""
+
+import threading
+
+import numpy as np
+
+from app.utils import threads
+
+try:
+    import numba
+except ImportError:  # numba is optional, the NumPy kernels are always available
+    numba = None
+
+if numba is not None and numba.config.THREADING_LAYER == "default":
+    # workqueue is always available, so TBB is only used when asked for
+    numba.config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
+
+BACKENDS = ("numba", "numpy")
+
+_backend = "numba" if numba is not None else "numpy"
+
+
+def set_backend(name):
+    """
+    Select the kernel backend
+    :param name: 'numba', 'numpy' or 'auto' (numba when installed)
+    :return: the backend in use
+    """
+    global _backend
+    name = (name or "auto").strip().lower()
+    if name not in BACKENDS + ("auto",):
+        raise ValueError(f"Unknown kernel backend '{name}'. Choose from auto, {', '.join(BACKENDS)}")
+    if name == "numba" and numba is None:
+        raise ValueError("The numba kernel backend requires numba to be installed")
+    _backend = name if name != "auto" else ("numba" if numba is not None else "numpy")
+    return _backend
+
+
+def backend():
+    """
+    Name of the kernel backend in use ('numba' or 'numpy')
+    :return:
+    """
+    return _backend
+
+
+### NumPy kernels ###
+
+
+def _lookup_pair_numpy(I, lut, values):
+    return lut[I], values[I]
+
+
+def _stains_to_uint8_numpy(C, stain_matrix, out):
+    out[...] = 255 * np.exp(-1 * np.dot(C, stain_matrix))
+    return out
+
+
+### Compiled kernels ###
+
+if numba is not None:
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _lookup_pair_numba(flat, lut, values, out, out_values):
+        for i in numba.prange(flat.shape[0]):
+            out[i] = lut[flat[i]]
+            out_values[i] = values[flat[i]]
+
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _stains_to_uint8_numba(C, stain_matrix, out):
+        for i in numba.prange(C.shape[0]):
+            for k in range(3):
+                out[i, k] = np.uint8(255 * np.exp(-1 * (C[i, 0] * stain_matrix[0, k] + C[i, 1] * stain_matrix[1, k])))
+
+
+# Serializes the parallel kernels while numba's threading layer is not known to be threadsafe
+_layer_lock = threading.Lock()
+_threadsafe_layer = None
+
+
+def _run_parallel(kernel, *args):
+    """
+    Run a parallel kernel on the compute thread limit of the calling thread (numba's
+    thread count is per calling thread), at most numba's pool size
+    :param kernel:
+    :param args:
+    :return:
+    """
+    global _threadsafe_layer
+    n = threads.num_threads()
+    numba.set_num_threads(min(n, numba.config.NUMBA_NUM_THREADS) if n > 0 else numba.config.NUMBA_NUM_THREADS)
+    if _threadsafe_layer:
+        return kernel(*args)
+    with _layer_lock:
+        result = kernel(*args)
+        # The layer is chosen on the first parallel call
+        _threadsafe_layer = numba.threading_layer() != "workqueue"
+        return result
+
+
+def lookup_pair(I, lut, values):
+    """
+    Map every uint8 value of I through two 256 entry tables in one pass, e.g. the
+    brightness standardization and the optical density of the standardized value
+    (see ut.standardized_OD)
+    :param I: uint8 array of any shape
+    :param lut: 256 uint8 table
+    :param values: 256 table
+    :return: (lut[I], values[I]), shaped like I
+    """
+    if _backend == "numpy":
+        return _lookup_pair_numpy(I, lut, values)
+    out = np.empty(I.shape, dtype=lut.dtype)
+    out_values = np.empty(I.shape, dtype=values.dtype)
+    _run_parallel(_lookup_pair_numba, np.ascontiguousarray(I).reshape(-1), lut, values,
+                  out.reshape(-1), out_values.reshape(-1))
+    return out, out_values
+
+
+def stains_to_uint8(C, stain_matrix, out=None):
+    """
+    Reconstruct RGB uint8 pixels from concentrations: 255 * exp(-C S)
+    :param C: npix x 2 concentrations
+    :param stain_matrix: a 2x3 stain matrix
+    :param out: optional npix x 3 uint8 array to write into
+    :return: npix x 3 uint8
+    """
+    if out is None:
+        out = np.empty((C.shape[0], 3), dtype=np.uint8)
+    if _backend == "numpy":
+        return _stains_to_uint8_numpy(C, stain_matrix, out)
+    _run_parallel(_stains_to_uint8_numba, np.ascontiguousarray(C, dtype=np.float64),
+                  np.ascontiguousarray(stain_matrix, dtype=np.float64), out)
+    return out
@@ -0,0 +1,68 @@
+"""
+Wall time and peak memory of processing stages.
+
+Peak memory comes from tracemalloc, which NumPy reports its array buffers to, so
+the float64 intermediates of a stage are included. tracemalloc has to be started
+(start_tracking) before any stage is measured. Its peak is process-wide and
+every stage resets it, so while tracking, measured stages run one at a time in
+a process (a stage resetting the peak would hide the allocations of a
+concurrent one). Allocations of other threads outside any stage still count
+towards a stage's peak, so under concurrency peaks can over-report, never
+under-report. Without tracking only the stage times are recorded and stages
+run concurrently.
+"""
+
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+MB = 2 ** 20
+
+# Held by the stage being measured while tracking (see the module docstring)
+_measure_lock = threading.Lock()
+
+
+def start_tracking():
+    """
+    Start tracing allocations (one frame per allocation keeps the overhead low)
+    :return:
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(1)
+
+
+class StageRecorder(object):
+    """
+    Records the stages of one computation:
+
+        stages = StageRecorder()
+        with stages.stage("transform"):
+            ...
+        stages.stages  # [{'name': 'transform', 'seconds': ..., 'peak_mb': ...}]
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block (and measure its peak allocations when tracking)
+        :param name:
+        :return:
+        """
+        tracking = tracemalloc.is_tracing()
+        if tracking:
+            _measure_lock.acquire()
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = {"name": name, "seconds": time.perf_counter() - start}
+            if tracking:
+                entry["peak_mb"] = max(0, tracemalloc.get_traced_memory()[1] - baseline) / MB
+                _measure_lock.release()
+            self.stages.append(entry)
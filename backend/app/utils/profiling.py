@@ -0,0 +1,50 @@
+"""
+Deterministic profiling of a single call.
+
+The profile is written in the standard pstats format (load it with
+pstats.Stats, snakeviz or gprof2dot) and summarized as the functions with the
+most own time. cProfile only follows the calling thread, so work the call hands
+to other threads shows up as time spent waiting for them.
+"""
+
+import cProfile
+import os
+import pstats
+import time
+
+
+def profile_call(path, fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) under cProfile and write the profile to path
+    :param path: .prof file to write
+    :param fn:
+    :return: (result of fn, wall-clock seconds)
+    """
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        return profiler.runcall(fn, *args, **kwargs), time.perf_counter() - start
+    finally:
+        profiler.dump_stats(str(path))
+
+
+def hot_functions(path, limit=15):
+    """
+    Functions with the most own time in a profile written by profile_call
+    :param path:
+    :param limit: number of functions to return
+    :return: list of dicts (function, file, line, calls, self_seconds, cumulative_seconds)
+    """
+    stats = pstats.Stats(str(path)).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+    return [
+        {
+            "function": function,
+            "file": os.path.basename(filename) if filename != "~" else "<built-in>",
+            "line": line,
+            "calls": calls,
+            "self_seconds": self_time,
+            "cumulative_seconds": cumulative_time,
+        }
+        for (filename, line, function), (_, calls, self_time, cumulative_time, _) in rows
+    ]
@@ -0,0 +1,110 @@
+"""
+Thread limits for the native compute libraries.
+
+numpy's BLAS (np.linalg.eigh, np.cov), OpenCV and spams each start one thread per
+core by default, which oversubscribes the CPU as soon as several requests or
+worker processes run at once. The environment variables must be set before numpy
+is first imported (the launcher does that for every worker); limit_threads() also
+applies the limit at runtime where the libraries allow it.
+"""
+
+import os
+
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+# Threads for spams calls (-1 lets spams use every core)
+_num_threads = -1
+
+
+def available_cores():
+    """
+    Number of cores this process may use (CPU affinity and cgroup quota aware)
+    :return:
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cores = min(cores, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cores
+
+
+def plan_workers(cores=None, workers=None, threads=None):
+    """
+    Split the cores between worker processes and per-worker compute threads.
+    A few threads per worker keeps single large requests fast while leaving
+    enough workers for concurrent ones.
+    :param cores: cores to plan for (default: available_cores())
+    :param workers: fixed number of workers, or None to derive it
+    :param threads: fixed threads per worker, or None to derive it
+    :return: (workers, threads)
+    """
+    cores = cores or available_cores()
+    if threads is None:
+        threads = max(1, cores // workers) if workers else max(1, min(4, cores // 4))
+    if workers is None:
+        workers = max(1, cores // threads)
+    return workers, threads
+
+
+def compute_slots(workers=None, compute_threads=None, cores=None):
+    """
+    Compute tasks one worker process can run at once without oversubscribing the
+    cores, when workers processes share them and every task uses compute_threads
+    threads (unset counts as one)
+    :param workers:
+    :param compute_threads:
+    :param cores: cores to plan for (default: available_cores())
+    :return:
+    """
+    cores = cores or available_cores()
+    return max(1, cores // ((workers or 1) * (compute_threads or 1)))
+
+
+def set_thread_env(n):
+    """
+    Set the BLAS/OpenMP thread environment variables (inherited by child processes)
+    :param n:
+    :return:
+    """
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n)
+
+
+def limit_threads(n):
+    """
+    Limit OpenCV, spams and (when threadpoolctl is installed) the already loaded
+    BLAS/OpenMP libraries of this process to n threads
+    :param n:
+    :return:
+    """
+    global _num_threads
+    _num_threads = n
+    set_thread_env(n)
+    import cv2 as cv
+    cv.setNumThreads(n)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(n)
+
+
+def num_threads():
+    """
+    Thread count to pass to spams (numThreads)
+    :return:
+    """
+    return _num_threads
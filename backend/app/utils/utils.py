@@ -1,5 +1,6 @@
 """
-Uses the spams package:
+Uses the spams package when installed (otherwise the concentrations are solved
+in closed form, see OD_concentrations_batch):
 
 http://spams-devel.gforge.inria.fr/index.html
 
@@ -10,7 +11,12 @@ from __future__ import division
 
 import numpy as np
 import cv2 as cv
-import spams
+try:
+    import spams
+except ImportError:  # spams is optional, see OD_concentrations
+    spams = None
+from app.utils import threads
+from app.utils import kernels
 # from sklearn.linear_model import MultiTaskLasso
 import matplotlib.pyplot as plt
 from skimage import exposure
@@ -81,20 +87,21 @@ def show(image, now=True, fig_size=(10, 10)):
 #         stack[i] = tup[i]
 #     return stack
 
-def build_stack(tup, target_height=512, target_width=512):
+def build_stack(tup, target_height=512, target_width=512, dtype=np.float64):
     """
     Build a stack of images from a tuple of images with resizing
     :param tup: Tuple of images
     :param target_height: Target height for resizing
     :param target_width: Target width for resizing
+    :param dtype: dtype of the stack (np.uint8 for the batch normalizer API)
     :return: Numpy array stack of images
     """
     N = len(tup)
     if len(tup[0].shape) == 3:
         c = tup[0].shape[2]
-        stack = np.zeros((N, target_height, target_width, c))
+        stack = np.zeros((N, target_height, target_width, c), dtype=dtype)
     else:
-        stack = np.zeros((N, target_height, target_width))
+        stack = np.zeros((N, target_height, target_width), dtype=dtype)
         
     for i in range(N):
         resized = cv.resize(tup[i], (target_width, target_height), interpolation=cv.INTER_AREA)
@@ -246,16 +253,198 @@ def plot_graph(transforms_dict, figsize=(15, 8), save_name=None):
 
 ######################################
 
-def standardize_brightness(I):
+# Values per cv.calcHist call: its float32 bin counts are exact up to 2**24
+_HISTOGRAM_CHUNK = 1 << 23
+
+# Size of the strided sample that brackets an order statistic before selecting it
+_SELECTION_SAMPLE = 20000
+
+
+def uint8_histogram(a):
+    """
+    Exact 256-bin value counts of a uint8 array (cv.calcHist in chunks, much faster
+    than np.bincount, which first casts every value to an index)
+    :param a: uint8 array of any shape
+    :return: int64 array of 256 counts
+    """
+    flat = np.ascontiguousarray(a).reshape(-1)
+    counts = np.zeros(256, dtype=np.int64)
+    for start in range(0, flat.size, _HISTOGRAM_CHUNK):
+        chunk = flat[start:start + _HISTOGRAM_CHUNK]
+        width = 1024 if chunk.size % 1024 == 0 else 1
+        counts += cv.calcHist([chunk.reshape((-1, width))], [0], None, [256], [0, 256]).ravel().astype(np.int64)
+    return counts
+
+
+def percentile(a, q, axis=None):
+    """
+    np.percentile(a, q, axis) (linear interpolation, same result) in linear time without
+    a full partition: uint8 data is counted into a 256-bin histogram, other data gets
+    each order statistic from a selection on the few values a strided sample brackets
+    it with.
+    :param a:
+    :param q: percentile or sequence of percentiles in [0, 100]
+    :param axis: None to use the flattened array, or the axis to reduce
+    :return: like np.percentile
+    """
+    a = np.asarray(a)
+    if axis is None:
+        return _percentile_1d(a.reshape(-1), q)
+    moved = np.moveaxis(a, axis, 0)
+    rest = moved.shape[1:]
+    columns = moved.reshape((moved.shape[0], -1))
+    result = np.stack([_percentile_1d(columns[:, j], q) for j in range(columns.shape[1])], axis=-1)
+    return result.reshape(np.shape(q) + rest)
+
+
+def _percentile_1d(a, q):
+    n = a.size
+    if n == 0:
+        raise ValueError("percentile of an empty array")
+    virtual = (n - 1) * np.true_divide(q, 100)
+    lo = np.minimum(np.floor(virtual), n - 1).astype(np.intp)
+    hi = np.minimum(lo + 1, n - 1)
+    gamma = virtual - np.floor(virtual)
+    if a.dtype == np.uint8:
+        cdf = np.cumsum(uint8_histogram(a))
+        previous = np.searchsorted(cdf, lo, side='right').astype(np.float64)
+        upper = np.searchsorted(cdf, hi, side='right').astype(np.float64)
+    else:
+        ranks = np.unique(np.concatenate((np.ravel(lo), np.ravel(hi))))
+        values = dict(zip(ranks.tolist(), _select(a, ranks)))
+        previous = np.vectorize(values.get, otypes=[a.dtype])(lo)
+        upper = np.vectorize(values.get, otypes=[a.dtype])(hi)
+    # Interpolate as numpy does (numpy.lib's _lerp), for bit-identical results
+    diff = upper - previous
+    result = np.where(gamma >= 0.5, upper - diff * (1 - gamma), previous + diff * gamma)
+    return result[()] if np.ndim(result) == 0 else result
+
+
+def _select(a, ranks):
+    """
+    Values of the given ascending ranks (order statistics) of a 1D array. A sorted
+    strided sample gives bounds that enclose each group of nearby ranks with high
+    probability; only the values between them are partitioned. Falls back to a full
+    partition when the bounds miss (e.g. on heavily tied data), so the result is
+    always exact.
+    """
+    n = a.size
+    if n <= 4 * _SELECTION_SAMPLE:
+        return np.partition(a, ranks)[ranks]
+    sample = np.sort(a[::n // _SELECTION_SAMPLE])
+    m = sample.size
+    margin = int(3 * np.sqrt(m)) + 2
+    sample_ranks = (ranks / (n - 1) * (m - 1)).astype(np.intp)
+    # Ranks whose sample brackets overlap are selected together
+    groups = np.split(np.arange(ranks.size), np.flatnonzero(np.diff(sample_ranks) > 2 * margin) + 1)
+    values = np.empty(ranks.size, dtype=a.dtype)
+    for group in groups:
+        low = sample[max(0, sample_ranks[group[0]] - margin)]
+        high = sample[min(m - 1, sample_ranks[group[-1]] + margin + 1)]
+        below = np.count_nonzero(a < low)
+        window = a[(a >= low) & (a <= high)]
+        if not (below <= ranks[group[0]] and below + window.size > ranks[group[-1]]):
+            return np.partition(a, ranks)[ranks]
+        values[group] = np.partition(window, ranks[group] - below)[ranks[group] - below]
+    return values
+
+
+def check_batch(stack, out=None):
+    """
+    Validate an N x H x W x 3 uint8 stack and return the output array to write
+    into (a new one unless a matching caller-provided out is given)
+    :param stack:
+    :param out:
+    :return:
+    """
+    if not isinstance(stack, np.ndarray) or stack.dtype != np.uint8 or stack.ndim != 4 or stack.shape[-1] != 3:
+        raise ValueError("Stack must be an N x H x W x 3 uint8 numpy array.")
+    if out is None:
+        return np.empty(stack.shape, dtype=np.uint8)
+    if not isinstance(out, np.ndarray) or out.dtype != np.uint8 or out.shape != stack.shape:
+        raise ValueError("out must be a uint8 numpy array with the same shape as the stack.")
+    return out
+
+
+def standardize_brightness_batch(stack, out=None):
+    """
+    standardize_brightness applied to every image of an N x H x W x 3 uint8 stack,
+    one brightness lookup table pass per image straight into out
+    :param stack:
+    :param out: optional uint8 array to write into
+    :return:
+    """
+    if out is None:
+        out = np.empty(stack.shape, dtype=np.uint8)
+    for n in range(stack.shape[0]):
+        out[n] = cv.LUT(stack[n], brightness_lut(brightness_percentile(stack[n])))
+    return out
+
+
+def standardize_brightness(I, p=None):
     """
 
     :param I:
+    :param p: optional brightness percentile (see brightness_percentile), e.g. estimated on a downscaled copy
     :return:
     """
-    p = np.percentile(I, 90)
+    if p is None:
+        p = brightness_percentile(I)
+    if I.dtype == np.uint8:
+        return cv.LUT(I, brightness_lut(p))
     return np.clip(I * 255.0 / p, 0, 255).astype(np.uint8)
 
 
+def brightness_lut(p):
+    """
+    standardize_brightness of every uint8 value as a 256-entry lookup table
+    :param p: brightness percentile (see brightness_percentile)
+    :return:
+    """
+    return np.clip(np.arange(256) * 255.0 / p, 0, 255).astype(np.uint8)
+
+
+def standardized_OD(I, p=None):
+    """
+    Brightness standardized copy of I and its optical densities, the first step of
+    every stain method; compute it once to share it between methods
+    :param I:
+    :param p: optional brightness percentile (see standardize_brightness)
+    :return: (standardized RGB uint8 image, npix x 3 optical densities)
+    """
+    if I.dtype != np.uint8:
+        I = standardize_brightness(I, p=p)
+        return I, RGB_to_OD(I).reshape((-1, 3))
+    # Brightness table and the densities of its values applied in one pass
+    lut = remove_zeros(brightness_lut(p if p is not None else brightness_percentile(I)))
+    I, OD = kernels.lookup_pair(I, lut, OD_LUT[lut])
+    return I, OD.reshape((-1, 3))
+
+
+def brightness_percentile(I):
+    """
+    The 90th percentile used by standardize_brightness
+    :param I:
+    :return:
+    """
+    return percentile(I, 90)
+
+
+def downscale(I, scale=1):
+    """
+    Downscale an image by a factor for estimating global statistics (stain vectors,
+    LAB moments, histograms). Returns I itself when scale <= 1.
+    :param I:
+    :param scale: downscale factor, e.g. 4 for a quarter of the width and height
+    :return:
+    """
+    if scale is None or scale <= 1:
+        return I
+    h, w = I.shape[:2]
+    size = (max(1, int(round(w / scale))), max(1, int(round(h / scale))))
+    return cv.resize(I, size, interpolation=cv.INTER_AREA)
+
+
 def remove_zeros(I):
     """
     Remove zeros, replace with 1's.
@@ -267,6 +456,10 @@ def remove_zeros(I):
     return I
 
 
+# Optical density of every uint8 value (zeros count as 1, see remove_zeros)
+OD_LUT = -1 * np.log(np.maximum(np.arange(256), 1) / 255)
+
+
 def RGB_to_OD(I):
     """
     Convert from RGB to optical density
@@ -274,9 +467,29 @@ def RGB_to_OD(I):
     :return:
     """
     I = remove_zeros(I)
+    if I.dtype == np.uint8:
+        return OD_LUT[I]
     return -1 * np.log(I / 255)
 
 
+def iter_OD_chunks(I, chunk_size=1 << 16, p=None):
+    """
+    Optical densities of the pixels of I in fixed-size chunks, so only one chunk
+    of float64 densities is in memory at a time
+    :param I: RGB uint8 image
+    :param chunk_size: pixels per chunk
+    :param p: optional brightness percentile; when given every chunk is brightness
+        standardized first (the chunked form of standardized_OD)
+    :return: generator of (slice of the flattened pixels, uint8 RGB chunk as used, OD chunk)
+    """
+    flat = I.reshape((-1, 3))
+    lut = remove_zeros(brightness_lut(p) if p is not None else np.arange(256, dtype=np.uint8))
+    OD_values = OD_LUT[lut]
+    for start in range(0, flat.shape[0], chunk_size):
+        rgb, OD = kernels.lookup_pair(flat[start:start + chunk_size], lut, OD_values)
+        yield slice(start, start + rgb.shape[0]), rgb, OD
+
+
 def OD_to_RGB(OD):
     """
     Convert from optical density to RGB
@@ -321,13 +534,248 @@ def sign(x):
         return 0
 
 
-def get_concentrations(I, stain_matrix, lamda=0.01):
+def get_concentrations(I, stain_matrix, lamda=0.01, mask=None, chunk_size=None):
     """
     Get concentrations, a npix x 2 matrix
     :param I:
     :param stain_matrix: a 2x3 stain matrix
+    :param mask: optional flat boolean tissue mask, only those pixels are solved (ntissue x 2)
+    :param chunk_size: optional number of pixels to convert and solve at a time, bounding
+        the optical densities in memory to one chunk
     :return:
     """
+    if chunk_size is not None and I.dtype == np.uint8:
+        C = np.empty((I.shape[0] * I.shape[1] if mask is None else np.count_nonzero(mask), 2))
+        filled = 0
+        for chunk, _, OD in iter_OD_chunks(I, chunk_size):
+            if mask is not None:
+                OD = OD[mask[chunk]]
+            C[filled:filled + OD.shape[0]] = OD_concentrations(OD, stain_matrix, lamda=lamda)
+            filled += OD.shape[0]
+        return C
     OD = RGB_to_OD(I).reshape((-1, 3))
-    return spams.lasso(OD.T, D=stain_matrix.T, mode=2, lambda1=lamda, pos=True).toarray().T
+    if mask is not None:
+        OD = OD[mask]
+    return OD_concentrations(OD, stain_matrix, lamda=lamda)
+
+
+def OD_concentrations(OD, stain_matrix, lamda=0.01):
+    """
+    Get concentrations for an npix x 3 array of optical densities
+    :param OD:
+    :param stain_matrix: a 2x3 stain matrix
+    :param lamda:
+    :return:
+    """
+    if spams is None:
+        return OD_concentrations_batch(OD[None], stain_matrix[None], lamda=lamda)[0]
+    return spams.lasso(OD.T, D=stain_matrix.T, mode=2, lambda1=lamda, pos=True,
+                       numThreads=threads.num_threads()).toarray().T
+
+
+# How pixels outside the tissue mask are written by concentrations_to_RGB
+BACKGROUND_MODES = ('passthrough', 'white')
+
+
+def tissue_mask(I, thresh=0.8):
+    """
+    Flat boolean mask of the tissue ('not white') pixels of I
+    :param I:
+    :param thresh:
+    :return:
+    """
+    return notwhite_mask(I, thresh=thresh).reshape((-1,))
+
+
+def concentrations_to_RGB(C, stain_matrix, I, mask=None, background='white'):
+    """
+    Reconstruct an RGB uint8 image shaped like I from concentrations.
+    With a mask, C only holds the tissue pixels and the background is either
+    copied from I ('passthrough') or set to white ('white').
+    :param C: npix x 2 (or ntissue x 2) concentrations
+    :param stain_matrix: a 2x3 stain matrix
+    :param I: image the concentrations were computed from
+    :param mask: optional flat boolean tissue mask
+    :param background: one of BACKGROUND_MODES
+    :return:
+    """
+    RGB = kernels.stains_to_uint8(C, stain_matrix)
+    if mask is None:
+        return RGB.reshape(I.shape)
+    if background == 'white':
+        out = np.full((mask.shape[0], 3), 255, dtype=np.uint8)
+    else:
+        out = I.reshape((-1, 3)).copy()
+    out[mask] = RGB
+    return out.reshape(I.shape)
+
+
+def concentration_maps(C, I, mask=None, out=None):
+    """
+    Per-pixel stain concentration maps shaped like I, with zero (no stain) in the
+    background pixels left out of a masked solve.
+    :param C: npix x 2 (or ntissue x 2) concentrations
+    :param I: image the concentrations were computed from
+    :param mask: optional flat boolean tissue mask
+    :param out: optional npix x 2 float32 array to write into (e.g. one chunk of the maps)
+    :return: H x W x 2 float32 (hematoxylin, eosin), or out
+    """
+    if out is None:
+        out = np.zeros((I.shape[0] * I.shape[1], 2), dtype=np.float32)
+        shape = I.shape[:2] + (2,)
+    else:
+        shape = out.shape
+    if mask is None:
+        out[...] = C
+    else:
+        out[~mask] = 0
+        out[mask] = C
+    return out.reshape(shape)
+
+
+def OD_concentrations_batch(OD, stain_matrices, lamda=0.01):
+    """
+    Concentrations for a stack of images, each with its own 2x3 stain matrix.
+    Solves the same positive lasso as OD_concentrations (spams mode=2) in closed
+    form: with two stains the optimum is either the unconstrained solution on
+    both stains, the best single stain, or zero, so all pixels of all images are
+    solved in one vectorized pass.
+    :param OD: N x npix x 3 optical densities
+    :param stain_matrices: N x 2 x 3 stain matrices
+    :param lamda:
+    :return: N x npix x 2
+    """
+    S = np.asarray(stain_matrices, dtype=np.float64)
+    G = np.matmul(S, np.swapaxes(S, 1, 2))
+    b = np.matmul(OD, np.swapaxes(S, 1, 2)) - lamda
+    g00, g01, g11 = G[:, 0, 0, None], G[:, 0, 1, None], G[:, 1, 1, None]
+    det = g00 * g11 - g01 * g01
+    det = np.where(np.abs(det) > 1e-12, det, np.inf)
+    b0, b1 = b[..., 0], b[..., 1]
+    both0 = (g11 * b0 - g01 * b1) / det
+    both1 = (g00 * b1 - g01 * b0) / det
+    # Best single-stain solution (objective -0.5 * b_i^2 / G_ii when b_i > 0)
+    single0 = np.maximum(b0, 0) / g00
+    single1 = np.maximum(b1, 0) / g11
+    use0 = single0 * b0 >= single1 * b1
+    C = np.empty(b.shape)
+    C[..., 0] = np.where(use0, single0, 0)
+    C[..., 1] = np.where(use0, 0, single1)
+    both = (both0 > 0) & (both1 > 0)
+    C[..., 0] = np.where(both, both0, C[..., 0])
+    C[..., 1] = np.where(both, both1, C[..., 1])
+    return C
+
+
+######################################
+
+class RunningMoments(object):
+    """
+    Streaming mean and covariance of row vectors.
+
+    Batches are merged with Chan et al.'s pairwise update, so the result matches
+    the statistics of all rows seen so far without keeping them in memory.
+    """
+
+    def __init__(self, dim):
+        self.n = 0
+        self.mean = np.zeros(dim)
+        self.M2 = np.zeros((dim, dim))
+
+    def update(self, X):
+        """
+        Merge a batch of rows
+        :param X: m x dim array
+        :return:
+        """
+        X = np.asarray(X, dtype=np.float64).reshape((-1, self.mean.shape[0]))
+        m = X.shape[0]
+        if m == 0:
+            return self
+        batch_mean = X.mean(axis=0)
+        centered = X - batch_mean
+        batch_M2 = np.dot(centered.T, centered)
+        delta = batch_mean - self.mean
+        n = self.n + m
+        self.M2 += batch_M2 + np.outer(delta, delta) * (self.n * m / n)
+        self.mean += delta * (m / n)
+        self.n = n
+        return self
+
+    def covariance(self, ddof=1):
+        """
+        Covariance of all rows seen so far (ddof=1 matches np.cov)
+        :param ddof:
+        :return:
+        """
+        return self.M2 / max(self.n - ddof, 1)
+
+    def variance(self, ddof=0):
+        """
+        Per-column variance (ddof=0 matches cv.meanStdDev)
+        :param ddof:
+        :return:
+        """
+        return np.diag(self.covariance(ddof=ddof)).copy()
+
+
+class ReservoirSample(object):
+    """
+    Fixed-size uniform sample of rows drawn from a stream of batches.
+
+    Every row gets a random key and the rows with the smallest keys are kept
+    (bottom-k sampling), so memory stays constant and samples of separate
+    streams can be pooled by simply updating one with the other's rows.
+    Rows are buffered and the sample compacted once per sample size of new
+    entries; once full, rows keyed above the current sample never enter.
+    """
 
+    def __init__(self, size=200000, seed=None):
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.keys = np.empty(0)
+        self._rows = None
+        self._threshold = np.inf
+        self._pending = []
+        self._n_pending = 0
+
+    def update(self, X):
+        """
+        Offer a batch of rows to the sample
+        :param X: m x d array
+        :return:
+        """
+        X = np.asarray(X)
+        keys = self.rng.random(X.shape[0])
+        if self._rows is None:
+            self._rows = X[:0].copy()
+        entering = keys < self._threshold
+        if not entering.all():
+            keys, X = keys[entering], X[entering]
+        if keys.shape[0]:
+            self._pending.append((keys, X))
+            self._n_pending += keys.shape[0]
+            if self._n_pending >= self.size:
+                self._compact()
+        return self
+
+    @property
+    def rows(self):
+        """
+        The sampled rows
+        :return:
+        """
+        if self._pending:
+            self._compact()
+        return self._rows
+
+    def _compact(self):
+        keys = np.concatenate([self.keys] + [k for k, _ in self._pending])
+        rows = np.concatenate([self._rows] + [r for _, r in self._pending])
+        self._pending = []
+        self._n_pending = 0
+        if keys.shape[0] > self.size:
+            keep = np.argpartition(keys, self.size)[:self.size]
+            keys, rows = keys[keep], rows[keep]
+            self._threshold = keys.max()
+        self.keys, self._rows = keys, rows
@@ -0,0 +1,136 @@
+"""
+Benchmark of the Vahadane stain dictionary backends.
+
+Estimates the stain matrix of synthetic H&E-like images (see load_test.py) of
+known stains with every available backend (spams trainDL and the NumPy NMF),
+and reports per size the estimation time, the angle in degrees between each
+estimated stain vector and the true one (and the spams one), and how far the
+normalized images of the two backends are apart.
+
+    python benchmark_vahadane.py --sizes 256,1024,2048 --repeats 3
+"""
+
+import argparse
+import functools
+import json
+import time
+
+import numpy as np
+
+from app.normalization_methods import vahadane
+from app.utils import utils as ut
+from load_test import synthetic_image, SOURCE_STAINS, REFERENCE_STAINS
+
+
+def available_backends():
+    return [name for name in vahadane.DICTIONARY_BACKENDS if name != "spams" or vahadane.spams is not None]
+
+
+def stain_angles(estimate, truth):
+    """
+    Angle in degrees between corresponding rows (hematoxylin, eosin) of two stain matrices
+    :param estimate: 2x3
+    :param truth: 2x3
+    :return: [hematoxylin, eosin]
+    """
+    cosine = np.sum(ut.normalize_rows(estimate) * ut.normalize_rows(truth), axis=1)
+    return [float(a) for a in np.degrees(np.arccos(np.clip(cosine, -1, 1)))]
+
+
+def estimate_stain_matrix(OD, backend, sample_size=None):
+    """
+    Stain matrix with a backend, the NMF learning from sample_size pixels when given
+    """
+    if backend != "nmf" or sample_size is None:
+        return vahadane.stain_matrix_from_OD(OD, backend=backend)
+    dictionary = vahadane.nmf_dictionary(OD, sample_size=sample_size)
+    if dictionary[0, 0] < dictionary[1, 0]:
+        dictionary = dictionary[[1, 0], :]
+    return ut.normalize_rows(dictionary)
+
+
+def timed(function, repeats):
+    """
+    Result of the last call and the best time in seconds over repeats calls
+    """
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def run(args):
+    backends = available_backends()
+    report = {"backends": backends, "sizes": {}}
+    for size in args.sizes:
+        source = synthetic_image(size, seed=size)
+        target = synthetic_image(size, seed=size + 1, stain_matrix=REFERENCE_STAINS)
+        mask = ut.tissue_mask(source, thresh=0.8)
+        OD = ut.RGB_to_OD(source).reshape((-1, 3))[mask]
+        rows = {}
+        for backend in backends:
+            estimate = functools.partial(estimate_stain_matrix, OD, backend, args.sample_size)
+            stain_matrix, seconds = timed(estimate, args.repeats)
+            rows[backend] = {"seconds": seconds, "stain_matrix": stain_matrix.tolist(),
+                             "angle_to_truth": stain_angles(stain_matrix, SOURCE_STAINS)}
+
+        # End to end: the same fit and transform with each backend selected
+        results = {}
+        previous = vahadane.dictionary_backend()
+        try:
+            for backend in backends:
+                vahadane.set_dictionary_backend(backend)
+                normalizer = vahadane.Normalizer()
+                normalizer.fit(target)
+                results[backend] = normalizer.transform(source).astype(np.int16)
+        finally:
+            vahadane.set_dictionary_backend(previous)
+
+        if "spams" in rows:
+            for backend in backends:
+                rows[backend]["angle_to_spams"] = stain_angles(np.array(rows[backend]["stain_matrix"]),
+                                                               np.array(rows["spams"]["stain_matrix"]))
+                difference = np.abs(results[backend] - results["spams"])
+                rows[backend]["output_mean_abs_diff"] = float(difference.mean())
+                rows[backend]["output_p99_abs_diff"] = float(np.percentile(difference, 99))
+        report["sizes"][size] = {"tissue_pixels": int(mask.sum()), "backends": rows}
+    return report
+
+
+def print_report(report):
+    print(f"backends: {', '.join(report['backends'])}")
+    print(f"{'size':>6}{'backend':>9}{'ms':>10}{'H err':>8}{'E err':>8}{'H vs spams':>12}{'E vs spams':>12}"
+          f"{'mean diff':>11}{'p99 diff':>10}")
+    for size, entry in report["sizes"].items():
+        for backend, r in entry["backends"].items():
+            line = (f"{size:>6}{backend:>9}{r['seconds'] * 1000:>10.1f}"
+                    f"{r['angle_to_truth'][0]:>8.2f}{r['angle_to_truth'][1]:>8.2f}")
+            if "angle_to_spams" in r:
+                line += (f"{r['angle_to_spams'][0]:>12.2f}{r['angle_to_spams'][1]:>12.2f}"
+                         f"{r['output_mean_abs_diff']:>11.2f}{r['output_p99_abs_diff']:>10.1f}")
+            print(line)
+    print("errors are angles in degrees between stain vectors; diffs are in 8-bit levels of the normalized image")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Vahadane stain dictionary backends")
+    parser.add_argument("--sizes", default="256,1024",
+                        type=lambda s: [int(size) for size in s.split(",")],
+                        help="Comma-separated side lengths of the synthetic images")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed estimations per backend (best is reported)")
+    parser.add_argument("--sample-size", type=int, default=None,
+                        help="Pixels the NMF backend learns from (default: its own default)")
+    parser.add_argument("--json", default=None, help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
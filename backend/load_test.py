@@ -0,0 +1,290 @@
+"""
+Load test for the HTTP API.
+
+Starts the app with uvicorn in a temporary working directory (its uploads,
+results and cache never touch the real ones) and replays a mix of /process
+requests on synthetic H&E-like images at a fixed concurrency. Like the frontend,
+every processed image is followed by its /chart-data, result /download and
+deferred chart data (chart_url) requests. Reports throughput, latency percentiles and
+error rates per endpoint and the server's memory growth over the run.
+
+    python load_test.py --requests 200 --concurrency 8 --mix 3:4,4:2,5:1 --sizes 256,1024
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+
+API = "/api/normalization"
+
+# Stain vectors (rows: hematoxylin, eosin) of the synthetic sources and reference
+SOURCE_STAINS = np.array([[0.65, 0.70, 0.29], [0.07, 0.99, 0.11]])
+REFERENCE_STAINS = np.array([[0.55, 0.76, 0.34], [0.15, 0.95, 0.27]])
+
+
+def synthetic_image(size, seed, stain_matrix=SOURCE_STAINS):
+    """
+    H&E-like RGB uint8 image: smooth random stain concentrations with white background
+    :param size: side length in pixels
+    :param seed:
+    :param stain_matrix: 2x3 stain matrix
+    :return:
+    """
+    rng = np.random.default_rng(seed)
+    coarse = rng.random((2, 16, 16)).astype(np.float32)
+    C = np.stack([cv.resize(c, (size, size), interpolation=cv.INTER_CUBIC) for c in coarse], axis=-1)
+    C = np.clip(C, 0, None) * np.array([1.2, 0.8], dtype=np.float32)
+    tissue = cv.resize(rng.random((8, 8)).astype(np.float32), (size, size), interpolation=cv.INTER_CUBIC) > 0.35
+    C *= tissue[..., None]
+    rgb = 255 * np.exp(-C.reshape((-1, 2)) @ stain_matrix.astype(np.float32))
+    rgb += rng.normal(0, 2, rgb.shape)
+    return np.clip(rgb, 0, 255).astype(np.uint8).reshape((size, size, 3))
+
+
+def encode_png(img):
+    return cv.imencode(".png", cv.cvtColor(img, cv.COLOR_RGB2BGR))[1].tobytes()
+
+
+def multipart(fields, files):
+    """
+    multipart/form-data body for urllib
+    :param fields: dict of form field -> value
+    :param files: dict of form field -> (filename, bytes)
+    :return: (body, content type)
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def process_tree_rss(pid):
+    """
+    Resident memory in bytes of a process and its children (Linux /proc), or None
+    :param pid:
+    :return:
+    """
+    try:
+        children = {}
+        for stat in Path("/proc").glob("[0-9]*/stat"):
+            try:
+                fields = stat.read_text().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            children.setdefault(int(fields[1]), []).append(int(stat.parent.name))
+        total, pending = 0, [pid]
+        while pending:
+            p = pending.pop()
+            pending.extend(children.get(p, []))
+            try:
+                total += int(Path(f"/proc/{p}/statm").read_text().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            except OSError:
+                pass
+        return total
+    except (OSError, ValueError):
+        return None
+
+
+class Server:
+    """The app served by uvicorn in a temporary working directory"""
+
+    def __init__(self, workers=1, env=None):
+        self.workers = workers
+        self.env = env or {}
+        self.workdir = tempfile.TemporaryDirectory(prefix="color_norm_load_")
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process = None
+
+    def __enter__(self):
+        env = dict(os.environ, PYTHONPATH=str(Path(__file__).resolve().parent), **self.env)
+        self.log = open(Path(self.workdir.name) / "server.log", "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--workers", str(self.workers), "--log-level", "warning"],
+            cwd=self.workdir.name, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                urllib.request.urlopen(f"{self.url}{API}/methods", timeout=1).read()
+                return self
+            except OSError:
+                time.sleep(0.2)
+        self.__exit__(None, None, None)
+        raise RuntimeError("The server did not start:\n" + (Path(self.workdir.name) / "server.log").read_text()[-2000:])
+
+    def __exit__(self, *exc):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+        self.workdir.cleanup()
+
+
+def request(url, body=None, content_type=None, timeout=600):
+    """
+    One HTTP request
+    :return: (status code or None on connection errors, response body, seconds)
+    """
+    headers = {"Content-Type": content_type} if content_type else {}
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=body, headers=headers), timeout=timeout) as r:
+            content, status = r.read(), r.status
+    except urllib.error.HTTPError as e:
+        content, status = e.read(), e.code
+    except OSError as e:
+        content, status = str(e).encode(), None
+    return status, content, time.perf_counter() - start
+
+
+def parse_mix(mix):
+    """
+    'method:weight,...' -> (methods, probabilities)
+    :param mix:
+    :return:
+    """
+    methods, weights = [], []
+    for item in mix.split(","):
+        method, _, weight = item.partition(":")
+        methods.append(int(method))
+        weights.append(float(weight or 1))
+    weights = np.array(weights)
+    return methods, weights / weights.sum()
+
+
+def run(args):
+    methods, probabilities = parse_mix(args.mix)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    images = {size: [encode_png(synthetic_image(size, seed)) for seed in range(args.variants)] for size in sizes}
+    reference = encode_png(synthetic_image(max(sizes), 1000, REFERENCE_STAINS))
+    rng = np.random.default_rng(args.seed)
+    plan = [(int(rng.choice(methods, p=probabilities)), int(rng.choice(sizes)), int(rng.integers(args.variants)))
+            for _ in range(args.requests)]
+
+    env = {} if args.cache else {"COLOR_NORM_CACHE": "0"}
+    with Server(args.workers, env) as server:
+        samples = {}  # endpoint -> list of (seconds, status)
+        lock = threading.Lock()
+
+        def record(endpoint, status, seconds):
+            with lock:
+                samples.setdefault(endpoint, []).append((seconds, status))
+
+        def scenario(item):
+            method, size, variant = item
+            fields = {"method": method}
+            files = {"source_image": (f"load_{size}_{variant}.png", images[size][variant])}
+            if method != 1:
+                files["reference_image"] = ("reference.png", reference)
+            body, content_type = multipart(fields, files)
+            status, content, seconds = request(f"{server.url}{API}/process", body, content_type)
+            record(f"process[{method}]", status, seconds)
+            if status != 200:
+                return
+            response = json.loads(content)
+            source = os.path.basename(response["source_image"]["path"])
+            record("chart-data", *request(f"{server.url}{API}/chart-data/{source}")[::2])
+            result = response.get("result_image") or response["result_images"][-1]
+            record("download", *request(f"{server.url}{result['download_url']}")[::2])
+            if response.get("chart_url"):
+                record("charts", *request(f"{server.url}{response['chart_url']}")[::2])
+
+        memory = [process_tree_rss(server.process.pid)]
+        done = threading.Event()
+
+        def sample_memory():
+            while not done.wait(0.5):
+                memory.append(process_tree_rss(server.process.pid))
+
+        sampler = threading.Thread(target=sample_memory, daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(scenario, plan))
+        elapsed = time.perf_counter() - start
+        done.set()
+        sampler.join()
+        memory.append(process_tree_rss(server.process.pid))
+
+    report = {"requests": args.requests, "concurrency": args.concurrency, "seconds": elapsed, "endpoints": {}}
+    for endpoint, values in sorted(samples.items()):
+        seconds = np.array([s for s, _ in values])
+        errors = sum(status != 200 for _, status in values)
+        report["endpoints"][endpoint] = {
+            "count": len(values),
+            "errors": errors,
+            "error_rate": errors / len(values),
+            "throughput": len(values) / elapsed,
+            "p50_ms": float(np.percentile(seconds, 50) * 1000),
+            "p95_ms": float(np.percentile(seconds, 95) * 1000),
+            "p99_ms": float(np.percentile(seconds, 99) * 1000),
+        }
+    if None not in memory:
+        report["memory"] = {"start_mb": memory[0] / 2 ** 20, "peak_mb": max(memory) / 2 ** 20,
+                            "end_mb": memory[-1] / 2 ** 20, "growth_mb": (memory[-1] - memory[0]) / 2 ** 20}
+    return report
+
+
+def print_report(report):
+    print(f"{report['requests']} scenarios at concurrency {report['concurrency']} in {report['seconds']:.1f}s")
+    print(f"{'endpoint':<16}{'count':>7}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, r in report["endpoints"].items():
+        print(f"{endpoint:<16}{r['count']:>7}{r['errors']:>8}{r['throughput']:>9.2f}"
+              f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}")
+    if "memory" in report:
+        m = report["memory"]
+        print(f"server memory: start {m['start_mb']:.0f} MB, peak {m['peak_mb']:.0f} MB, "
+              f"end {m['end_mb']:.0f} MB (growth {m['growth_mb']:+.0f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Color Norm API on synthetic images")
+    parser.add_argument("--requests", type=int, default=100, help="Number of /process scenarios to replay")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent clients")
+    parser.add_argument("--mix", default="2:1,3:1,4:1,5:1",
+                        help="Methods and their weights, e.g. '3:4,4:2,5:1' (method numbers as in /process)")
+    parser.add_argument("--sizes", default="256,512", help="Comma-separated side lengths of the synthetic sources")
+    parser.add_argument("--variants", type=int, default=8,
+                        help="Distinct source images per size (repeats hit the result cache unless --no-cache)")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--no-cache", dest="cache", action="store_false", help="Disable the server's result cache")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the request plan")
+    parser.add_argument("--json", default=None, help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
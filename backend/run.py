@@ -1,4 +1,42 @@
+import argparse
+import logging
+import os
+
 import uvicorn
 
+from app.config import settings
+from app.utils import threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Color Norm API")
+    parser.add_argument("--prod", action="store_true",
+                        help="Production mode: multiple workers, no reload, bounded compute threads")
+    parser.add_argument("--host", default=None, help="Bind host (default: COLOR_NORM_HOST or 0.0.0.0 in --prod)")
+    parser.add_argument("--port", type=int, default=None, help="Bind port (default: COLOR_NORM_PORT or 8080)")
+    parser.add_argument("--workers", type=int, default=settings.workers,
+                        help="Worker processes (default: COLOR_NORM_WORKERS or derived from available cores)")
+    parser.add_argument("--threads", type=int, default=settings.compute_threads,
+                        help="Compute threads per worker for BLAS/OpenMP/OpenCV/spams "
+                             "(default: COLOR_NORM_COMPUTE_THREADS or derived from available cores)")
+    args = parser.parse_args()
+
+    if not args.prod:
+        uvicorn.run("app.main:app", host=args.host or "localhost", port=args.port or 8080, reload=True)
+        return
+
+    cores = threads.available_cores()
+    workers, compute_threads = threads.plan_workers(cores, args.workers, args.threads)
+    # Workers inherit these, so numpy/OpenCV/spams start with the limit applied
+    threads.set_thread_env(compute_threads)
+    os.environ["COLOR_NORM_COMPUTE_THREADS"] = str(compute_threads)
+    os.environ["COLOR_NORM_WORKERS"] = str(workers)
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger(__name__).info(
+        f"Starting {workers} workers x {compute_threads} compute threads on {cores} cores")
+    uvicorn.run("app.main:app", host=args.host or settings.host, port=args.port or settings.port,
+                workers=workers, reload=False)
+
+
 if __name__ == "__main__":
-    uvicorn.run("app.main:app", host="localhost", port=8080, reload=True)
\ No newline at end of file
+    main()
@@ -1,12 +1,32 @@
 import React from "react";
 import { ScatterChart } from "@mui/x-charts/ScatterChart";
 
+const CHANNEL_COLORS = ["red", "green", "blue"];
+
+// Expand the density grid (bins x bins counts and dominant channels) into one point per occupied cell
+const densityPoints = (density) => {
+  const step = (density.max - density.min) / density.bins;
+  const points = [];
+  density.counts.forEach((row, i) => {
+    row.forEach((count, j) => {
+      if (count > 0) {
+        points.push({
+          x: density.min + (i + 0.5) * step,
+          y: density.min + (j + 0.5) * step,
+          color: CHANNEL_COLORS[density.dominant[i][j]],
+        });
+      }
+    });
+  });
+  return points;
+};
+
 const ScatterPlotChart = ({
   data,
   title = "RGB Scatter Plot",
   imageType = "source",
 }) => {
-  if (!data || !data[imageType] || !data[imageType].scatter_plots) {
+  if (!data || !data[imageType] || (!data[imageType].scatter_plots && !data[imageType].scatter_density)) {
     return (
       <div className="p-8 text-center bg-gradient-to-br from-gray-50 to-blue-50 rounded-lg border border-gray-200">
         <div className="max-w-md mx-auto">
@@ -21,7 +41,9 @@ const ScatterPlotChart = ({
   }
 
   // Get scatter plot data
-  const scatterData = data[imageType].scatter_plots;
+  const scatterData = data[imageType].scatter_density
+    ? densityPoints(data[imageType].scatter_density)
+    : data[imageType].scatter_plots;
 
   // Group data by color/channel
   const redPoints = scatterData.filter((point) => point.color === "red");
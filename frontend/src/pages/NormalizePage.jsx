@@ -16,7 +16,7 @@ import {
   Eye,
   TrendingUp
 } from "lucide-react";
-import { processImage, getMethods } from "../services/api";
+import { processImage, getMethods, getChartData } from "../services/api";
 import HistogramChart from "../components/HistogramChart";
 import ScatterPlotChart from "../components/ScatterPlotChart";
 
@@ -153,6 +153,15 @@ const NormalizePage = () => {
           console.log("Setting chart data:", response.chart_data);
           setChartData(response.chart_data);
           resetChartIndex();
+        } else if (response.chart_url) {
+          // Charts are computed on demand, after the result image is shown
+          setChartData(null);
+          getChartData(response.chart_url)
+            .then((data) => {
+              setChartData(data);
+              resetChartIndex();
+            })
+            .catch((err) => console.error("Error loading chart data:", err));
         } else {
           console.log("No chart data in response");
           setChartData(null);
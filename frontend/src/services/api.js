@@ -33,4 +33,9 @@ export const processImage = async (sourceImage, method, referenceImage = null) =
   return response.data;
 };
 
+export const getChartData = async (chartUrl) => {
+  const response = await api.get(chartUrl);
+  return response.data;
+};
+
 export default api; 
\ No newline at end of file